@@ -1,5 +1,11 @@
+import atexit
 from django.apps import AppConfig
 
 
 class CoreConfig(AppConfig):
     name = 'core'
+
+    def ready(self):
+        from core.services import note_store
+        # Write-behind notes still in memory are written before the process exits
+        atexit.register(note_store.flush_all)
@@ -0,0 +1,41 @@
+import os
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from core.services import note_store
+
+
+class Command(BaseCommand):
+    help = "Re-encodes every Note and CommonNote file under MEDIA_ROOT/notes with NOTE_COMPRESSION (or --codec)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--codec', choices=sorted(note_store.CODECS), help="Codec to convert to (default: NOTE_COMPRESSION)")
+
+    def handle(self, *args, **options):
+        codec = options['codec'] or note_store.storage_codec()
+        if codec == 'zstd' and note_store.zstandard is None:
+            raise CommandError("zstd needs the 'zstandard' package")
+
+        root = os.path.join(settings.MEDIA_ROOT, 'notes')
+        paths = set()
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                if filename.endswith('.html.blocks'): # A note whose body has not been built yet
+                    paths.add(os.path.join(dirpath, filename[:-len('.blocks')]))
+                    continue
+                for suffix in note_store.CODECS.values():
+                    if filename.endswith('.html' + suffix):
+                        paths.add(os.path.join(dirpath, filename[:len(filename) - len(suffix)]))
+                        break
+
+        converted = before = after = 0
+        for path in sorted(paths):
+            sizes = note_store.recompress(path, codec)
+            if sizes:
+                converted += 1
+                before += sizes[0]
+                after += sizes[1]
+                self.stdout.write(f"{os.path.relpath(path, root)}: {sizes[0]} -> {sizes[1]} bytes")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Converted {converted} of {len(paths)} notes to {codec}: {before} -> {after} bytes."
+        ))
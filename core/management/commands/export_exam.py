@@ -0,0 +1,40 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from core.models import Exam
+from core.services import exam_archive
+from core.services.export import buffered
+
+
+class Command(BaseCommand):
+    help = "Writes a whole exam (subjects, videos, chunks and notes) to a JSON Lines archive."
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('exam_id', type=int)
+        parser.add_argument('-o', '--output', default='-', help="Archive path ('-' for stdout, the default)")
+        parser.add_argument('--gzip', action='store_true', help="Compress the archive (implied by a .gz output path)")
+
+    def handle(self, *args, **options):
+        try:
+            exam = Exam.objects.get(id=options['exam_id'], user__username=options['username'])
+        except Exam.DoesNotExist:
+            raise CommandError(f"User '{options['username']}' has no exam {options['exam_id']}")
+
+        output = options['output']
+        compress = options['gzip'] or output.endswith('.gz')
+        blocks = buffered(exam_archive.export_lines(exam))
+        if compress:
+            blocks = exam_archive.gzip_stream(blocks)
+        else:
+            blocks = (block.encode('utf-8') for block in blocks)
+
+        if output == '-':
+            for block in blocks:
+                sys.stdout.buffer.write(block)
+            sys.stdout.buffer.flush()
+            return
+
+        with open(output, 'wb') as f:
+            for block in blocks:
+                f.write(block)
+        self.stdout.write(self.style.SUCCESS(f"Exported '{exam.name}' to {output}."))
@@ -0,0 +1,38 @@
+import datetime
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from core.services import export
+
+
+class Command(BaseCommand):
+    help = "Streams a user's study logs, sessions, goals and watched state as CSV or NDJSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('--format', choices=sorted(export.FORMATS), default='csv')
+        parser.add_argument('--from', dest='start', help="First day to include (YYYY-MM-DD)")
+        parser.add_argument('--to', dest='end', help="Last day to include (YYYY-MM-DD)")
+        parser.add_argument('--output', '-o', help="Output file (default: stdout)")
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError(f"User '{options['username']}' does not exist")
+
+        try:
+            start = datetime.date.fromisoformat(options['start']) if options['start'] else None
+            end = datetime.date.fromisoformat(options['end']) if options['end'] else None
+        except ValueError:
+            raise CommandError("Dates must be in YYYY-MM-DD format")
+
+        stream, _ = export.FORMATS[options['format']]
+        lines = export.buffered(stream(export.export_rows(user, start, end)))
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as f:
+                for block in lines:
+                    f.write(block)
+        else:
+            for block in lines:
+                self.stdout.write(block, ending='')
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.services import note_history
+
+
+class Command(BaseCommand):
+    help = "Deletes note history chunks under MEDIA_ROOT/notes/objects that no version refers to."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep', type=int, help="First drop all but the newest KEEP versions of every note")
+        parser.add_argument(
+            '--grace', type=int, default=note_history.GC_GRACE_SECONDS,
+            help="Keep unreferenced chunks younger than this many seconds (default: %(default)s)",
+        )
+
+    def handle(self, *args, **options):
+        keep = options['keep']
+        if keep is not None:
+            if keep < 1:
+                raise CommandError("--keep must be at least 1")
+            dropped = sum(note_history.prune(path, keep) for path in note_history.history_paths())
+            self.stdout.write(f"Dropped {dropped} old versions.")
+
+        deleted, freed = note_history.collect_garbage(options['grace'])
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} unused chunks ({freed} bytes)."))
@@ -0,0 +1,34 @@
+import sys
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from core.services import exam_archive
+
+
+class Command(BaseCommand):
+    help = "Restores an exam archive written by export_exam as a new exam of the given user."
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('file', help="Archive path, plain or gzipped ('-' for stdin)")
+        parser.add_argument('--name', help="Name of the new exam (defaults to the archived name)")
+        parser.add_argument('--reset-progress', action='store_true', help="Import every video and chunk as unwatched")
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError(f"User '{options['username']}' does not exist")
+
+        kwargs = {'name': options['name'], 'reset_progress': options['reset_progress']}
+        try:
+            if options['file'] == '-':
+                exam = exam_archive.import_archive(sys.stdin.buffer, user, **kwargs)
+            else:
+                with open(options['file'], 'rb') as f:
+                    exam = exam_archive.import_archive(f, user, **kwargs)
+        except (exam_archive.ArchiveError, OSError, EOFError) as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported '{exam.name}' (id {exam.id}): {exam.total_items} items."
+        ))
@@ -0,0 +1,56 @@
+import csv
+import sys
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from core.models import Exam
+from core.services import imports, progress
+
+
+class Command(BaseCommand):
+    help = "Imports many playlists into an exam at once, from a CSV of 'subject name,playlist url' rows."
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('exam', help="Exam name")
+        parser.add_argument('file', help="CSV file with subject,url rows ('-' for stdin)")
+        parser.add_argument('--create-exam', action='store_true', help="Create the exam if it does not exist")
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.select_related('profile').get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError(f"User '{options['username']}' does not exist")
+        if not user.profile.google_api_key:
+            raise CommandError(f"User '{user.username}' has no YouTube API key")
+
+        exam = Exam.objects.filter(user=user, name=options['exam']).first()
+        if exam is None:
+            if not options['create_exam']:
+                raise CommandError(f"Exam '{options['exam']}' does not exist (use --create-exam)")
+            exam = Exam.objects.create(user=user, name=options['exam'])
+            progress.bump_progress_version(user)
+
+        if options['file'] == '-':
+            rows = list(csv.reader(sys.stdin))
+        else:
+            with open(options['file'], newline='', encoding='utf-8') as f:
+                rows = list(csv.reader(f))
+        pairs = [(row[0].strip(), row[1].strip()) for row in rows if len(row) >= 2 and row[0].strip()]
+        if not pairs:
+            raise CommandError("No 'subject,url' rows found")
+
+        report = imports.import_playlists(user, exam, pairs)
+
+        failed = 0
+        for entry in report:
+            if entry['status'] == 'ok':
+                self.stdout.write(
+                    f"{entry['subject']}: {entry['videos']} videos, "
+                    f"{entry['inserted']} new, {entry['updated']} updated"
+                    + (" (new subject)" if entry['created_subject'] else "")
+                )
+            else:
+                failed += 1
+                self.stdout.write(self.style.ERROR(f"{entry['subject']}: {entry['error']}"))
+
+        self.stdout.write(self.style.SUCCESS(f"Imported {len(report) - failed} of {len(report)} playlists."))
@@ -0,0 +1,47 @@
+import io
+import os
+import pstats
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from core.middleware import make_profile_token
+
+
+class Command(BaseCommand):
+    help = "Aggregates the ProfilingMiddleware .prof dumps into a hot-function report per view."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', help="Profile directory (default: settings.PROFILING_DIR)")
+        parser.add_argument('--view', help="Only report this view (URL name as used in the file names)")
+        parser.add_argument('--top', type=int, default=20, help="Functions listed per view")
+        parser.add_argument('--sort', choices=['cumulative', 'tottime', 'calls'], default='tottime')
+        parser.add_argument('--token', action='store_true',
+                            help="Print a signed token for the X-Profile header / ?profile= param and exit")
+
+    def handle(self, *args, **options):
+        if options['token']:
+            self.stdout.write(make_profile_token())
+            return
+
+        directory = options['dir'] or str(getattr(settings, 'PROFILING_DIR', settings.BASE_DIR / 'profiles'))
+        if not os.path.isdir(directory):
+            raise CommandError(f"No profile directory at {directory}")
+
+        # Dumps are named <view>.<timestamp>.<pid>.prof
+        by_view = {}
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.prof'):
+                by_view.setdefault(name.split('.', 1)[0], []).append(os.path.join(directory, name))
+
+        if options['view']:
+            by_view = {v: files for v, files in by_view.items() if v == options['view']}
+        if not by_view:
+            raise CommandError("No profile dumps found")
+
+        for view, files in sorted(by_view.items()):
+            report = io.StringIO()
+            stats = pstats.Stats(*files, stream=report)
+            stats.strip_dirs().sort_stats(options['sort']).print_stats(options['top'])
+            self.stdout.write(self.style.MIGRATE_HEADING(f"{view} ({len(files)} requests)"))
+            self.stdout.write(report.getvalue())
+
+        self.stdout.write(self.style.SUCCESS(f"Reported {len(by_view)} views"))
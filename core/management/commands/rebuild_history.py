@@ -0,0 +1,21 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from core.services.history import rebuild_history
+
+
+class Command(BaseCommand):
+    help = "Recomputes the day/week/month StudyRollup rows from DailyStudyLog, StudySession and DailyGoal."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, help="Only rebuild this user ID")
+
+    def handle(self, *args, **options):
+        users = User.objects.order_by('id')
+        if options['user']:
+            users = users.filter(id=options['user'])
+
+        total = 0
+        for user in users.iterator(chunk_size=500):
+            total += rebuild_history(user)
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {total} rollup rows."))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.services import note_search
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the full-text search index of all subject notes and common notes from their files."
+
+    def handle(self, *args, **options):
+        if not note_search.available():
+            raise CommandError("Note search needs the SQLite database")
+        count = note_search.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count} notes."))
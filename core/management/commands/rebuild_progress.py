@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.models import Exam
+from core.services.progress import rebuild_progress
+
+
+class Command(BaseCommand):
+    help = "Rebuilds (or with --verify, only checks) the denormalized Subject/Exam progress counters."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true', help="Report drift without writing anything")
+        parser.add_argument('--user', type=int, help="Only process exams of this user ID")
+
+    def handle(self, *args, **options):
+        exams = Exam.objects.all()
+        if options['user']:
+            exams = exams.filter(user_id=options['user'])
+
+        drifted = rebuild_progress(exams, commit=not options['verify'])
+
+        for obj, stored, expected in drifted:
+            diff = ", ".join(
+                f"{field} {stored[field]} -> {expected[field]}"
+                for field in expected if stored[field] != expected[field]
+            )
+            self.stdout.write(f"{obj.__class__.__name__} {obj.pk}: {diff}")
+
+        if options['verify']:
+            if drifted:
+                raise CommandError(f"{len(drifted)} rows have drifted counters.")
+            self.stdout.write(self.style.SUCCESS("All progress counters are consistent."))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Rebuilt progress counters ({len(drifted)} rows fixed)."))
@@ -0,0 +1,22 @@
+import datetime
+from django.core.management.base import BaseCommand, CommandError
+from core.services.streaks import rollover_streaks
+
+
+class Command(BaseCommand):
+    help = "Resets or extends every user's streak from their DailyGoal history. Safe to run repeatedly (e.g. nightly from cron)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help="Treat this day (YYYY-MM-DD) as today")
+        parser.add_argument('--chunk-size', type=int, default=1000, help="Users processed per batch")
+
+    def handle(self, *args, **options):
+        today = None
+        if options['date']:
+            try:
+                today = datetime.date.fromisoformat(options['date'])
+            except ValueError:
+                raise CommandError("--date must be in YYYY-MM-DD format")
+
+        updated = rollover_streaks(today=today, chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f"Updated streaks for {updated} users."))
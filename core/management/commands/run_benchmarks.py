@@ -0,0 +1,64 @@
+import platform
+from django.db import connection
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+from core.services.benchmark import seed_dataset, measure_views, write_results
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures latency percentiles and SQL query counts of the main views for several "
+        "dataset sizes. Each size is seeded into a throwaway test database; results go to JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='50,200,700', help="Comma separated videos-per-subject sizes")
+        parser.add_argument('--exams', type=int, default=3)
+        parser.add_argument('--subjects', type=int, default=5)
+        parser.add_argument('--days', type=int, default=90)
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--output', default='benchmark-results.json')
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',') if size.strip()]
+        except ValueError:
+            raise CommandError("--sizes must be a comma separated list of integers")
+
+        report = {
+            'started_at': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'iterations': options['iterations'],
+            'runs': [],
+        }
+
+        setup_test_environment()
+        try:
+            for size in sizes:
+                old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+                try:
+                    user = seed_dataset(
+                        exams=options['exams'], subjects=options['subjects'],
+                        videos=size, days=options['days'],
+                    )[0]
+                    views = measure_views(user, iterations=options['iterations'])
+                finally:
+                    connection.creation.destroy_test_db(old_name, verbosity=0)
+
+                report['runs'].append({
+                    'videos_per_subject': size,
+                    'total_videos': size * options['exams'] * options['subjects'],
+                    'views': views,
+                })
+                self.stdout.write(f"{size} videos/subject:")
+                for name, stats in views.items():
+                    self.stdout.write(
+                        f"  {name:<22} p50 {stats['p50_ms']:>8} ms  p90 {stats['p90_ms']:>8} ms  {stats['queries']:>4} queries"
+                    )
+        finally:
+            teardown_test_environment()
+
+        write_results(report, options['output'])
+        self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
@@ -0,0 +1,40 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from core.services import imports
+
+
+class Command(BaseCommand):
+    help = "Runs queued playlist imports. Start one or more of these next to the web server."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Exit when the queue is empty")
+        parser.add_argument('--poll-interval', type=float, default=2.0, help="Seconds to wait when the queue is empty")
+        parser.add_argument('--stale-after', type=int, default=30 * 60,
+                            help="Requeue running jobs whose worker has not reported in for this many seconds")
+
+    def handle(self, *args, **options):
+        worker = imports.worker_name()
+        processed = 0
+        self.stdout.write(f"Import worker {worker} started.")
+
+        try:
+            while True:
+                close_old_connections()
+                job = imports.claim_next(worker)
+                if job is None:
+                    if options['once']:
+                        break
+                    imports.requeue_stale(options['stale_after'])
+                    time.sleep(options['poll_interval'])
+                    continue
+
+                imports.run_job(job)
+                processed += 1
+                self.stdout.write(
+                    f"Job {job.id}: {job.status}, {job.videos_inserted} videos from {job.pages_fetched} pages"
+                )
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(self.style.SUCCESS(f"Processed {processed} import jobs."))
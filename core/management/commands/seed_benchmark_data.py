@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from core.services.benchmark import seed_dataset
+
+
+class Command(BaseCommand):
+    help = "Generates synthetic users, exams, subjects, videos, chunks and study history for benchmarking."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1)
+        parser.add_argument('--exams', type=int, default=3, help="Exams per user")
+        parser.add_argument('--subjects', type=int, default=5, help="Subjects per exam")
+        parser.add_argument('--videos', type=int, default=700, help="Videos per subject")
+        parser.add_argument('--chunked-ratio', type=float, default=0.1, help="Share of videos that are chunked")
+        parser.add_argument('--days', type=int, default=90, help="Days of study logs, goals and sessions")
+        parser.add_argument('--prefix', default='bench', help="Username prefix of the generated users")
+        parser.add_argument('--password', default='bench-password')
+        parser.add_argument('--seed', type=int, default=0, help="Random seed, for reproducible datasets")
+
+    def handle(self, *args, **options):
+        users = seed_dataset(
+            users=options['users'],
+            exams=options['exams'],
+            subjects=options['subjects'],
+            videos=options['videos'],
+            chunked_ratio=options['chunked_ratio'],
+            days=options['days'],
+            prefix=options['prefix'],
+            password=options['password'],
+            seed=options['seed'],
+        )
+        total = options['exams'] * options['subjects'] * options['videos']
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {len(users)} users with {total} videos each: "
+            + ", ".join(user.username for user in users)
+        ))
@@ -1,6 +1,20 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import re
+import time
+from collections import Counter
 from django.shortcuts import redirect
 from django.urls import reverse
 from django.conf import settings
+from django.core import signing
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+query_logger = logging.getLogger('core.queries')
 
 class EnsureAPIKeyMiddleware:
     """
@@ -46,3 +60,140 @@ class EnsureAPIKeyMiddleware:
             return redirect('setup_api_key')
 
         return self.get_response(request)
+
+
+class QueryRecorder:
+    """connection.execute_wrapper hook that counts, times and fingerprints queries."""
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            self.count += 1
+            # Parameters are kept out of the SQL, so the statement itself is the fingerprint
+            self.fingerprints[sql] += 1
+
+    def duplicates(self):
+        return {sql: n for sql, n in self.fingerprints.items() if n > 1}
+
+
+class QueryBudgetMiddleware:
+    """
+    Records query count, total DB time and duplicated queries (likely N+1s) per request.
+    Exposes them in a Server-Timing header and logs them to the 'core.queries' logger.
+    Enabled by settings.QUERY_INSTRUMENTATION (defaults to DEBUG).
+    """
+    def __init__(self, get_response):
+        if not getattr(settings, 'QUERY_INSTRUMENTATION', settings.DEBUG):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.duplicate_threshold = getattr(settings, 'QUERY_DUPLICATE_THRESHOLD', 3)
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        started = time.perf_counter()
+        with connection.execute_wrapper(recorder):
+            response = self.get_response(request)
+        total_ms = (time.perf_counter() - started) * 1000
+        db_ms = recorder.duration * 1000
+
+        duplicates = recorder.duplicates()
+        response['Server-Timing'] = (
+            f'db;dur={db_ms:.1f};desc="{recorder.count} queries", '
+            f'dup;desc="{sum(duplicates.values())} duplicated", '
+            f'total;dur={total_ms:.1f}'
+        )
+
+        query_logger.debug(
+            "%s %s: %d queries, %.1f ms DB, %.1f ms total",
+            request.method, request.path, recorder.count, db_ms, total_ms
+        )
+        for sql, n in duplicates.items():
+            if n >= self.duplicate_threshold:
+                query_logger.warning("%s %s ran %d times: %s", request.method, request.path, n, sql)
+
+        return response
+
+
+PROFILE_SALT = 'core.profiler'
+
+
+def make_profile_token():
+    """Signed value accepted in the X-Profile header or ?profile= query param."""
+    return signing.dumps('profile', salt=PROFILE_SALT)
+
+
+class ProfilingMiddleware:
+    """
+    Opt-in cProfile of whole requests. A request is profiled when it carries a valid
+    signed token (X-Profile header or ?profile=, see `manage.py profile_report --token`)
+    or is picked by PROFILING_SAMPLE_RATE. Each profile is written to PROFILING_DIR
+    as a .prof file plus a .txt top-N summary; only the newest PROFILING_MAX_FILES are kept.
+    """
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILING_ENABLED', False):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 0)
+        self.token_age = getattr(settings, 'PROFILING_TOKEN_MAX_AGE', 60 * 60 * 24)
+        self.directory = str(getattr(settings, 'PROFILING_DIR', settings.BASE_DIR / 'profiles'))
+        self.max_files = getattr(settings, 'PROFILING_MAX_FILES', 200)
+        self.top_n = getattr(settings, 'PROFILING_TOP_N', 30)
+
+    def should_profile(self, request):
+        token = request.headers.get('X-Profile') or request.GET.get('profile')
+        if token:
+            try:
+                return signing.loads(token, salt=PROFILE_SALT, max_age=self.token_age) == 'profile'
+            except signing.BadSignature:
+                return False
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def __call__(self, request):
+        if not self.should_profile(request):
+            return self.get_response(request)
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already active in this process
+            return self.get_response(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.disable()
+
+        match = getattr(request, 'resolver_match', None)
+        view_name = match.view_name if match else 'unresolved'
+        self.dump(profiler, view_name)
+        return response
+
+    def dump(self, profiler, view_name):
+        os.makedirs(self.directory, exist_ok=True)
+        safe_name = re.sub(r'[^A-Za-z0-9_-]', '_', view_name)
+        base = os.path.join(self.directory, f"{safe_name}.{time.time_ns()}.{os.getpid()}")
+        profiler.dump_stats(base + '.prof')
+
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(self.top_n)
+        with open(base + '.txt', 'w', encoding='utf-8') as f:
+            f.write(summary.getvalue())
+
+        self.rotate()
+
+    def rotate(self):
+        dumps = sorted(
+            (entry for entry in os.scandir(self.directory) if entry.name.endswith('.prof')),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        for entry in dumps[:max(0, len(dumps) - self.max_files)]:
+            for path in (entry.path, entry.path[:-len('.prof')] + '.txt'):
+                if os.path.exists(path):
+                    os.remove(path)
@@ -0,0 +1,100 @@
+# Generated by Django 6.0 on 2026-10-18 19:23
+
+from django.db import migrations, models
+
+FIELDS = ('total_items', 'watched_items', 'total_seconds', 'watched_seconds')
+
+
+def backfill_progress(apps, schema_editor):
+    Exam = apps.get_model('core', 'Exam')
+    Subject = apps.get_model('core', 'Subject')
+    Video = apps.get_model('core', 'Video')
+    VideoChunk = apps.get_model('core', 'VideoChunk')
+
+    stats = {}
+    video_rows = Video.objects.filter(is_chunked=False).values('subject_id').annotate(
+        total_items=models.Count('id'),
+        watched_items=models.Count('id', filter=models.Q(is_watched=True)),
+        total_seconds=models.Sum('duration_seconds'),
+        watched_seconds=models.Sum('duration_seconds', filter=models.Q(is_watched=True)),
+    )
+    duration = models.F('end_seconds') - models.F('start_seconds')
+    chunk_rows = VideoChunk.objects.filter(video__is_chunked=True).values(
+        subject_id=models.F('video__subject_id')
+    ).annotate(
+        total_items=models.Count('id'),
+        watched_items=models.Count('id', filter=models.Q(is_watched=True)),
+        total_seconds=models.Sum(duration),
+        watched_seconds=models.Sum(duration, filter=models.Q(is_watched=True)),
+    )
+    for rows in (video_rows, chunk_rows):
+        for row in rows:
+            entry = stats.setdefault(row['subject_id'], dict.fromkeys(FIELDS, 0))
+            for field in FIELDS:
+                entry[field] += row[field] or 0
+
+    exam_stats = {}
+    subjects = list(Subject.objects.filter(id__in=stats.keys()))
+    for subject in subjects:
+        exam_entry = exam_stats.setdefault(subject.exam_id, dict.fromkeys(FIELDS, 0))
+        for field in FIELDS:
+            setattr(subject, field, stats[subject.id][field])
+            exam_entry[field] += stats[subject.id][field]
+    Subject.objects.bulk_update(subjects, FIELDS, batch_size=500)
+
+    exams = list(Exam.objects.filter(id__in=exam_stats.keys()))
+    for exam in exams:
+        for field in FIELDS:
+            setattr(exam, field, exam_stats[exam.id][field])
+    Exam.objects.bulk_update(exams, FIELDS, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_remove_note_content_screenshots'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exam',
+            name='total_items',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='exam',
+            name='total_seconds',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='exam',
+            name='watched_items',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='exam',
+            name='watched_seconds',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='subject',
+            name='total_items',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='subject',
+            name='total_seconds',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='subject',
+            name='watched_items',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='subject',
+            name='watched_seconds',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_progress, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-18 19:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_exam_subject_progress_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='progress_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
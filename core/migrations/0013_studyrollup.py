@@ -0,0 +1,35 @@
+# Generated by Django 6.0 on 2026-10-18 19:26
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_userprofile_progress_version'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StudyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('day', 'Day'), ('week', 'Week'), ('month', 'Month')], max_length=5)),
+                ('period_start', models.DateField()),
+                ('seconds_watched', models.PositiveIntegerField(default=0)),
+                ('focus_seconds', models.PositiveIntegerField(default=0)),
+                ('goal_seconds', models.PositiveIntegerField(default=0)),
+                ('completed_seconds', models.PositiveIntegerField(default=0)),
+                ('goals_achieved', models.PositiveIntegerField(default=0)),
+                ('subject', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='study_rollups', to='core.subject')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='study_rollups', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'granularity', 'period_start'], name='core_studyr_user_id_6f212a_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('subject__isnull', False)), fields=('user', 'subject', 'granularity', 'period_start'), name='unique_subject_rollup'), models.UniqueConstraint(condition=models.Q(('subject__isnull', True)), fields=('user', 'granularity', 'period_start'), name='unique_user_rollup')],
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 6.0 on 2026-10-18 19:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_studyrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='YouTubePlaylistCache',
+            fields=[
+                ('playlist_id', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('etag', models.CharField(blank=True, max_length=100)),
+                ('video_ids', models.JSONField(default=list)),
+                ('fetched_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='YouTubeVideoCache',
+            fields=[
+                ('video_id', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('title', models.CharField(max_length=255)),
+                ('duration_seconds', models.PositiveIntegerField(default=0)),
+                ('fetched_at', models.DateTimeField()),
+            ],
+        ),
+    ]
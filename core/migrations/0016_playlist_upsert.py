@@ -0,0 +1,27 @@
+# Generated by Django 6.0 on 2026-10-18 19:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_importjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='videos_updated',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='subject',
+            name='playlist_url',
+            field=models.URLField(blank=True, max_length=500),
+        ),
+        migrations.AddIndex(
+            model_name='video',
+            index=models.Index(fields=['subject', 'video_id'], name='core_video_subject_a34746_idx'),
+        ),
+    ]
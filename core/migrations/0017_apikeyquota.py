@@ -0,0 +1,25 @@
+# Generated by Django 6.0 on 2026-10-18 19:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_playlist_upsert'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ApiKeyQuota',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key_hash', models.CharField(max_length=64)),
+                ('day', models.DateField()),
+                ('units_used', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('key_hash', 'day'), name='unique_key_quota_day')],
+            },
+        ),
+    ]
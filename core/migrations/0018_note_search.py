@@ -0,0 +1,46 @@
+# Generated by Django 6.0 on 2026-10-18 20:05
+
+from django.db import migrations
+
+# Full-text index of note text (see core.services.note_search). SQLite only:
+# other databases run without search.
+CREATE_SQL = [
+    "CREATE VIRTUAL TABLE core_notesearch USING fts5("
+    "owner, title, body, tokenize = 'unicode61 remove_diacritics 2', prefix = '3')",
+    # ORDER BY rank: titles weigh five times the body, the owner tag nothing
+    "INSERT INTO core_notesearch (core_notesearch, rank) VALUES ('rank', 'bm25(0.0, 5.0, 1.0)')",
+    "CREATE TABLE core_notesearch_pending (doc_id INTEGER PRIMARY KEY, owner_id INTEGER NOT NULL)",
+    "CREATE INDEX core_notesearch_pending_owner ON core_notesearch_pending (owner_id)",
+    # Existing notes are indexed by the first search of their owner
+    "INSERT INTO core_notesearch_pending (doc_id, owner_id) "
+    "SELECT n.id * 2, e.user_id FROM core_note n "
+    "JOIN core_subject s ON s.id = n.subject_id JOIN core_exam e ON e.id = s.exam_id",
+    "INSERT INTO core_notesearch_pending (doc_id, owner_id) SELECT id * 2 + 1, user_id FROM core_commonnote",
+]
+DROP_SQL = [
+    "DROP TABLE IF EXISTS core_notesearch_pending",
+    "DROP TABLE IF EXISTS core_notesearch",
+]
+
+
+def create_search_tables(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        for sql in CREATE_SQL:
+            schema_editor.execute(sql)
+
+
+def drop_search_tables(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        for sql in DROP_SQL:
+            schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_apikeyquota'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_tables, drop_search_tables),
+    ]
@@ -2,12 +2,15 @@ from django.db import models
 from django.contrib.auth.models import User
 import os
 from django.conf import settings
+from core.services import note_store
 
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     google_api_key = models.CharField(max_length=255, blank=True, null=True, help_text="Your YouTube Data API Key")
     current_streak = models.PositiveIntegerField(default=0)
     last_goal_date = models.DateField(null=True, blank=True)
+    # Bumped on every change that affects analytics; used as a cache key / ETag
+    progress_version = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return f"{self.user.username}'s Profile"
@@ -18,6 +21,12 @@ class Exam(models.Model):
     description = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # Denormalized progress rollups (maintained by core.services.progress)
+    total_items = models.PositiveIntegerField(default=0)
+    watched_items = models.PositiveIntegerField(default=0)
+    total_seconds = models.PositiveIntegerField(default=0)
+    watched_seconds = models.PositiveIntegerField(default=0)
+
     def __str__(self):
         return self.name
 
@@ -25,6 +34,13 @@ class Subject(models.Model):
     name = models.CharField(max_length=100)
     exam = models.ForeignKey(Exam, on_delete=models.CASCADE, related_name='subjects')
     daily_goal_minutes = models.PositiveIntegerField(default=0, help_text="Daily study goal in minutes")
+    playlist_url = models.URLField(max_length=500, blank=True) # Last imported playlist, used by resync
+
+    # Denormalized progress rollups (maintained by core.services.progress)
+    total_items = models.PositiveIntegerField(default=0)
+    watched_items = models.PositiveIntegerField(default=0)
+    total_seconds = models.PositiveIntegerField(default=0)
+    watched_seconds = models.PositiveIntegerField(default=0)
     
     def __str__(self):
         return self.name
@@ -43,6 +59,9 @@ class Video(models.Model):
 
     class Meta:
         ordering = ['order']
+        indexes = [
+            models.Index(fields=['subject', 'video_id']), # Playlist import dedupe
+        ]
 
     @property
     def duration_display(self):
@@ -82,17 +101,24 @@ class Note(models.Model):
         return os.path.join(settings.MEDIA_ROOT, 'notes', 'subjects', str(self.subject.id), 'note.html')
 
     def save_content_to_file(self, content):
-        file_path = self.get_file_path()
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.write(content)
+        # Full save; returns the new version (see core.services.note_store)
+        return note_store.write_full(self.get_file_path(), note_store.split_blocks(content), self.file_written)
+
+    def save_blocks_to_file(self, blocks):
+        return note_store.write_full(self.get_file_path(), blocks, self.file_written)
+
+    def apply_delta_to_file(self, base_version, ops):
+        return note_store.append_delta(self.get_file_path(), base_version, ops, self.file_written)
+
+    def file_written(self, content):
+        # Once per (possibly coalesced) write: bump the timestamp, reindex for search
+        from core.services import note_search
+        type(self).objects.filter(pk=self.pk).update(updated_at=timezone.now())
+        note_search.index_note(self, content)
             
     def get_content_from_file(self):
-        file_path = self.get_file_path()
-        if os.path.exists(file_path):
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return f.read()
-        return self.content # Fallback to DB
+        content = note_store.read(self.get_file_path())
+        return self.content if content is None else content # Fallback to DB
 
 from django.utils import timezone
 
@@ -123,17 +149,24 @@ class CommonNote(models.Model):
         return os.path.join(settings.MEDIA_ROOT, 'notes', 'users', str(self.user.id), 'common_note.html')
 
     def save_content_to_file(self, content):
-        file_path = self.get_file_path()
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.write(content)
+        # Full save; returns the new version (see core.services.note_store)
+        return note_store.write_full(self.get_file_path(), note_store.split_blocks(content), self.file_written)
+
+    def save_blocks_to_file(self, blocks):
+        return note_store.write_full(self.get_file_path(), blocks, self.file_written)
+
+    def apply_delta_to_file(self, base_version, ops):
+        return note_store.append_delta(self.get_file_path(), base_version, ops, self.file_written)
+
+    def file_written(self, content):
+        # Once per (possibly coalesced) write: bump the timestamp, reindex for search
+        from core.services import note_search
+        type(self).objects.filter(pk=self.pk).update(updated_at=timezone.now())
+        note_search.index_note(self, content)
             
     def get_content_from_file(self):
-        file_path = self.get_file_path()
-        if os.path.exists(file_path):
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return f.read()
-        return self.content # Fallback to DB
+        content = note_store.read(self.get_file_path())
+        return self.content if content is None else content # Fallback to DB
 
 class StudySession(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='study_sessions')
@@ -168,6 +201,124 @@ class Streak(models.Model):
     def __str__(self):
         return f"Streak - {self.user.username} - {self.current_streak}"
 
+class StudyRollup(models.Model):
+    """
+    Precomputed study history per day/week/month (maintained by core.services.history).
+    Rows with a subject hold video watch time; the per-user row (subject=None)
+    holds focus timer and daily goal totals.
+    """
+    GRANULARITY_CHOICES = [('day', 'Day'), ('week', 'Week'), ('month', 'Month')]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='study_rollups')
+    subject = models.ForeignKey(Subject, on_delete=models.CASCADE, null=True, blank=True, related_name='study_rollups')
+    granularity = models.CharField(max_length=5, choices=GRANULARITY_CHOICES)
+    period_start = models.DateField()
+    seconds_watched = models.PositiveIntegerField(default=0)
+    focus_seconds = models.PositiveIntegerField(default=0)
+    goal_seconds = models.PositiveIntegerField(default=0)
+    completed_seconds = models.PositiveIntegerField(default=0)
+    goals_achieved = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'granularity', 'period_start']),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'subject', 'granularity', 'period_start'],
+                condition=models.Q(subject__isnull=False),
+                name='unique_subject_rollup',
+            ),
+            models.UniqueConstraint(
+                fields=['user', 'granularity', 'period_start'],
+                condition=models.Q(subject__isnull=True),
+                name='unique_user_rollup',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} - {self.granularity} - {self.period_start}"
+
+class YouTubeVideoCache(models.Model):
+    """
+    Metadata of a YouTube video shared by every user (see core.services.youtube_cache).
+    Rows older than YOUTUBE_VIDEO_CACHE_TTL are refetched.
+    """
+    video_id = models.CharField(max_length=50, primary_key=True)
+    title = models.CharField(max_length=255)
+    duration_seconds = models.PositiveIntegerField(default=0)
+    fetched_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.video_id} - {self.title}"
+
+class YouTubePlaylistCache(models.Model):
+    """
+    Ordered video ids of a playlist plus the etag of its first playlistItems page,
+    so a stale entry can be revalidated with a conditional request.
+    """
+    playlist_id = models.CharField(max_length=100, primary_key=True)
+    etag = models.CharField(max_length=100, blank=True)
+    video_ids = models.JSONField(default=list)
+    fetched_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.playlist_id} ({len(self.video_ids)} videos)"
+
+class ApiKeyQuota(models.Model):
+    """
+    Estimated YouTube Data API units spent per key and quota day (Pacific time,
+    when Google resets quotas). Keys are stored as SHA-256 hashes.
+    Maintained by core.services.quota.
+    """
+    key_hash = models.CharField(max_length=64)
+    day = models.DateField()
+    units_used = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['key_hash', 'day'], name='unique_key_quota_day'),
+        ]
+
+    def __str__(self):
+        return f"{self.key_hash[:8]} - {self.day} - {self.units_used}"
+
+class ImportJob(models.Model):
+    """
+    A queued playlist import, run by `manage.py run_import_worker`
+    (see core.services.imports). Progress fields are updated while it runs.
+    """
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='import_jobs')
+    subject = models.ForeignKey(Subject, on_delete=models.CASCADE, related_name='import_jobs')
+    playlist_url = models.URLField(max_length=500)
+    force = models.BooleanField(default=False) # Resync: revalidate the cached playlist even while it is fresh
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    worker = models.CharField(max_length=100, blank=True)
+    pages_fetched = models.PositiveIntegerField(default=0)
+    videos_found = models.PositiveIntegerField(default=0)
+    videos_inserted = models.PositiveIntegerField(default=0)
+    videos_updated = models.PositiveIntegerField(default=0)
+    errors = models.JSONField(default=list)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True) # Last sign of life from the running worker
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"Import {self.id} - {self.subject.name} - {self.status}"
+
 # --- SIGNALS ---
 from django.db.models.signals import post_save
 from django.dispatch import receiver
@@ -179,6 +330,7 @@ def create_user_profile(sender, instance, created, **kwargs):
 
 @receiver(post_save, sender=User)
 def save_user_profile(sender, instance, **kwargs):
-    instance.profile.save()
+    from core.services import progress
+    progress.save_profile(instance.profile)
 
 
@@ -0,0 +1,74 @@
+from django.core.cache import cache
+from core.models import Subject, UserProfile
+
+# Keys are versioned, so entries never go stale; the timeout only bounds memory
+ANALYTICS_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def build_exam_analytics(user):
+    """
+    Per-exam breakdown used by the analytics pages and the JSON endpoint.
+    Returns a list of {'goal_name', 'total_seconds', 'total_hours', 'subjects'}
+    where each subject is {'name', 'seconds', 'hours', 'percentage'}, sorted by
+    contribution. Subjects with no watched time are left out.
+    Reads the denormalized counters kept by core.services.progress.
+    """
+    subjects = Subject.objects.filter(exam__user=user).values(
+        'id', 'name', 'exam_id', 'watched_seconds'
+    ).order_by('exam_id', 'id')
+
+    # Keep exams without subjects so they still show up with 0 hours
+    exams = {}
+    for exam in user.exams.order_by('id').values('id', 'name'):
+        exams[exam['id']] = {
+            'goal_name': exam['name'],
+            'total_seconds': 0,
+            'subjects': [],
+        }
+
+    for subject in subjects:
+        exam = exams.get(subject['exam_id'])
+        if exam is None:
+            continue
+        seconds = subject['watched_seconds']
+        exam['total_seconds'] += seconds
+        if seconds > 0:
+            exam['subjects'].append({
+                'name': subject['name'],
+                'seconds': seconds,
+                'hours': round(seconds / 3600, 1)
+            })
+
+    analytics_data = []
+    for exam in exams.values():
+        exam_total = exam['total_seconds']
+        for sub in exam['subjects']:
+            sub['percentage'] = round((sub['seconds'] / exam_total) * 100, 1) if exam_total > 0 else 0
+        exam['subjects'].sort(key=lambda x: x['seconds'], reverse=True)
+        exam['total_hours'] = round(exam_total / 3600, 1)
+        analytics_data.append(exam)
+
+    return analytics_data
+
+
+def get_progress_version(user):
+    return UserProfile.objects.filter(user=user).values_list('progress_version', flat=True).first() or 0
+
+
+def analytics_etag(request):
+    """Strong ETag for get_analytics_data; changes whenever the progress version is bumped."""
+    return f'"analytics-{request.user.pk}-{get_progress_version(request.user)}"'
+
+
+def get_exam_analytics(user):
+    """
+    Cached version of build_exam_analytics. The cache key embeds the user's
+    progress_version, so any watched-state mutation makes it miss.
+    """
+    key = f"analytics:{user.pk}:{get_progress_version(user)}"
+    data = cache.get(key)
+    if data is None:
+        data = build_exam_analytics(user)
+        cache.set(key, data, ANALYTICS_CACHE_TIMEOUT)
+    return data
+
@@ -0,0 +1,189 @@
+import datetime
+import json
+import random
+import time
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from core.models import (
+    UserProfile, Exam, Subject, Video, VideoChunk, Note,
+    DailyStudyLog, DailyGoal, StudySession, Streak,
+)
+from core.services.progress import rebuild_progress
+from core.services.history import rebuild_history
+
+BATCH_SIZE = 1000
+CHUNK_INTERVAL = 20 * 60
+
+
+def seed_dataset(users=1, exams=3, subjects=5, videos=700, chunked_ratio=0.1, days=90,
+                 prefix='bench', password='bench-password', seed=0):
+    """
+    Creates synthetic users with `exams` exams, `subjects` subjects per exam and
+    `videos` videos per subject (a share of them chunked), plus `days` days of
+    study logs, goals and sessions. Everything is written with bulk_create, then
+    the progress counters and history rollups are rebuilt.
+    Returns the created users.
+    """
+    rng = random.Random(seed)
+    today = timezone.localdate()
+    hashed = make_password(password)
+
+    with transaction.atomic():
+        start = User.objects.filter(username__startswith=prefix).count()
+        new_users = User.objects.bulk_create([
+            User(username=f"{prefix}{start + i}", password=hashed) for i in range(users)
+        ])
+        # bulk_create skips the post_save signal that normally creates these
+        UserProfile.objects.bulk_create([
+            UserProfile(user=user, google_api_key=f"{prefix}-key") for user in new_users
+        ])
+        Streak.objects.bulk_create([Streak(user=user) for user in new_users])
+
+        new_exams = Exam.objects.bulk_create([
+            Exam(user=user, name=f"Exam {e + 1}") for user in new_users for e in range(exams)
+        ], batch_size=BATCH_SIZE)
+        new_subjects = Subject.objects.bulk_create([
+            Subject(exam=exam, name=f"Subject {s + 1}", daily_goal_minutes=60)
+            for exam in new_exams for s in range(subjects)
+        ], batch_size=BATCH_SIZE)
+        Note.objects.bulk_create([Note(subject=subject) for subject in new_subjects], batch_size=BATCH_SIZE)
+
+        video_rows = []
+        for subject in new_subjects:
+            for v in range(videos):
+                duration = rng.randint(5 * 60, 90 * 60)
+                is_chunked = rng.random() < chunked_ratio
+                video_rows.append(Video(
+                    subject=subject,
+                    title=f"Lecture {v + 1}",
+                    video_id=f"{prefix}{subject.id}x{v}",
+                    url=f"https://www.youtube.com/watch?v={prefix}{subject.id}x{v}",
+                    order=v,
+                    duration_seconds=duration,
+                    is_watched=not is_chunked and rng.random() < 0.4,
+                    is_chunked=is_chunked,
+                ))
+        new_videos = Video.objects.bulk_create(video_rows, batch_size=BATCH_SIZE)
+
+        chunk_rows = []
+        for video in new_videos:
+            if not video.is_chunked:
+                continue
+            for part, begin in enumerate(range(0, video.duration_seconds, CHUNK_INTERVAL), start=1):
+                chunk_rows.append(VideoChunk(
+                    video=video,
+                    part_number=part,
+                    title=f"Part {part}",
+                    start_seconds=begin,
+                    end_seconds=min(begin + CHUNK_INTERVAL, video.duration_seconds),
+                    is_watched=rng.random() < 0.4,
+                ))
+        VideoChunk.objects.bulk_create(chunk_rows, batch_size=BATCH_SIZE)
+
+        logs, goals, sessions = [], [], []
+        for user in new_users:
+            user_subjects = [s for s in new_subjects if s.exam.user_id == user.id]
+            for d in range(1, days + 1):
+                day = today - datetime.timedelta(days=d)
+                studied = 0
+                for subject in rng.sample(user_subjects, k=min(3, len(user_subjects))):
+                    seconds = rng.randint(10 * 60, 2 * 3600)
+                    studied += seconds
+                    logs.append(DailyStudyLog(user=user, subject=subject, date=day, seconds_watched=seconds))
+                goal_hours = rng.choice([2, 3, 4])
+                goals.append(DailyGoal(
+                    user=user, date=day, goal_hours=goal_hours, completed_seconds=studied,
+                    is_completed=studied >= goal_hours * 3600, achieved=studied >= goal_hours * 3600,
+                ))
+                begin = timezone.now() - datetime.timedelta(days=d)
+                sessions.append(StudySession(
+                    user=user, date=day, start_time=begin,
+                    end_time=begin + datetime.timedelta(seconds=studied), total_seconds=studied,
+                ))
+        DailyStudyLog.objects.bulk_create(logs, batch_size=BATCH_SIZE)
+        DailyGoal.objects.bulk_create(goals, batch_size=BATCH_SIZE)
+        StudySession.objects.bulk_create(sessions, batch_size=BATCH_SIZE)
+
+    rebuild_progress(Exam.objects.filter(user__in=new_users))
+    for user in new_users:
+        rebuild_history(user)
+
+    return new_users
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def fake_playlist(count=50):
+    return [
+        {'title': f"Imported {i}", 'video_id': f"imp{i}", 'url': f"https://www.youtube.com/watch?v=imp{i}", 'duration': 600}
+        for i in range(count)
+    ]
+
+
+def benchmark_cases(user):
+    """(name, method, url, kwargs) for every view we track; URLs point at the user's first subject/video."""
+    subject = Subject.objects.filter(exam__user=user).order_by('id').first()
+    video = Video.objects.filter(subject=subject, is_chunked=False).order_by('id').first()
+    return [
+        ('dashboard', 'get', reverse('dashboard'), {}),
+        ('subject_detail', 'get', reverse('subject_detail', args=[subject.id]), {}),
+        ('analytics_dashboard', 'get', reverse('analytics_dashboard'), {}),
+        ('analytics_subject', 'get', reverse('analytics_subject'), {}),
+        ('get_analytics_data', 'get', reverse('get_analytics_data'), {}),
+        ('get_history', 'get', reverse('get_history'), {}),
+        ('update_video_status', 'post', reverse('update_video_status', args=[video.id]),
+         {'data': '{"is_watched": true}', 'content_type': 'application/json'}),
+        ('add_playlist', 'post', reverse('add_playlist', args=[subject.id]),
+         {'data': {'playlist_url': 'https://www.youtube.com/playlist?list=bench'}}),
+    ]
+
+
+def measure_views(user, iterations=20, warmup=2):
+    """
+    Runs every benchmark case `iterations` times as `user` and returns
+    {view: {'p50_ms', 'p90_ms', 'p99_ms', 'mean_ms', 'queries', 'status'}}.
+    add_playlist only enqueues an import job, so no YouTube call is made.
+    """
+    client = Client()
+    client.force_login(user)
+    results = {}
+
+    for name, method, url, kwargs in benchmark_cases(user):
+        call = getattr(client, method)
+        for _ in range(warmup):
+            call(url, **kwargs)
+
+        timings = []
+        queries = 0
+        status = None
+        for _ in range(iterations):
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = call(url, **kwargs)
+                timings.append((time.perf_counter() - started) * 1000)
+            queries = max(queries, len(captured.captured_queries))
+            status = response.status_code
+
+        results[name] = {
+            'p50_ms': round(_percentile(timings, 50), 2),
+            'p90_ms': round(_percentile(timings, 90), 2),
+            'p99_ms': round(_percentile(timings, 99), 2),
+            'mean_ms': round(sum(timings) / len(timings), 2),
+            'queries': queries,
+            'status': status,
+        }
+    return results
+
+
+def write_results(results, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
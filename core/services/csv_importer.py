@@ -1,7 +1,17 @@
+import codecs
 import csv
-import io
-from django.db import models
-from core.models import Video, Subject
+import re
+import uuid
+from django.db import models, transaction
+from core.models import Video
+from core.services import progress
+
+BATCH_SIZE = 1000
+READ_CHUNK_SIZE = 64 * 1024
+MAX_REPORTED_ERRORS = 100
+DEDUPE_FIELDS = ('title', 'video_id')
+# A line with its ending: \r\n, \n or a bare \r (old Mac exports), the ones csv.reader knows
+LINE_RE = re.compile(r'[^\r\n]*(?:\r\n|\r|\n)')
 
 def parse_duration(duration_str):
     """
@@ -18,73 +28,162 @@ def parse_duration(duration_str):
         pass
     return 0
 
-def import_videos_from_csv(file, subject):
+def _chunks(file):
+    """Yields the upload as bytes/str pieces without reading it whole."""
+    if isinstance(file, (str, bytes)):
+        yield file
+    elif hasattr(file, 'chunks'): # Django UploadedFile
+        yield from file.chunks(READ_CHUNK_SIZE)
+    else:
+        while True:
+            chunk = file.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+def iter_lines(file):
+    """
+    Decodes the upload incrementally (UTF-8, BOM tolerated) and yields it line
+    by line, so csv.reader never needs more than one row in memory.
+    Lines end in \r\n, \n or \r; a \r at the end of a chunk is held back
+    until the next one shows whether a \n follows.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    pending = ''
+    for chunk in _chunks(file):
+        pending += decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+        end = 0
+        for match in LINE_RE.finditer(pending):
+            if match.end() == len(pending) and pending.endswith('\r'):
+                break
+            yield match.group()
+            end = match.end()
+        pending = pending[end:]
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+def import_videos_from_csv(file, subject, dedupe=None):
     """
-    Parses a CSV file and creates Video objects for the given subject.
+    Streams a CSV file into Video objects for the given subject.
     Expects CSV with columns: title, duration
     Optional: description, youtube_link, video_id
+
+    Rows are written with bulk_create in batches of BATCH_SIZE inside one
+    transaction; invalid rows are reported (first MAX_REPORTED_ERRORS) and skipped.
+    With dedupe='title' or 'video_id', rows whose value already exists in the
+    subject (or earlier in the file) are skipped.
     """
-    # Ensure file is in text mode
+    if dedupe and dedupe not in DEDUPE_FIELDS:
+        return {'success': False, 'message': f'Cannot dedupe on {dedupe}'}
+
+    reader = csv.reader(iter_lines(file))
     try:
-        decoded_file = file.read().decode('utf-8')
-    except AttributeError:
-         # Already string (e.g. from tests) or raw bytes needs decoding
-         decoded_file = file if isinstance(file, str) else file.decode('utf-8')
-    
-    io_string = io.StringIO(decoded_file)
-    reader = csv.DictReader(io_string)
-    
+        header = next(reader, None)
+    except csv.Error as e:
+        return {'success': False, 'message': f'Could not read the header row: {e}'}
+
     # Normalize headers
-    reader.fieldnames = [name.lower().strip() for name in reader.fieldnames]
-    
-    if 'title' not in reader.fieldnames:
+    fieldnames = [name.lower().strip() for name in header or []]
+    if 'title' not in fieldnames:
         return {'success': False, 'message': 'Missing required column: title'}
-        
+
+    seen = set()
+    if dedupe:
+        seen.update(subject.videos.values_list(dedupe, flat=True).iterator(chunk_size=5000))
+
     created_count = 0
+    skipped_count = 0
+    error_count = 0
     errors = []
-    
-    # Get current max order to append new videos
-    current_max_order = subject.videos.aggregate(models.Max('order'))['order__max'] or 0
-    next_order = current_max_order + 1
-
-    for row_idx, row in enumerate(reader, start=1):
-        title = row.get('title', '').strip()
-        if not title:
-            continue
-            
-        duration_str = row.get('duration', '00:00')
-        duration_seconds = parse_duration(duration_str)
-        
-        # basic duplicate check via title?
-        # For now, we allow duplicates as they might be different parts, 
-        # or we could skip. Let's create for now.
-        
-        video_id = row.get('video_id', '')
-        if not video_id:
-             # Generate a dummy ID if not provided, as it's required by model
-             import uuid
-             video_id = f"csv-{uuid.uuid4().hex[:8]}"
-
-        url = row.get('youtube_link', '')
-        if not url:
-            url = f"https://www.youtube.com/watch?v={video_id}"
-
-        try:
-            Video.objects.create(
+    totals = progress.empty_stats()
+    batch = []
+
+    def error(row_idx, message):
+        nonlocal error_count
+        error_count += 1
+        if len(errors) < MAX_REPORTED_ERRORS:
+            errors.append(f"Row {row_idx}: {message}")
+
+    with transaction.atomic():
+        # Get current max order to append new videos
+        current_max_order = subject.videos.aggregate(models.Max('order'))['order__max'] or 0
+        next_order = current_max_order + 1
+
+        row_idx = 0
+        while True:
+            row_idx += 1
+            try:
+                values = next(reader)
+            except StopIteration:
+                break
+            except csv.Error as e: # e.g. a field over csv's size limit; the reader carries on with the next row
+                error(row_idx, f"could not be parsed ({e})")
+                continue
+            if not any(value.strip() for value in values):
+                continue
+            row = dict(zip(fieldnames, values))
+
+            title = row.get('title', '').strip()
+            if not title:
+                error(row_idx, "missing title")
+                continue
+            if len(title) > 255:
+                error(row_idx, "title is longer than 255 characters")
+                continue
+
+            duration_str = row.get('duration', '').strip()
+            duration_seconds = parse_duration(duration_str) if duration_str else 0
+            if duration_str and not duration_seconds and duration_str.strip('0:'):
+                error(row_idx, f"invalid duration '{duration_str}' (use MM:SS or HH:MM:SS)")
+                continue
+
+            video_id = row.get('video_id', '').strip()
+            if len(video_id) > 50:
+                error(row_idx, "video_id is longer than 50 characters")
+                continue
+            if not video_id:
+                # Generate a dummy ID if not provided, as it's required by model
+                video_id = f"csv-{uuid.uuid4().hex[:8]}"
+
+            if dedupe:
+                key = title if dedupe == 'title' else video_id
+                if key in seen:
+                    skipped_count += 1
+                    continue
+                seen.add(key)
+
+            url = row.get('youtube_link', '').strip()
+            if not url:
+                url = f"https://www.youtube.com/watch?v={video_id}"
+
+            batch.append(Video(
                 subject=subject,
                 title=title,
                 duration_seconds=duration_seconds,
                 video_id=video_id,
                 url=url,
                 order=next_order
-            )
+            ))
             next_order += 1
-            created_count += 1
-        except Exception as e:
-            errors.append(f"Row {row_idx}: {str(e)}")
+            totals['total_items'] += 1
+            totals['total_seconds'] += duration_seconds
+
+            if len(batch) >= BATCH_SIZE:
+                Video.objects.bulk_create(batch)
+                created_count += len(batch)
+                batch = []
+
+        if batch:
+            Video.objects.bulk_create(batch)
+            created_count += len(batch)
+
+        progress.apply_delta(subject, **totals)
 
     return {
         'success': True,
         'items_created': created_count,
+        'skipped': skipped_count,
+        'error_count': error_count,
         'errors': errors
     }
@@ -0,0 +1,238 @@
+import gzip
+import json
+import zlib
+from django.db import DataError, IntegrityError, transaction
+from core.models import Exam, Subject, Video, VideoChunk, Note
+from core.services import progress
+from core.services.csv_importer import iter_lines
+
+FORMAT = 'done-dusted-exam'
+VERSION = 1
+BATCH_SIZE = 2000
+MAX_COUNT = 2 ** 31 - 1 # PositiveIntegerField
+
+# Column order of every record type. Each archive line after the header is a
+# JSON array [type, *values] in this order, parents before children.
+FIELDS = {
+    'subject': ['id', 'name', 'daily_goal_minutes', 'playlist_url'],
+    'note': ['subject_id', 'content'],
+    'video': ['id', 'subject_id', 'title', 'video_id', 'url', 'is_watched', 'order', 'duration_seconds', 'is_chunked'],
+    'chunk': ['video_id', 'part_number', 'title', 'start_seconds', 'end_seconds', 'is_watched'],
+}
+
+
+class ArchiveError(ValueError):
+    pass
+
+
+def export_lines(exam, chunk_size=BATCH_SIZE):
+    """
+    Yields the exam as JSON Lines: a header with the exam and the column
+    lists, then subjects, notes, videos and chunks. Rows are streamed with
+    iterator(), so memory does not grow with the size of the exam.
+    """
+    header = {
+        'format': FORMAT,
+        'version': VERSION,
+        'exam': {'name': exam.name, 'description': exam.description},
+        'fields': FIELDS,
+    }
+    yield json.dumps(header) + '\n'
+
+    subjects = Subject.objects.filter(exam=exam).order_by('id')
+    for row in subjects.values_list(*FIELDS['subject']).iterator(chunk_size=chunk_size):
+        yield json.dumps(['subject', *row]) + '\n'
+
+    for note in Note.objects.filter(subject__exam=exam).select_related('subject').order_by('id'):
+        yield json.dumps(['note', note.subject_id, note.get_content_from_file()]) + '\n'
+
+    videos = Video.objects.filter(subject__exam=exam).order_by('subject_id', 'order', 'id')
+    for row in videos.values_list(*FIELDS['video']).iterator(chunk_size=chunk_size):
+        yield json.dumps(['video', *row]) + '\n'
+
+    chunks = VideoChunk.objects.filter(video__subject__exam=exam).order_by('video_id', 'part_number')
+    for row in chunks.values_list(*FIELDS['chunk']).iterator(chunk_size=chunk_size):
+        yield json.dumps(['chunk', *row]) + '\n'
+
+
+def gzip_stream(blocks):
+    """Gzip-compresses a stream of text blocks on the fly."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) # wbits=31 writes a gzip header
+    for block in blocks:
+        data = compressor.compress(block.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def open_archive(file):
+    """Wraps an uploaded or opened archive in gzip when it starts with the gzip magic bytes."""
+    if hasattr(file, 'peek'): # Buffered streams such as sys.stdin.buffer
+        magic = file.peek(2)[:2]
+    elif hasattr(file, 'seek'):
+        magic = file.read(2)
+        file.seek(0)
+    else:
+        return file
+    return gzip.GzipFile(fileobj=file) if magic == b'\x1f\x8b' else file
+
+
+def _check_header(header):
+    """Raises ArchiveError unless `header` is a well-formed archive header this app can read."""
+    if not isinstance(header, dict) or header.get('format') != FORMAT:
+        raise ArchiveError("Not an exam archive")
+    version = header.get('version', 0)
+    if not isinstance(version, int):
+        raise ArchiveError("Archive header has an invalid version")
+    if version > VERSION:
+        raise ArchiveError(f"Archive version {version} is newer than this app supports")
+
+    fields = header.get('fields')
+    if not isinstance(fields, dict) or not all(
+        isinstance(names, list) and all(isinstance(name, str) for name in names) for names in fields.values()
+    ):
+        raise ArchiveError("Archive header has no valid field lists")
+    exam = header.get('exam', {})
+    if not isinstance(exam, dict) or not all(isinstance(exam.get(key, ''), str) for key in ('name', 'description')):
+        raise ArchiveError("Archive header has an invalid exam")
+
+
+def import_archive(file, user, name=None, reset_progress=False, batch_size=BATCH_SIZE):
+    """
+    Restores an archive from export_lines as a new exam of `user`.
+    The file is read line by line; every level is bulk-inserted in batches
+    and the old primary keys are remapped to the new rows on the way.
+    Progress counters are rebuilt at the end. Returns the new Exam.
+    Raises ArchiveError for files that are not exam archives.
+    """
+    lines = iter_lines(open_archive(file))
+    try:
+        header = json.loads(next(lines))
+    except (StopIteration, ValueError):
+        raise ArchiveError("Not an exam archive")
+    _check_header(header)
+
+    columns = {kind: {field: i + 1 for i, field in enumerate(fields)} for kind, fields in header['fields'].items()}
+    subject_ids = {}
+    video_ids = {}
+    notes = {}
+    pending = []
+    pending_kind = None
+
+    def value(kind, row, field, default=None):
+        index = columns[kind].get(field)
+        return row[index] if index is not None and index < len(row) else default
+
+    # Rows are checked here rather than left to the database, whose
+    # constraints would fail the whole import with an IntegrityError
+    def text(kind, row, field, model, required=False):
+        result = value(kind, row, field, '')
+        max_length = model._meta.get_field(field).max_length
+        if not isinstance(result, str) or (required and not result.strip()) or len(result) > max_length:
+            raise ArchiveError(f"{kind} {field} must be a {'non-empty ' if required else ''}"
+                               f"string of at most {max_length} characters")
+        return result
+
+    def count(kind, row, field, default=0):
+        result = value(kind, row, field, default)
+        if not isinstance(result, int) or isinstance(result, bool) or not 0 <= result <= MAX_COUNT:
+            raise ArchiveError(f"{kind} {field} must be a non-negative integer")
+        return result
+
+    def flag(kind, row, field):
+        result = value(kind, row, field, False)
+        if not isinstance(result, bool):
+            raise ArchiveError(f"{kind} {field} must be true or false")
+        return result
+
+    def flush():
+        if not pending:
+            return
+        objects = [build(pending_kind, row) for row in pending]
+        model = {'subject': Subject, 'video': Video, 'chunk': VideoChunk}[pending_kind]
+        model.objects.bulk_create(objects, batch_size=batch_size)
+        if pending_kind == 'subject':
+            subject_ids.update((value('subject', row, 'id'), obj.id) for row, obj in zip(pending, objects))
+        elif pending_kind == 'video':
+            video_ids.update((value('video', row, 'id'), obj.id) for row, obj in zip(pending, objects))
+        pending.clear()
+
+    def build(kind, row):
+        if kind == 'subject':
+            return Subject(
+                exam=exam,
+                name=text(kind, row, 'name', Subject, required=True),
+                daily_goal_minutes=count(kind, row, 'daily_goal_minutes'),
+                playlist_url=text(kind, row, 'playlist_url', Subject),
+            )
+        if kind == 'video':
+            return Video(
+                subject_id=subject_ids[value(kind, row, 'subject_id')],
+                title=text(kind, row, 'title', Video, required=True),
+                video_id=text(kind, row, 'video_id', Video, required=True),
+                url=text(kind, row, 'url', Video, required=True),
+                is_watched=flag(kind, row, 'is_watched') and not reset_progress,
+                order=count(kind, row, 'order'),
+                duration_seconds=count(kind, row, 'duration_seconds'),
+                is_chunked=flag(kind, row, 'is_chunked'),
+            )
+        start_seconds, end_seconds = count(kind, row, 'start_seconds'), count(kind, row, 'end_seconds')
+        if end_seconds < start_seconds:
+            raise ArchiveError("chunk end_seconds is before its start_seconds")
+        return VideoChunk(
+            video_id=video_ids[value(kind, row, 'video_id')],
+            part_number=count(kind, row, 'part_number', 1),
+            title=text(kind, row, 'title', VideoChunk, required=True),
+            start_seconds=start_seconds,
+            end_seconds=end_seconds,
+            is_watched=flag(kind, row, 'is_watched') and not reset_progress,
+        )
+
+    exam_name = name or header.get('exam', {}).get('name') or 'Imported exam'
+    if len(exam_name) > Exam._meta.get_field('name').max_length:
+        raise ArchiveError(f"Exam name must be at most {Exam._meta.get_field('name').max_length} characters")
+
+    with transaction.atomic():
+        exam = Exam.objects.create(
+            user=user,
+            name=exam_name,
+            description=header.get('exam', {}).get('description', ''),
+        )
+        line_number = 1
+        try:
+            for line_number, line in enumerate(lines, start=2):
+                if not line.strip():
+                    continue
+                row = json.loads(line)
+                kind = row[0]
+                if kind == 'note':
+                    flush()
+                    content = value(kind, row, 'content', '')
+                    if not isinstance(content, str):
+                        raise ArchiveError("note content must be a string")
+                    notes[subject_ids[value(kind, row, 'subject_id')]] = content
+                    continue
+                if kind not in columns or kind not in ('subject', 'video', 'chunk'):
+                    raise ArchiveError(f"unknown record type {kind!r}")
+                if kind != pending_kind:
+                    flush()
+                    pending_kind = kind
+                pending.append(row)
+                if len(pending) >= batch_size:
+                    flush()
+            flush()
+        except ArchiveError as e:
+            raise ArchiveError(f"Line {line_number}: {e}")
+        except (ValueError, KeyError, IndexError, TypeError, IntegrityError, DataError) as e:
+            raise ArchiveError(f"Line {line_number}: {e!r}")
+
+        Note.objects.bulk_create([Note(subject_id=subject_id) for subject_id in notes])
+        progress.rebuild_progress(Exam.objects.filter(pk=exam.pk))
+        progress.bump_progress_version(user)
+
+    # Note bodies live in files, written once the rows are committed
+    for note in Note.objects.filter(subject__exam=exam).select_related('subject__exam'):
+        if notes.get(note.subject_id):
+            note.save_content_to_file(notes[note.subject_id])
+    exam.refresh_from_db()
+    return exam
@@ -0,0 +1,133 @@
+import csv
+import json
+from core.models import DailyStudyLog, StudySession, DailyGoal, Video, VideoChunk
+
+EXPORT_FIELDS = [
+    'record', 'date', 'exam', 'subject', 'video', 'part',
+    'seconds', 'goal_seconds', 'is_watched', 'achieved', 'start_time', 'end_time',
+]
+
+CHUNK_SIZE = 2000
+
+
+def _in_range(queryset, start, end, field='date'):
+    if start:
+        queryset = queryset.filter(**{f'{field}__gte': start})
+    if end:
+        queryset = queryset.filter(**{f'{field}__lte': end})
+    return queryset
+
+
+def export_rows(user, start=None, end=None, chunk_size=CHUNK_SIZE):
+    """
+    Yields one flat dict (keys from EXPORT_FIELDS) per history record of a user.
+    Every query is streamed with iterator(), so memory does not grow with history size.
+    Dated records are limited to [start, end]; watched state is always exported in full.
+    """
+    logs = _in_range(DailyStudyLog.objects.filter(user=user), start, end).order_by('date', 'id').values(
+        'date', 'seconds_watched', 'goal_achieved', 'subject__name', 'subject__exam__name'
+    )
+    for log in logs.iterator(chunk_size=chunk_size):
+        yield {
+            'record': 'study_log',
+            'date': log['date'],
+            'exam': log['subject__exam__name'],
+            'subject': log['subject__name'],
+            'seconds': log['seconds_watched'],
+            'achieved': log['goal_achieved'],
+        }
+
+    sessions = _in_range(StudySession.objects.filter(user=user), start, end).order_by('start_time', 'id').values(
+        'date', 'start_time', 'end_time', 'total_seconds'
+    )
+    for session in sessions.iterator(chunk_size=chunk_size):
+        yield {
+            'record': 'session',
+            'date': session['date'],
+            'seconds': session['total_seconds'],
+            'start_time': session['start_time'],
+            'end_time': session['end_time'],
+        }
+
+    goals = _in_range(DailyGoal.objects.filter(user=user), start, end).order_by('date').values(
+        'date', 'goal_hours', 'completed_seconds', 'achieved'
+    )
+    for goal in goals.iterator(chunk_size=chunk_size):
+        yield {
+            'record': 'goal',
+            'date': goal['date'],
+            'seconds': goal['completed_seconds'],
+            'goal_seconds': int(goal['goal_hours'] * 3600),
+            'achieved': goal['achieved'],
+        }
+
+    videos = Video.objects.filter(subject__exam__user=user, is_chunked=False).order_by(
+        'subject_id', 'order', 'id'
+    ).values('title', 'duration_seconds', 'is_watched', 'subject__name', 'subject__exam__name')
+    for video in videos.iterator(chunk_size=chunk_size):
+        yield {
+            'record': 'video',
+            'exam': video['subject__exam__name'],
+            'subject': video['subject__name'],
+            'video': video['title'],
+            'seconds': video['duration_seconds'],
+            'is_watched': video['is_watched'],
+        }
+
+    chunks = VideoChunk.objects.filter(video__subject__exam__user=user).order_by(
+        'video__subject_id', 'video__order', 'video_id', 'part_number'
+    ).values(
+        'part_number', 'start_seconds', 'end_seconds', 'is_watched',
+        'video__title', 'video__subject__name', 'video__subject__exam__name'
+    )
+    for chunk in chunks.iterator(chunk_size=chunk_size):
+        yield {
+            'record': 'chunk',
+            'exam': chunk['video__subject__exam__name'],
+            'subject': chunk['video__subject__name'],
+            'video': chunk['video__title'],
+            'part': chunk['part_number'],
+            'seconds': chunk['end_seconds'] - chunk['start_seconds'],
+            'is_watched': chunk['is_watched'],
+        }
+
+
+class _Echo:
+    """File-like object whose write() just returns the line, for csv.writer."""
+    def write(self, value):
+        return value
+
+
+def _json_value(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def stream_csv(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        values = (_json_value(row.get(field)) for field in EXPORT_FIELDS)
+        yield writer.writerow(['' if value is None else value for value in values])
+
+
+def stream_ndjson(rows):
+    for row in rows:
+        yield json.dumps({field: _json_value(row.get(field)) for field in EXPORT_FIELDS}) + '\n'
+
+
+def buffered(lines, size=500):
+    """Joins generated lines into larger blocks so streaming responses send fewer, bigger writes."""
+    block = []
+    for line in lines:
+        block.append(line)
+        if len(block) >= size:
+            yield ''.join(block)
+            block = []
+    if block:
+        yield ''.join(block)
+
+
+FORMATS = {
+    'csv': (stream_csv, 'text/csv'),
+    'ndjson': (stream_ndjson, 'application/x-ndjson'),
+}
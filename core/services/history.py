@@ -0,0 +1,130 @@
+import datetime
+from django.db import models, transaction
+from core.models import StudyRollup, DailyStudyLog, StudySession, DailyGoal
+from core.services.progress import counter_updates
+
+GRANULARITIES = ('day', 'week', 'month')
+ROLLUP_FIELDS = ('seconds_watched', 'focus_seconds', 'goal_seconds', 'completed_seconds', 'goals_achieved')
+
+
+def period_start(day, granularity):
+    """First day of the bucket containing `day` (weeks start on Monday)."""
+    if granularity == 'week':
+        return day - datetime.timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def record(user, day, subject=None, **deltas):
+    """
+    Adds the given deltas (any of ROLLUP_FIELDS) to the day, week and month
+    rollups of `day`. Pass a subject for watch time, leave it out for the
+    per-user focus/goal totals.
+    Two queries: missing rows are inserted empty (conflicts ignored), then
+    all three are updated at once.
+    """
+    updates = counter_updates(deltas)
+    if not updates:
+        return
+    periods = {granularity: period_start(day, granularity) for granularity in GRANULARITIES}
+    StudyRollup.objects.bulk_create([
+        StudyRollup(user=user, subject=subject, granularity=granularity, period_start=start)
+        for granularity, start in periods.items()
+    ], ignore_conflicts=True)
+    buckets = models.Q()
+    for granularity, start in periods.items():
+        buckets |= models.Q(granularity=granularity, period_start=start)
+    StudyRollup.objects.filter(buckets, user=user, subject=subject).update(**updates)
+
+
+def record_watch(user, subject, day, seconds):
+    """
+    Adds watch time (negative to take it back) to the user's study log for
+    the subject and day and to the rollups. The log never goes below zero,
+    and the rollups get the change actually made to it.
+    Returns the log's new seconds_watched.
+    """
+    logs = DailyStudyLog.objects.filter(user=user, subject=subject, date=day)
+    current = logs.values_list('seconds_watched', flat=True).first()
+    seconds = max(seconds, -(current or 0))
+    if not seconds:
+        return current or 0
+    if current is None:
+        DailyStudyLog.objects.bulk_create([DailyStudyLog(user=user, subject=subject, date=day)], ignore_conflicts=True)
+    logs.update(**counter_updates({'seconds_watched': seconds}))
+    record(user, day, subject=subject, seconds_watched=seconds)
+    return (current or 0) + seconds
+
+
+def record_goal_change(goal, old_completed, old_achieved):
+    """Mirrors a change to a DailyGoal's progress into the per-user rollups."""
+    record(
+        goal.user, goal.date,
+        completed_seconds=goal.completed_seconds - old_completed,
+        goals_achieved=int(goal.achieved) - int(old_achieved),
+    )
+
+
+def get_history(user, start, end, granularity='day', subject=None):
+    """
+    Returns one dict per bucket between start and end (inclusive) in a
+    single range scan over the rollups.
+    """
+    rows = StudyRollup.objects.filter(
+        user=user,
+        granularity=granularity,
+        period_start__gte=period_start(start, granularity),
+        period_start__lte=end,
+    )
+    if subject is not None:
+        rows = rows.filter(subject=subject)
+
+    rows = rows.values('period_start').annotate(
+        **{field: models.Sum(field) for field in ROLLUP_FIELDS}
+    ).order_by('period_start')
+
+    return [
+        {'date': row['period_start'].isoformat(), **{f: row[f] or 0 for f in ROLLUP_FIELDS}}
+        for row in rows
+    ]
+
+
+def _empty():
+    return dict.fromkeys(ROLLUP_FIELDS, 0)
+
+
+def rebuild_history(user):
+    """Recomputes every rollup row of a user from the raw log, session and goal rows."""
+    buckets = {}
+
+    def add(subject_id, day, **values):
+        for granularity in GRANULARITIES:
+            key = (subject_id, granularity, period_start(day, granularity))
+            bucket = buckets.setdefault(key, _empty())
+            for field, value in values.items():
+                bucket[field] += value
+
+    logs = DailyStudyLog.objects.filter(user=user, seconds_watched__gt=0).values_list(
+        'subject_id', 'date', 'seconds_watched'
+    )
+    for subject_id, day, seconds in logs.iterator(chunk_size=2000):
+        add(subject_id, day, seconds_watched=seconds)
+
+    sessions = StudySession.objects.filter(user=user, total_seconds__gt=0).values('date').annotate(
+        seconds=models.Sum('total_seconds')
+    )
+    for row in sessions:
+        add(None, row['date'], focus_seconds=row['seconds'])
+
+    goals = DailyGoal.objects.filter(user=user).values_list('date', 'goal_hours', 'completed_seconds', 'achieved')
+    for day, goal_hours, completed, achieved in goals.iterator(chunk_size=2000):
+        add(None, day, goal_seconds=int(goal_hours * 3600), completed_seconds=completed, goals_achieved=int(achieved))
+
+    with transaction.atomic():
+        StudyRollup.objects.filter(user=user).delete()
+        StudyRollup.objects.bulk_create([
+            StudyRollup(user=user, subject_id=subject_id, granularity=granularity, period_start=start, **values)
+            for (subject_id, granularity, start), values in buckets.items()
+        ], batch_size=1000)
+    return len(buckets)
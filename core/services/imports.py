@@ -0,0 +1,213 @@
+import datetime
+import os
+import socket
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from core.models import ImportJob, Subject, Video
+from core.services import progress, quota
+from core.utils import fetch_playlist_items, fetch_playlists
+
+BATCH_SIZE = 500
+FETCH_ERROR = 'Failed to fetch playlist items. Please check the URL and your API Key.'
+
+
+def enqueue(user, subject, playlist_url, force=False):
+    """
+    Queues an import (or resync) of `playlist_url` into the subject and remembers the URL for resyncs.
+    With force the job bypasses the freshness of the playlist cache (see utils.fetch_playlist_items).
+    """
+    if subject.playlist_url != playlist_url:
+        subject.playlist_url = playlist_url
+        subject.save(update_fields=['playlist_url'])
+    return ImportJob.objects.create(user=user, subject=subject, playlist_url=playlist_url, force=force)
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def claim_next(worker):
+    """
+    Moves the oldest queued job to 'running' and returns it, or None when the
+    queue is empty. The claim is a conditional UPDATE on status, so two workers
+    can never take the same job, without relying on row locks (SQLite has none).
+    """
+    while True:
+        job_id = ImportJob.objects.filter(status='queued').order_by('created_at', 'id').values_list(
+            'id', flat=True
+        ).first()
+        if job_id is None:
+            return None
+        now = timezone.now()
+        claimed = ImportJob.objects.filter(id=job_id, status='queued').update(
+            status='running', worker=worker, started_at=now, heartbeat_at=now
+        )
+        if claimed:
+            return ImportJob.objects.select_related('user__profile', 'subject').get(id=job_id)
+        # Another worker got it first, try the next one
+
+
+def requeue_stale(older_than):
+    """
+    Puts 'running' jobs whose worker has not reported in for more than
+    `older_than` seconds (dead worker) back in the queue. Workers beat on
+    every page they fetch, so a long import is not taken for a dead one.
+    """
+    cutoff = timezone.now() - datetime.timedelta(seconds=older_than)
+    silent = Q(heartbeat_at__lt=cutoff) | Q(heartbeat_at__isnull=True, started_at__lt=cutoff)
+    return ImportJob.objects.filter(silent, status='running').update(status='queued', worker='')
+
+
+def upsert_videos(subject, videos_data, batch_size=BATCH_SIZE):
+    """
+    Idempotent playlist write. Videos already in the subject (matched on video_id)
+    keep their order and watched state and only get their duration updated;
+    new ones are bulk-inserted after the current last video, in playlist order.
+    Chunked videos are left alone since their chunks define the duration.
+    Returns (inserted, updated).
+    """
+    with transaction.atomic():
+        existing = {}
+        next_order = 0
+        for video in subject.videos.only('id', 'video_id', 'order', 'duration_seconds', 'is_watched', 'is_chunked'):
+            existing.setdefault(video.video_id, video)
+            next_order = max(next_order, video.order + 1)
+
+        new_videos, changed = [], []
+        delta = progress.empty_stats()
+        for vid in videos_data:
+            duration = vid.get('duration', 0)
+            video = existing.get(vid['video_id'])
+            if video is None:
+                video = Video(
+                    subject=subject,
+                    title=vid['title'],
+                    video_id=vid['video_id'],
+                    url=vid['url'],
+                    order=next_order,
+                    duration_seconds=duration
+                )
+                existing[video.video_id] = video # Playlists can list a video twice
+                new_videos.append(video)
+                next_order += 1
+            elif not video.is_chunked and video.pk and video.duration_seconds != duration:
+                delta['total_seconds'] += duration - video.duration_seconds
+                if video.is_watched:
+                    delta['watched_seconds'] += duration - video.duration_seconds
+                video.duration_seconds = duration
+                changed.append(video)
+
+        Video.objects.bulk_create(new_videos, batch_size=batch_size)
+        Video.objects.bulk_update(changed, ['duration_seconds'], batch_size=batch_size)
+
+        for video in new_videos:
+            for field, value in progress.video_stats(video, chunks=[]).items():
+                delta[field] += value
+        progress.apply_delta(subject, **delta)
+    return len(new_videos), len(changed)
+
+
+def import_playlists(user, exam, pairs):
+    """
+    Batch import of [(subject_name, playlist_url), ...] into an exam. All playlists
+    are fetched together (utils.fetch_playlists) first, then every subject is
+    upserted inside one transaction. Subjects that do not exist yet are created
+    along with their first successful import, so a bad URL leaves nothing behind.
+    A failing playlist does not stop the others.
+    Returns one report dict per pair, in order (subject_id is None when the
+    subject does not exist).
+    """
+    names = list(dict.fromkeys(name for name, _ in pairs))
+    subjects = {subject.name: subject for subject in exam.subjects.filter(name__in=names)}
+
+    api_key = user.profile.google_api_key
+    results, errors = fetch_playlists([url for _, url in pairs], api_key) if api_key else ({}, {})
+
+    report = []
+    created = set()
+    with transaction.atomic():
+        for name, url in pairs:
+            subject = subjects.get(name)
+            entry = {
+                'subject': name,
+                'subject_id': subject.id if subject else None,
+                'created_subject': name in created,
+                'playlist_url': url,
+            }
+            report.append(entry)
+
+            if url not in results:
+                entry.update(status='error', error=errors.get(url, FETCH_ERROR))
+                continue
+            try:
+                with transaction.atomic():
+                    if subject is None:
+                        subject = Subject.objects.create(exam=exam, name=name)
+                    inserted, updated = upsert_videos(subject, results[url])
+                    Subject.objects.filter(pk=subject.pk).update(playlist_url=url)
+            except Exception as e:
+                entry.update(status='error', error=f"Could not save videos: {e}")
+                continue
+            if name not in subjects:
+                subjects[name] = subject
+                created.add(name)
+            entry.update(
+                status='ok', subject_id=subject.id, created_subject=name in created,
+                videos=len(results[url]), inserted=inserted, updated=updated,
+            )
+        if created:
+            progress.bump_progress_version(user)
+    return report
+
+
+def _finish(job, status, **fields):
+    for field, value in fields.items():
+        setattr(job, field, value)
+    job.status = status
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'finished_at', *fields])
+
+
+def run_job(job):
+    """
+    Fetches the job's playlist, recording progress (and a heartbeat) after
+    every page, then upserts the videos.
+    """
+    def on_page(pages, found):
+        now = timezone.now()
+        ImportJob.objects.filter(id=job.id).update(pages_fetched=pages, videos_found=found, heartbeat_at=now)
+        job.pages_fetched, job.videos_found, job.heartbeat_at = pages, found, now
+
+    api_key = job.user.profile.google_api_key
+    try:
+        videos_data = None
+        if api_key:
+            videos_data = fetch_playlist_items(job.playlist_url, api_key, on_page=on_page, force=job.force)
+    except quota.QuotaExceeded as e:
+        _finish(job, 'failed', errors=job.errors + [str(e)])
+        return job
+    if not videos_data:
+        _finish(job, 'failed', errors=job.errors + [FETCH_ERROR])
+        return job
+
+    try:
+        inserted, updated = upsert_videos(job.subject, videos_data)
+    except Exception as e:
+        _finish(job, 'failed', errors=job.errors + [f"Could not save videos: {e}"])
+        return job
+
+    _finish(job, 'done', videos_inserted=inserted, videos_updated=updated)
+    return job
+
+
+def job_progress(job):
+    return {
+        'id': job.id,
+        'state': job.status,
+        'pages_fetched': job.pages_fetched,
+        'videos_found': job.videos_found,
+        'videos_inserted': job.videos_inserted,
+        'videos_updated': job.videos_updated,
+        'errors': job.errors,
+    }
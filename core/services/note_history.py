@@ -0,0 +1,307 @@
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from django.conf import settings
+
+# Every time a note is written (see note_store._commit) its content is cut
+# into chunks and recorded in <note>.html.history, one JSON line per version:
+#   {"id": n, "version": v, "saved_at": t, "bytes": n, "chunks": [sha256, ...]}
+#   {"id": n, "version": v, "saved_at": t, "bytes": n, "ops": [[index, delete_count, [sha256, ...]]]}
+# The first form is a snapshot, written for the first entry and then every
+# SNAPSHOT_EVERY entries; the others are a delta op against the previous
+# entry's chunk list (in the format of note_store's block ops). Chunks are
+# stored once, gzipped, as MEDIA_ROOT/notes/objects/<2 hex>/<sha256>.gz, so an
+# edit only stores the chunks it changed.
+# Each of the note's sections is chunked on its own. Chunk boundaries are
+# content-defined: a section is cut after a block (or, inside very long
+# blocks, a line) whose CRC matches BOUNDARY_MASK once the chunk has
+# MIN_CHUNK characters, so an edit moves no boundaries outside the chunk it
+# touches.
+# <note>.html.history.head keeps the newest entry's chunk list, which section
+# each run of it came from and the size of the history after it, so a save
+# only chunks the sections it changed and does not read the whole history.
+
+MIN_CHUNK = 4 * 1024
+MAX_CHUNK = 64 * 1024
+BOUNDARY_MASK = 0x7 # A boundary on about every 8th block past MIN_CHUNK
+SNAPSHOT_EVERY = 50
+GC_GRACE_SECONDS = 60 * 60
+
+
+def enabled():
+    return getattr(settings, 'NOTE_HISTORY', True)
+
+
+def objects_dir():
+    return os.path.join(settings.MEDIA_ROOT, 'notes', 'objects')
+
+
+def _history_path(path):
+    return path + '.history'
+
+
+def _head_path(path):
+    return path + '.history.head'
+
+
+def _object_path(digest):
+    return os.path.join(objects_dir(), digest[:2], digest + '.gz')
+
+
+def _units(blocks):
+    for block in blocks:
+        if len(block) <= MAX_CHUNK:
+            yield block
+            continue
+        for line in block.splitlines(keepends=True):
+            for start in range(0, len(line), MAX_CHUNK):
+                yield line[start:start + MAX_CHUNK]
+
+
+def split_chunks(blocks):
+    """Groups blocks into content-defined chunks of text."""
+    chunks, current, size = [], [], 0
+    for unit in _units(blocks):
+        current.append(unit)
+        size += len(unit)
+        if size >= MAX_CHUNK or (size >= MIN_CHUNK and zlib.crc32(unit.encode('utf-8')) & BOUNDARY_MASK == 0):
+            chunks.append(''.join(current))
+            current, size = [], 0
+    if current:
+        chunks.append(''.join(current))
+    return chunks
+
+
+def _write_object(digest, data):
+    object_path = _object_path(digest)
+    if os.path.exists(object_path):
+        return
+    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+    tmp_path = f"{object_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(gzip.compress(data, compresslevel=6, mtime=0))
+    os.replace(tmp_path, object_path)
+
+
+def _read_object(digest):
+    with gzip.open(_object_path(digest), 'rb') as f:
+        return f.read().decode('utf-8')
+
+
+def _read(path):
+    try:
+        with open(_history_path(path), 'r', encoding='utf-8') as f:
+            entries = []
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError: # Torn last line
+                    break
+            return entries
+    except FileNotFoundError:
+        return []
+
+
+def _chunk_lists(entries):
+    """Yields (entry, chunk hashes) for the entries in order. The list is updated in place."""
+    chunks = []
+    for entry in entries:
+        if 'chunks' in entry:
+            chunks = list(entry['chunks'])
+        else:
+            for index, delete_count, inserted in entry['ops']:
+                chunks[index:index + delete_count] = inserted
+        yield entry, chunks
+
+
+def _diff(before, after):
+    start = 0
+    while start < len(before) and start < len(after) and before[start] == after[start]:
+        start += 1
+    end = 0
+    while (end < len(before) - start and end < len(after) - start
+           and before[len(before) - 1 - end] == after[len(after) - 1 - end]):
+        end += 1
+    return [start, len(before) - start - end, after[start:len(after) - end]]
+
+
+def _latest(path):
+    """
+    (id, entries since the last snapshot, chunk list, section runs) of the
+    newest entry. The runs are [[section id, chunk count], ...] and only come
+    from the head file, when it matches the history (it does not after a
+    prune or a crash between the two writes); otherwise the rest is read from
+    the history and the runs are [].
+    """
+    try:
+        with open(_head_path(path), 'r', encoding='utf-8') as f:
+            head = json.load(f)
+        if head['offset'] == os.path.getsize(_history_path(path)):
+            return head['id'], head['since_snapshot'], head['chunks'], head['sections']
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        pass
+    last_id, since_snapshot, previous = 0, 0, None
+    for entry, previous in _chunk_lists(_read(path)):
+        last_id = entry['id']
+        since_snapshot = 0 if 'chunks' in entry else since_snapshot + 1
+    return last_id, since_snapshot, previous, []
+
+
+def record(path, sections, version, load):
+    """
+    Adds the note's content as a new history entry, unless it is the same as
+    the latest one. `sections` are the note's sections as in its layout and
+    `load(index)` returns the blocks of one of them; it is only called for
+    sections the latest entry does not have. Called by note_store with the
+    note's lock held.
+    """
+    if not enabled():
+        return
+    last_id, since_snapshot, previous, runs = _latest(path)
+    known, offset = {}, 0
+    for section_id, count in runs:
+        known[section_id] = previous[offset:offset + count]
+        offset += count
+
+    hashes, new_runs = [], []
+    for index, section in enumerate(sections):
+        if section['id'] not in known:
+            section_hashes = []
+            for chunk in split_chunks(load(index)):
+                data = chunk.encode('utf-8')
+                digest = hashlib.sha256(data).hexdigest()
+                _write_object(digest, data)
+                section_hashes.append(digest)
+            known[section['id']] = section_hashes
+        hashes.extend(known[section['id']])
+        new_runs.append([section['id'], len(known[section['id']])])
+
+    if previous != hashes:
+        entry = {
+            'id': last_id + 1,
+            'version': version,
+            'saved_at': int(time.time()),
+            'bytes': sum(section['bytes'] for section in sections),
+        }
+        if previous is None or since_snapshot + 1 >= SNAPSHOT_EVERY:
+            entry['chunks'] = hashes
+        else:
+            entry['ops'] = [_diff(previous, hashes)]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(_history_path(path), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + '\n')
+        last_id, since_snapshot = entry['id'], 0 if 'chunks' in entry else since_snapshot + 1
+    elif runs == new_runs:
+        return
+
+    head = {
+        'id': last_id,
+        'since_snapshot': since_snapshot,
+        'chunks': hashes,
+        'sections': new_runs,
+        'offset': os.path.getsize(_history_path(path)),
+    }
+    tmp_path = f"{_head_path(path)}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(head, f)
+    os.replace(tmp_path, _head_path(path))
+
+
+def versions(path):
+    """The note's history, newest first: [{"id", "version", "saved_at", "bytes"}]."""
+    return [
+        {
+            'id': entry['id'],
+            'version': entry['version'],
+            'saved_at': datetime.datetime.fromtimestamp(entry['saved_at'], datetime.timezone.utc).isoformat(),
+            'bytes': entry['bytes'],
+        }
+        for entry in reversed(_read(path))
+    ]
+
+
+def content(path, history_id):
+    """The note's content as of a history entry, or None if there is no such entry."""
+    for entry, chunks in _chunk_lists(_read(path)):
+        if entry['id'] == history_id:
+            return ''.join(_read_object(digest) for digest in chunks)
+    return None
+
+
+def latest(path):
+    """The note's content as of its newest history entry, or None without a readable one."""
+    try:
+        chunks = _latest(path)[2]
+        return None if chunks is None else ''.join(_read_object(digest) for digest in chunks)
+    except (OSError, EOFError):
+        return None
+
+
+def prune(path, keep):
+    """Drops all but the newest `keep` history entries. Returns how many were dropped."""
+    entries = _read(path)
+    dropped = max(len(entries) - keep, 0)
+    if not dropped:
+        return 0
+    lines = []
+    for i, (entry, chunks) in enumerate(_chunk_lists(entries)):
+        if i < dropped:
+            continue
+        if i == dropped and 'ops' in entry: # The oldest kept entry becomes the snapshot
+            entry = {key: value for key, value in entry.items() if key != 'ops'}
+            entry['chunks'] = list(chunks)
+        lines.append(json.dumps(entry) + '\n')
+    tmp_path = f"{_history_path(path)}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.writelines(lines)
+    os.replace(tmp_path, _history_path(path))
+    try:
+        os.remove(_head_path(path))
+    except FileNotFoundError:
+        pass
+    return dropped
+
+
+def history_paths():
+    """The note paths (without .history) that have a history under MEDIA_ROOT/notes."""
+    root = os.path.join(settings.MEDIA_ROOT, 'notes')
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if dirpath == root and 'objects' in dirnames:
+            dirnames.remove('objects')
+        paths.extend(os.path.join(dirpath, name[:-len('.history')]) for name in filenames if name.endswith('.history'))
+    return sorted(paths)
+
+
+def collect_garbage(grace_seconds=GC_GRACE_SECONDS):
+    """
+    Deletes chunk objects no history refers to. Objects younger than
+    `grace_seconds` are kept, as a save may have written them without having
+    recorded its entry yet. Returns (objects deleted, bytes freed).
+    """
+    referenced = set()
+    for path in history_paths():
+        for entry in _read(path):
+            if 'chunks' in entry:
+                referenced.update(entry['chunks'])
+            else:
+                for _, _, inserted in entry['ops']:
+                    referenced.update(inserted)
+
+    deleted = freed = 0
+    cutoff = time.time() - grace_seconds
+    for dirpath, _, filenames in os.walk(objects_dir()):
+        for filename in filenames:
+            object_path = os.path.join(dirpath, filename)
+            stat = os.stat(object_path)
+            if filename.split('.')[0] in referenced or stat.st_mtime > cutoff:
+                continue
+            os.remove(object_path)
+            deleted += 1
+            freed += stat.st_size
+    return deleted, freed
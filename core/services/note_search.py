@@ -0,0 +1,180 @@
+import html
+import re
+from django.db import connection, transaction
+from core.models import Note, CommonNote
+
+# Notes are indexed in the core_notesearch FTS5 table (migration 0018) with
+# rowid = note id * 2 for Note and * 2 + 1 for CommonNote. Saves that only
+# send a delta queue the note in core_notesearch_pending instead of reading
+# the whole note back; an owner's queue is indexed before each search.
+
+SKIPPED_ELEMENTS_RE = re.compile(r'<(script|style)\b.*?</\1\s*>', re.I | re.S)
+TAG_RE = re.compile(r'<[^>]*>')
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+SNIPPET_START, SNIPPET_END = '\x02', '\x03'
+SNIPPET_TOKENS = 16
+MIN_PREFIX = 3
+BATCH_SIZE = 200
+
+
+def available():
+    return connection.vendor == 'sqlite'
+
+
+def html_to_text(content):
+    """Plain text of a note: tags, scripts and styles dropped, entities decoded."""
+    content = SKIPPED_ELEMENTS_RE.sub(' ', content)
+    return ' '.join(html.unescape(TAG_RE.sub(' ', content)).split())
+
+
+def doc_id(note):
+    return note.id * 2 + (1 if isinstance(note, CommonNote) else 0)
+
+
+def owner_id(note):
+    return note.user_id if isinstance(note, CommonNote) else note.subject.exam.user_id
+
+
+def title(note):
+    if isinstance(note, CommonNote):
+        return 'Common Notes'
+    return f"{note.subject.name} {note.subject.exam.name}"
+
+
+def _rows(notes, contents=None):
+    for note in notes:
+        content = contents[note.id] if contents else note.get_content_from_file()
+        yield doc_id(note), f"u{owner_id(note)}", title(note), html_to_text(content)
+
+
+def _write(cursor, rows):
+    rows = list(rows)
+    cursor.executemany("INSERT OR REPLACE INTO core_notesearch (rowid, owner, title, body) VALUES (%s, %s, %s, %s)", rows)
+    cursor.executemany("DELETE FROM core_notesearch_pending WHERE doc_id = %s", [(row[0],) for row in rows])
+
+
+def index_note(note, content=None):
+    """
+    Call after saving a Note or CommonNote. With the full `content` the note
+    is indexed right away; without it (delta saves) it is queued.
+    """
+    if not available():
+        return
+    with connection.cursor() as cursor:
+        if content is None:
+            cursor.execute(
+                "INSERT OR IGNORE INTO core_notesearch_pending (doc_id, owner_id) VALUES (%s, %s)",
+                [doc_id(note), owner_id(note)],
+            )
+        else:
+            _write(cursor, _rows([note], {note.id: content}))
+
+
+def index_pending(user):
+    """Indexes the user's queued notes. Returns how many were indexed."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT doc_id FROM core_notesearch_pending WHERE owner_id = %s", [user.id])
+        doc_ids = [row[0] for row in cursor.fetchall()]
+        if not doc_ids:
+            return 0
+        note_ids = [i // 2 for i in doc_ids if i % 2 == 0]
+        common_ids = [i // 2 for i in doc_ids if i % 2 == 1]
+        notes = list(Note.objects.filter(id__in=note_ids).select_related('subject__exam'))
+        notes += CommonNote.objects.filter(id__in=common_ids)
+        with transaction.atomic():
+            _write(cursor, _rows(notes))
+            # Queued notes deleted since are dropped from the queue and the index
+            found = {doc_id(note) for note in notes}
+            gone = [(i,) for i in doc_ids if i not in found]
+            cursor.executemany("DELETE FROM core_notesearch WHERE rowid = %s", gone)
+            cursor.executemany("DELETE FROM core_notesearch_pending WHERE doc_id = %s", gone)
+    return len(doc_ids)
+
+
+def match_query(query):
+    """
+    Turns user input into an FTS5 query: every word must appear. A trailing
+    '*' makes the last word a prefix, if it has at least MIN_PREFIX characters
+    (shorter prefixes expand to too many terms to rank quickly).
+    None when there are no words.
+    """
+    terms = TERM_RE.findall(query)
+    if not terms:
+        return None
+    match = ' '.join(f'"{term}"' for term in terms)
+    if query.rstrip().endswith('*') and len(terms[-1]) >= MIN_PREFIX:
+        match += '*'
+    return match
+
+
+def _snippet_html(text):
+    escaped = html.escape(text)
+    return escaped.replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>')
+
+
+def search(user, query, limit=20):
+    """
+    Ranked matches among the user's notes: a list of dicts with the kind
+    ('note' or 'common'), ids, subject and exam names and an HTML snippet
+    with the matches in <mark>.
+    """
+    terms = match_query(query)
+    if terms is None:
+        return []
+    index_pending(user)
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT rowid, snippet(core_notesearch, 2, %s, %s, '…', %s) "
+            "FROM core_notesearch WHERE core_notesearch MATCH %s "
+            "ORDER BY rank LIMIT %s",
+            [SNIPPET_START, SNIPPET_END, SNIPPET_TOKENS, f'owner : "u{user.id}" AND ({terms})', limit],
+        )
+        rows = cursor.fetchall()
+
+    notes = Note.objects.filter(id__in=[i // 2 for i, _ in rows if i % 2 == 0]).select_related('subject__exam')
+    notes = {note.id: note for note in notes}
+    results = []
+    stale = []
+    for rowid, snippet in rows:
+        if rowid % 2:
+            results.append({'kind': 'common', 'note_id': rowid // 2, 'snippet': _snippet_html(snippet)})
+            continue
+        note = notes.get(rowid // 2)
+        if note is None: # The subject was deleted
+            stale.append((rowid,))
+            continue
+        results.append({
+            'kind': 'note',
+            'note_id': note.id,
+            'subject_id': note.subject_id,
+            'subject': note.subject.name,
+            'exam_id': note.subject.exam_id,
+            'exam': note.subject.exam.name,
+            'snippet': _snippet_html(snippet),
+        })
+    if stale:
+        with connection.cursor() as cursor:
+            cursor.executemany("DELETE FROM core_notesearch WHERE rowid = %s", stale)
+    return results
+
+
+def rebuild():
+    """Re-indexes every note from its file. Returns the number of notes indexed."""
+    count = 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("DELETE FROM core_notesearch")
+        cursor.execute("DELETE FROM core_notesearch_pending")
+        querysets = [Note.objects.select_related('subject__exam').order_by('id'), CommonNote.objects.order_by('id')]
+        for queryset in querysets:
+            batch = []
+            for note in queryset.iterator(chunk_size=BATCH_SIZE):
+                batch.append(note)
+                if len(batch) >= BATCH_SIZE:
+                    _write(cursor, _rows(batch))
+                    count += len(batch)
+                    batch = []
+            if batch:
+                _write(cursor, _rows(batch))
+                count += len(batch)
+    return count
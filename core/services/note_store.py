@@ -0,0 +1,932 @@
+import contextlib
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from django.conf import settings
+from django.db import connections
+from core.services import note_history
+
+try:
+    import zstandard
+except ImportError: # Optional; notes are gzipped without it
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError: # Windows: notes are only locked within the process
+    fcntl = None
+
+# A note at <note>.html is stored as files next to it:
+#   <note>.html.sections/ one <id>.part[.gz|.zst] file per section, named by content hash
+#   <note>.html.blocks    {"version": n, "lengths": [...], "sections": [...], "size": n,
+#                          "body_version": n, "bytes": n} - the block layout, the section
+#                         index, the decompressed size, and the version and stored size
+#                         of the body
+#   <note>.html.journal   one {"version": n, "ops": [...]} line per delta save
+#   <note>.html[.gz|.zst] the whole content, compressed with NOTE_COMPRESSION
+# Sections are runs of blocks that start at a heading or once the previous
+# section reaches NOTE_SECTION_MAX_BYTES; their index is
+# "sections": [{"id", "title", "level", "blocks", "bytes"}]. The sections hold
+# the note: a write regroups only the sections its changes touch and writes
+# only their files, so its cost follows the size of the edit rather than of
+# the note. The body is a copy for serving the note in one piece: a write
+# drops it and it is rebuilt from the sections when next needed.
+# A delta op is [index, delete_count, [inserted blocks]] and applies to the
+# block list as left by the previous op. The journal is folded into the
+# sections on read and whenever it grows past NOTE_JOURNAL_MAX_ENTRIES entries
+# or the size of the note itself. Entries up to the layout's version are
+# already folded (a fold stopped before dropping the journal).
+# Each write is also recorded in the note's history (see note_history).
+# Write-behind is an opt-in for single-process deployments: with
+# NOTE_WRITE_BEHIND_SECONDS > 0, saves are coalesced in memory. The first
+# save of a note starts the window, later ones (full or delta) replace the
+# pending blocks, and the change is journaled as one delta when the window
+# ends, when anything but read() or version() needs the note's files, or at
+# shutdown (flush_all). The buffer is per process: with several workers a
+# save in one is not seen by the others and can be overwritten by them, so
+# leave it at 0 there.
+
+# Content-Encoding name -> body file suffix
+CODECS = {'zstd': '.zst', 'gzip': '.gz', 'identity': ''}
+READ_CHUNK_SIZE = 64 * 1024
+
+TAG_RE = re.compile(r'<!--.*?-->|<(/?)([a-zA-Z][^\s/>]*)[^>]*>', re.S)
+HEADING_RE = re.compile(r'\s*<h([1-6])[\s>]', re.I)
+VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+RAW_TEXT_ELEMENTS = {'script', 'style', 'textarea', 'title'}
+
+_locks = {}
+_locks_lock = threading.Lock()
+_pending = {} # path -> {"base", "version", "blocks", "on_flush", "timer"}
+
+logger = logging.getLogger(__name__)
+
+
+class DeltaConflict(Exception):
+    """The delta was made against another version than the stored one."""
+    def __init__(self, version):
+        super().__init__(f"Note is at version {version}")
+        self.version = version
+
+
+def split_blocks(html):
+    """
+    Splits HTML into its top-level nodes (elements, text runs and comments),
+    matching how the editor sees them. Unclosed elements run to the end.
+    """
+    blocks, depth, block_start, pos = [], 0, 0, 0
+    lowered = None
+
+    def cut(end):
+        nonlocal block_start
+        if end > block_start:
+            blocks.append(html[block_start:end])
+        block_start = end
+
+    while True:
+        match = TAG_RE.search(html, pos)
+        if not match:
+            break
+        if depth == 0:
+            cut(match.start()) # Text before a top-level tag
+        pos = match.end()
+        closing, name = match.group(1), (match.group(2) or '').lower()
+        if name in RAW_TEXT_ELEMENTS and not closing:
+            lowered = lowered or html.lower()
+            end = lowered.find(f'</{name}', pos)
+            pos = len(html) if end < 0 else (html.find('>', end) + 1 or len(html))
+        elif closing:
+            depth = max(depth - 1, 0)
+        elif name and name not in VOID_ELEMENTS and not match.group(0).endswith('/>'):
+            depth += 1
+        if depth == 0:
+            cut(pos)
+    cut(len(html))
+    return blocks
+
+
+def _strip_tags(html):
+    return ' '.join(TAG_RE.sub(' ', html).split())
+
+
+def build_sections(blocks):
+    """Groups blocks into sections: [(entry, text)] with entry as stored in the layout."""
+    max_bytes = getattr(settings, 'NOTE_SECTION_MAX_BYTES', 64 * 1024)
+    groups = []
+    for block in blocks:
+        heading = HEADING_RE.match(block)
+        size = len(block.encode('utf-8'))
+        if not groups or heading or groups[-1]['bytes'] + size > max_bytes:
+            groups.append({
+                'title': _strip_tags(block)[:120] if heading else '',
+                'level': int(heading.group(1)) if heading else 0,
+                'blocks': [],
+                'bytes': 0,
+            })
+        groups[-1]['blocks'].append(block)
+        groups[-1]['bytes'] += size
+
+    sections = []
+    for group in groups:
+        text = ''.join(group['blocks'])
+        entry = {
+            'id': hashlib.sha256(text.encode('utf-8')).hexdigest()[:16],
+            'title': group['title'],
+            'level': group['level'],
+            'blocks': len(group['blocks']),
+            'bytes': group['bytes'],
+        }
+        sections.append((entry, text))
+    return sections
+
+
+@contextlib.contextmanager
+def _lock(path):
+    """
+    Serializes access to a note: a thread lock within the process, and an
+    flock on <note>.lock across processes (gunicorn workers, commands), as a
+    fold rewrites sections and drops the journal another process may be using.
+    """
+    with _locks_lock:
+        thread_lock = _locks.setdefault(path, threading.Lock())
+    with thread_lock:
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+
+def _layout_path(path):
+    return path + '.blocks'
+
+
+def _journal_path(path):
+    return path + '.journal'
+
+
+def _sections_dir(path):
+    return path + '.sections'
+
+
+def _section_path(path, section_id):
+    return os.path.join(_sections_dir(path), section_id + '.part')
+
+
+def storage_codec():
+    """The codec new note bodies are written with: NOTE_COMPRESSION, where 'auto' prefers zstd."""
+    codec = getattr(settings, 'NOTE_COMPRESSION', 'auto')
+    if codec == 'auto' or (codec == 'zstd' and zstandard is None):
+        return 'zstd' if zstandard is not None else 'gzip'
+    return codec
+
+
+def _stored(path):
+    """(body path, codec) of the note's body file, or (None, None) when there is none."""
+    found = [(path + suffix, codec) for codec, suffix in CODECS.items() if os.path.exists(path + suffix)]
+    if not found:
+        return None, None
+    # Several can only exist after a crash while switching codecs; the newest wins
+    return max(found, key=lambda item: os.path.getmtime(item[0]))
+
+
+def _open_body(body, codec):
+    """Opens a body file (a path or an open binary file) as a binary stream of the decompressed content."""
+    if codec == 'gzip':
+        return gzip.open(body, 'rb')
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().stream_reader(body if hasattr(body, 'read') else open(body, 'rb'), closefd=True)
+    return body if hasattr(body, 'read') else open(body, 'rb')
+
+
+def _read_body(path):
+    body_path, codec = _stored(path)
+    if body_path is None:
+        return None
+    with _open_body(body_path, codec) as f:
+        return f.read().decode('utf-8')
+
+
+def _write_body(path, text, codec=None):
+    """
+    Writes the note body with `codec` (storage_codec() by default) and drops
+    other encodings. Returns (body path, decompressed size).
+    """
+    codec = codec or storage_codec()
+    data = text.encode('utf-8')
+    body_path = path + CODECS[codec]
+    size = len(data)
+    if codec == 'gzip':
+        data = gzip.compress(data, compresslevel=6, mtime=0)
+    elif codec == 'zstd':
+        data = zstandard.ZstdCompressor(level=3).compress(data)
+    _write_bytes(body_path, data)
+    for other in CODECS.values():
+        if path + other != body_path and os.path.exists(path + other):
+            os.remove(path + other)
+    return body_path, size
+
+
+def _read_text(path):
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        return f.read()
+
+
+def _fsync_enabled():
+    return getattr(settings, 'NOTE_FSYNC', False)
+
+
+def _write_bytes(path, data):
+    """
+    Writes through a temporary file so readers never see half a note. With
+    NOTE_FSYNC the data and the rename are also synced to disk.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        if _fsync_enabled():
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    if _fsync_enabled() and hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(directory, os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _read_journal(path):
+    try:
+        with open(_journal_path(path), 'r', encoding='utf-8') as f:
+            # A torn last line (crash mid-append) is dropped
+            entries = []
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break
+            return entries
+    except FileNotFoundError:
+        return []
+
+
+def _write_layout(path, layout):
+    _write_bytes(_layout_path(path), json.dumps(layout).encode())
+
+
+def _journal_version(path, version):
+    return max([version] + [entry['version'] for entry in _read_journal(path)])
+
+
+def _read_layout(path):
+    """
+    The note's layout (see above), or None when there is no note. Notes
+    written before layouts or sections existed are indexed from their body on
+    first use.
+    """
+    try:
+        layout = json.loads(_read_text(_layout_path(path)))
+        version, lengths = layout['version'], layout['lengths']
+    except FileNotFoundError:
+        if _stored(path)[0] is None:
+            return None
+        # Written before delta saves existed: split into blocks at a new
+        # version, as the block layout changes
+        return _reindex(path, split_blocks(_read_body(path)), _journal_version(path, 0) + 1)
+    except (ValueError, KeyError, TypeError):
+        return _repair(path, 0)
+    if 'body_version' not in layout:
+        # Written while the body was the note itself
+        body_path, _ = _stored(path)
+        if layout.get('bytes') != (os.path.getsize(body_path) if body_path else 0):
+            # A compaction stopped after replacing the body: the journal is
+            # already in it, so restart from the file
+            return _repair(path, version)
+        if 'sections' not in layout:
+            return _reindex(path, _split(_read_body(path) or '', lengths), version)
+        layout['body_version'] = version
+    directory = _sections_dir(path)
+    present = {name.split('.')[0] for name in os.listdir(directory)} if os.path.isdir(directory) else set()
+    if any(entry['id'] not in present for entry in layout['sections']):
+        logger.warning("Note %s is missing section files; rebuilding it", path)
+        return _repair(path, version, layout)
+    return layout
+
+
+def _repair(path, version, layout=None):
+    """
+    Rebuilds the note at a new version (forcing clients to resend in full)
+    from its body, or, when a layout whose body is outdated lost section
+    files, from the newest history entry.
+    """
+    version = _journal_version(path, version) + 1
+    if layout is not None and not _body_current(path, layout):
+        content = note_history.latest(path)
+        if content is not None:
+            return _rebuild(path, None, split_blocks(content), version)
+    return _reindex(path, split_blocks(_read_body(path) or ''), version)
+
+
+def _reindex(path, blocks, version):
+    """Indexes the note from its body file, which holds `blocks` and stays current."""
+    return _rebuild(path, None, blocks, version, keep_body=True)
+
+
+def _split(content, lengths):
+    """Cuts the body back into its blocks (a None length runs to the end)."""
+    blocks, start = [], 0
+    for length in lengths:
+        end = len(content) if length is None else start + length
+        blocks.append(content[start:end])
+        start = end
+    return blocks
+
+
+def _apply_ops(blocks, ops):
+    """Applies delta ops to a list of blocks (or of block lengths) in place."""
+    for index, delete_count, inserted in ops:
+        blocks[index:index + delete_count] = inserted
+
+
+def _validate_ops(ops, count):
+    """Checks the ops against a block count and returns the count they leave."""
+    if not isinstance(ops, list):
+        raise ValueError("ops must be a list")
+    for op in ops:
+        if not (isinstance(op, list) and len(op) == 3):
+            raise ValueError("Each op must be [index, delete_count, blocks]")
+        index, delete_count, inserted = op
+        if not (isinstance(index, int) and isinstance(delete_count, int) and 0 <= index
+                and 0 <= delete_count and index + delete_count <= count):
+            raise ValueError(f"Op {op[:2]} is out of range for {count} blocks")
+        if not (isinstance(inserted, list) and all(isinstance(block, str) for block in inserted)):
+            raise ValueError("Inserted blocks must be strings")
+        count += len(inserted) - delete_count
+    return count
+
+
+def _journal(path, layout):
+    """The journal entries not folded into the layout yet."""
+    version = layout['version'] if layout else 0
+    return [entry for entry in _read_journal(path) if entry['version'] > version]
+
+
+def _state(path):
+    """(version, block count, journal entries, size) without reading the note's content."""
+    layout = _read_layout(path)
+    version, count, size = (layout['version'], len(layout['lengths']), layout['size']) if layout else (0, 0, 0)
+    entries = _journal(path, layout)
+    for entry in entries:
+        count += sum(len(inserted) - delete_count for _, delete_count, inserted in entry['ops'])
+        version = entry['version']
+    return version, count, entries, size
+
+
+def _body_current(path, layout):
+    body_path, _ = _stored(path)
+    return (body_path is not None and layout.get('body_version') == layout['version']
+            and os.path.getsize(body_path) == layout.get('bytes'))
+
+
+def _read_section(path, section_id):
+    text = _read_body(_section_path(path, section_id))
+    if text is None:
+        raise FileNotFoundError(_section_path(path, section_id))
+    return text
+
+
+def _content(path, layout):
+    """The content as of the layout, from the body when it is current and otherwise from the sections."""
+    if _body_current(path, layout):
+        return _read_body(path)
+    return ''.join(_read_section(path, entry['id']) for entry in layout['sections'])
+
+
+def _load(path):
+    """(version, blocks) of the note with its journal applied."""
+    layout = _read_layout(path)
+    if layout is None:
+        version, blocks = 0, []
+    else:
+        version, blocks = layout['version'], _split(_content(path, layout), layout['lengths'])
+    for entry in _journal(path, layout):
+        _apply_ops(blocks, entry['ops'])
+        version = entry['version']
+    return version, blocks
+
+
+def _diff(before, after):
+    """The op that turns the block list `before` into `after`, keeping their common start and end."""
+    start = 0
+    while start < len(before) and start < len(after) and before[start] == after[start]:
+        start += 1
+    end = 0
+    while (end < len(before) - start and end < len(after) - start
+           and before[len(before) - 1 - end] == after[len(after) - 1 - end]):
+        end += 1
+    return [start, len(before) - start - end, list(after[start:len(after) - end])]
+
+
+def _refs(path, layout, blocks):
+    """
+    `blocks` as refs for _rebuild: the blocks they start and end with that
+    are unchanged from the layout as indexes, the rest as strings. All of
+    them are strings when the stored sections cannot be read.
+    """
+    try:
+        old = _split(_content(path, layout), layout['lengths']) if layout else []
+    except (OSError, EOFError, ValueError):
+        logger.warning("Could not read note %s; writing it in full", path)
+        return list(blocks)
+    start, delete_count, inserted = _diff(old, blocks)
+    return list(range(start)) + inserted + list(range(start + delete_count, len(old)))
+
+
+def _rebuild(path, layout, refs, version, keep_body=False):
+    """
+    Writes the note at `version` as `refs`: indexes of blocks in `layout`
+    (None for a new note) and new blocks as strings. A section whose blocks
+    are all still there, in order, is kept with its file; the blocks in
+    between are regrouped, taking in the next section when it has no heading
+    and fits, so that edits do not leave small sections behind. Only the
+    changed sections' blocks are read and only their files are written.
+    Returns the new layout.
+    """
+    max_bytes = getattr(settings, 'NOTE_SECTION_MAX_BYTES', 64 * 1024)
+    old = layout['sections'] if layout else []
+    lengths = layout['lengths'] if layout else []
+    starts, owner = [], [] # First block of each old section; section of each old block
+    for j, entry in enumerate(old):
+        starts.append(len(owner))
+        owner.extend([j] * entry['blocks'])
+    position = {ref: p for p, ref in enumerate(refs) if isinstance(ref, int)}
+
+    kept = set()
+    for j, entry in enumerate(old):
+        first = position.get(starts[j])
+        if first is not None and all(position.get(starts[j] + k) == first + k for k in range(1, entry['blocks'])):
+            kept.add(j)
+
+    def kept_at(p):
+        ref = refs[p]
+        return owner[ref] if isinstance(ref, int) and owner[ref] in kept and starts[owner[ref]] == ref else None
+
+    # Blocks inserted between two kept sections that were next to each other
+    # join the one before them (or the first section, at the start)
+    before, p = None, 0
+    while p < len(refs):
+        j = kept_at(p)
+        if j is not None:
+            before, p = j, p + old[j]['blocks']
+            continue
+        while p < len(refs) and kept_at(p) is None:
+            p += 1
+        after = kept_at(p) if p < len(refs) else None
+        before_end = starts[before] + old[before]['blocks'] if before is not None else 0
+        if before_end == (starts[after] if after is not None else len(owner)):
+            kept.discard(before if before is not None else after)
+
+    loaded = {}
+    def block(ref):
+        if isinstance(ref, str):
+            return ref
+        j = owner[ref]
+        if j not in loaded:
+            loaded[j] = _split(_read_section(path, old[j]['id']), lengths[starts[j]:starts[j] + old[j]['blocks']])
+        return loaded[j][ref - starts[j]]
+
+    sections, texts, p = [], {}, 0
+    while p < len(refs):
+        j = kept_at(p)
+        if j is not None:
+            sections.append(old[j])
+            p += old[j]['blocks']
+            continue
+        run = []
+        while p < len(refs) and kept_at(p) is None:
+            run.append(refs[p])
+            p += 1
+        groups = build_sections([block(ref) for ref in run])
+        j = kept_at(p) if p < len(refs) else None
+        if j is not None and not old[j]['level'] and groups[-1][0]['bytes'] + old[j]['bytes'] <= max_bytes:
+            run.extend(refs[p:p + old[j]['blocks']])
+            p += old[j]['blocks']
+            groups = build_sections([block(ref) for ref in run])
+        for entry, text in groups:
+            sections.append(entry)
+            texts[entry['id']] = text
+
+    new_layout = {
+        'version': version,
+        'lengths': [lengths[ref] if isinstance(ref, int) else len(ref) for ref in refs],
+        'sections': sections,
+        'size': sum(entry['bytes'] for entry in sections),
+        'body_version': layout.get('body_version') if layout else None,
+        'bytes': layout.get('bytes') if layout else None,
+    }
+    if keep_body:
+        body_path, _ = _stored(path)
+        new_layout.update(body_version=version, bytes=os.path.getsize(body_path) if body_path else None)
+    _commit(path, new_layout, texts)
+    return new_layout
+
+
+def _commit(path, layout, texts):
+    """
+    Writes the files of new sections (`texts`: id -> text), records the
+    version in the history, then replaces the layout and drops the journal,
+    the outdated body and the files of sections no longer in it. A crash in
+    between leaves the old layout with all its files, or the new one with
+    some stray files.
+    """
+    codec = storage_codec()
+    for section_id, text in texts.items():
+        if _stored(_section_path(path, section_id))[0] is None:
+            _write_body(_section_path(path, section_id), text, codec)
+    starts = [0]
+    for entry in layout['sections']:
+        starts.append(starts[-1] + entry['blocks'])
+
+    def section_blocks(index):
+        section_id = layout['sections'][index]['id']
+        text = texts[section_id] if section_id in texts else _read_section(path, section_id)
+        return _split(text, layout['lengths'][starts[index]:starts[index + 1]])
+    note_history.record(path, layout['sections'], layout['version'], section_blocks)
+    _write_layout(path, layout)
+    try:
+        os.remove(_journal_path(path))
+    except FileNotFoundError:
+        pass
+    if layout['body_version'] != layout['version']: # Rebuilt when next needed
+        for suffix in CODECS.values():
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    keep = {entry['id'] for entry in layout['sections']}
+    for section_path in _section_files(path):
+        if os.path.basename(section_path).split('.')[0] not in keep:
+            os.remove(section_path)
+
+
+def _write_body_of(path, layout, codec=None):
+    """Rebuilds the body file from the sections, marks it current and returns (body path, codec)."""
+    codec = codec or storage_codec()
+    body_path, _ = _write_body(path, ''.join(_read_section(path, entry['id']) for entry in layout['sections']), codec)
+    layout.update(body_version=layout['version'], bytes=os.path.getsize(body_path))
+    _write_layout(path, layout)
+    return body_path, codec
+
+
+def _compact(path):
+    _flush(path)
+    if not os.path.exists(_journal_path(path)):
+        return
+    layout = _read_layout(path)
+    entries = _journal(path, layout)
+    if not entries:
+        os.remove(_journal_path(path))
+        return
+    refs = list(range(len(layout['lengths']))) if layout else []
+    for entry in entries:
+        _apply_ops(refs, entry['ops'])
+    _rebuild(path, layout, refs, entries[-1]['version'])
+
+
+def _write_behind_seconds():
+    return getattr(settings, 'NOTE_WRITE_BEHIND_SECONDS', 0)
+
+
+def _pending_blocks(path):
+    """(version, blocks) of the note with any pending saves."""
+    if path in _pending:
+        return _pending[path]['version'], _pending[path]['blocks']
+    return _load(path)
+
+
+def _defer(path, base, version, blocks, on_flush):
+    """
+    Keeps the note's latest blocks for the write-behind window (the caller
+    holds the lock). `base` is the stored (version, blocks) a new window
+    starts from.
+    """
+    entry = _pending.get(path)
+    if entry is None:
+        timer = threading.Timer(_write_behind_seconds(), _flush_later, [path])
+        timer.daemon = True
+        entry = _pending[path] = {'timer': timer, 'base': base}
+        timer.start()
+    entry.update(version=version, blocks=blocks, on_flush=on_flush or entry.get('on_flush'))
+    return version
+
+
+def _flush(path):
+    """Journals the note's pending blocks, if any, as one delta (the caller holds the lock)."""
+    entry = _pending.pop(path, None)
+    if entry is None:
+        return
+    entry['timer'].cancel()
+    base_version, base_blocks = entry['base']
+    current, count, entries, size = _state(path)
+    new_version = entry['version']
+    if current == base_version:
+        op = _diff(base_blocks, entry['blocks'])
+    else:
+        logger.warning("Note %s was written by another process during its write-behind window; "
+                       "replacing it (NOTE_WRITE_BEHIND_SECONDS needs a single process)", path)
+        op, new_version = [0, count, entry['blocks']], max(new_version, current + 1)
+    _append_journal(path, new_version, [op], entries, size)
+    if entry['on_flush']:
+        entry['on_flush'](''.join(entry['blocks']))
+
+
+def _flush_later(path):
+    try:
+        with _lock(path):
+            _flush(path)
+    except Exception:
+        logger.exception("Writing note %s failed", path)
+    finally:
+        connections.close_all() # on_flush may have opened this thread's connections
+
+
+def flush_all():
+    """Journals every pending note now. Registered to run at shutdown."""
+    for path in list(_pending):
+        with _lock(path):
+            _flush(path)
+
+
+def _append_journal(path, version, ops, entries, size):
+    """
+    Appends a journal entry and folds the journal once it is due. `entries`
+    and `size` are the unfolded entries and the note size from _state().
+    """
+    line = json.dumps({'version': version, 'ops': ops}) + '\n'
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(_journal_path(path), 'a', encoding='utf-8') as f:
+        f.write(line)
+        if _fsync_enabled():
+            f.flush()
+            os.fsync(f.fileno())
+
+    max_entries = getattr(settings, 'NOTE_JOURNAL_MAX_ENTRIES', 100)
+    if len(entries) + 1 >= max_entries or os.path.getsize(_journal_path(path)) > size:
+        _compact(path)
+
+
+def version(path):
+    with _lock(path):
+        if path in _pending:
+            return _pending[path]['version']
+        return _state(path)[0]
+
+
+def write_full(path, blocks, on_flush=None):
+    """
+    Replaces the note with the given blocks (a full save) and drops the
+    journal; only the sections that differ are written. Returns the new
+    version. `on_flush(content)` is called once the blocks are written, which
+    may be later (see NOTE_WRITE_BEHIND_SECONDS).
+    """
+    with _lock(path):
+        if _write_behind_seconds() > 0:
+            current, stored = _pending_blocks(path)
+            return _defer(path, (current, stored), current + 1, list(blocks), on_flush)
+        _flush(path)
+        layout = _read_layout(path) # The journal is replaced along with it
+        new_version = _journal_version(path, layout['version'] if layout else 0) + 1
+        _rebuild(path, layout, _refs(path, layout, blocks), new_version)
+        if on_flush:
+            on_flush(''.join(blocks))
+        return new_version
+
+
+def append_delta(path, base_version, ops, on_flush=None):
+    """
+    Journals a delta made against `base_version` and returns the new version.
+    Raises DeltaConflict when the note has moved on since, and ValueError for
+    malformed ops. With write-behind the delta is applied to the pending
+    blocks instead; `on_flush` is as for write_full, and gets None when the
+    delta was journaled.
+    """
+    with _lock(path):
+        if _write_behind_seconds() > 0:
+            current, blocks = _pending_blocks(path)
+            if base_version != current:
+                raise DeltaConflict(current)
+            _validate_ops(ops, len(blocks))
+            if not ops:
+                return current
+            updated = list(blocks)
+            _apply_ops(updated, ops)
+            return _defer(path, (current, blocks), current + 1, updated, on_flush)
+
+        _flush(path)
+        current, count, entries, size = _state(path)
+        if base_version != current:
+            raise DeltaConflict(current)
+        _validate_ops(ops, count)
+        if not ops:
+            return current
+
+        _append_journal(path, current + 1, ops, entries, size)
+        if on_flush:
+            on_flush(None)
+        return current + 1
+
+
+def read(path):
+    """Folds any pending journal into the sections and returns the content, or None if there is no note."""
+    with _lock(path):
+        if path in _pending:
+            return ''.join(_pending[path]['blocks'])
+        _compact(path)
+        layout = _read_layout(path)
+        return None if layout is None else _content(path, layout)
+
+
+def compact(path):
+    with _lock(path):
+        _compact(path)
+
+
+def stored_body(path):
+    """
+    Folds any pending journal into the sections and returns (body file,
+    codec, decompressed size, os.fstat of the file), so the stored bytes can
+    be served as they are. The body is rebuilt first when it is older than
+    the note. It is opened under the lock, like open_range's sections, so a
+    save in the meantime does not pull it from under the response; the
+    caller closes it. (None, None, 0, None) without a note.
+    """
+    with _lock(path):
+        _compact(path)
+        layout = _read_layout(path)
+        if layout is None:
+            return None, None, 0, None
+        if _body_current(path, layout):
+            body_path, codec = _stored(path)
+        else:
+            body_path, codec = _write_body_of(path, layout)
+        f = open(body_path, 'rb')
+        return f, codec, layout['size'], os.fstat(f.fileno())
+
+
+def iter_decompressed(body, codec, start=0, length=None, chunk_size=READ_CHUNK_SIZE):
+    """
+    Returns an iterator over `length` bytes (all by default) of the
+    decompressed content of an open body file from `start` on, in chunks.
+    The file is closed with the iterator.
+    """
+    def chunks():
+        try:
+            with _open_body(body, codec) as f:
+                if start:
+                    f.seek(start)
+                remaining = length
+                while remaining is None or remaining > 0:
+                    chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                    if not chunk:
+                        break
+                    if remaining is not None:
+                        remaining -= len(chunk)
+                    yield chunk
+        finally:
+            body.close()
+    return _ClosingIterator(chunks(), [body])
+
+
+def _section_files(path):
+    directory = _sections_dir(path)
+    return [os.path.join(directory, name) for name in os.listdir(directory)] if os.path.isdir(directory) else []
+
+
+class _ClosingIterator:
+    """
+    Iterates `chunks` and closes `files` on close(), also before the first
+    chunk: a response that is never read is only closed, and closing a
+    generator that has not started does not run its cleanup.
+    """
+    def __init__(self, chunks, files):
+        self.chunks, self.files = chunks, files
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.chunks)
+
+    def close(self):
+        self.chunks.close()
+        for f in self.files:
+            f.close()
+
+
+def _read_parts(parts):
+    """Yields the (file, skip, count) parts in order, closing every file when done."""
+    try:
+        for f, skip, count in parts:
+            if skip:
+                f.seek(skip)
+            while count > 0:
+                chunk = f.read(min(READ_CHUNK_SIZE, count))
+                if not chunk:
+                    break
+                count -= len(chunk)
+                yield chunk
+    finally:
+        for f, _, _ in parts:
+            f.close()
+
+
+def open_range(path, start, length):
+    """
+    Returns an iterator over `length` bytes of the note's decompressed content
+    from `start` on. The section index doubles as an offset index: only the
+    section files covering the range are opened and decompressed, so loading a
+    note range by range costs about its size in total instead of decompressing
+    from the start for every range.
+    The files are opened before returning, so a save in the meantime does not
+    pull them from under the response.
+    """
+    with _lock(path):
+        _compact(path)
+        layout = _read_layout(path)
+        if layout is None:
+            return iter(())
+
+        plan, offset, end = [], 0, start + length
+        for entry in layout['sections']:
+            section_end = offset + entry['bytes']
+            if section_end > start and offset < end:
+                section_path, section_codec = _stored(_section_path(path, entry['id']))
+                plan.append((section_path, section_codec, max(start - offset, 0),
+                             min(end, section_end) - max(start, offset)))
+            offset = section_end
+            if offset >= end:
+                break
+        parts = [(_open_body(section_path, section_codec), skip, count)
+                 for section_path, section_codec, skip, count in plan]
+        return _ClosingIterator(_read_parts(parts), [f for f, _, _ in parts])
+
+
+def recompress(path, codec=None):
+    """
+    Rewrites the note's section files and body with `codec`
+    (storage_codec() by default), keeping its version and block layout.
+    Returns (old size, new size) in bytes, or None when there is no note or
+    everything is already stored that way.
+    """
+    codec = codec or storage_codec()
+    with _lock(path):
+        _compact(path)
+        layout = _read_layout(path)
+        if layout is None:
+            return None
+        body_path, current = _stored(path)
+        sections = _section_files(path)
+        if (current == codec and _body_current(path, layout)
+                and all(section.endswith('.part' + CODECS[codec]) for section in sections)):
+            return None
+        old_size = (os.path.getsize(body_path) if body_path else 0) + sum(os.path.getsize(section) for section in sections)
+        for entry in layout['sections']:
+            if _stored(_section_path(path, entry['id']))[1] != codec:
+                _write_body(_section_path(path, entry['id']), _read_section(path, entry['id']), codec)
+        body_path, _ = _write_body_of(path, layout, codec)
+        return old_size, os.path.getsize(body_path) + sum(os.path.getsize(section) for section in _section_files(path))
+
+
+def outline(path):
+    """
+    Folds any pending journal into the sections and returns (version,
+    sections). Notes written before sections existed are split and indexed
+    on first use (see _read_layout).
+    """
+    with _lock(path):
+        _compact(path)
+        layout = _read_layout(path)
+        return (layout['version'], layout['sections']) if layout else (0, [])
+
+
+def section_body(path, section_id):
+    """
+    (open file, codec, decompressed size) of a section in the current index,
+    or (None, None, 0). Opened under the lock, as in stored_body; the caller
+    closes it.
+    """
+    with _lock(path):
+        _flush(path)
+        layout = _read_layout(path)
+        for entry in layout['sections'] if layout else []:
+            if entry['id'] == section_id:
+                body_path, codec = _stored(_section_path(path, section_id))
+                return (open(body_path, 'rb'), codec, entry['bytes']) if body_path else (None, None, 0)
+        return None, None, 0
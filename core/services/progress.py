@@ -0,0 +1,254 @@
+from django.db import models, transaction
+from django.db.models.functions import Greatest
+from core.models import Exam, Subject, Video, VideoChunk, UserProfile
+
+COUNTER_FIELDS = ('total_items', 'watched_items', 'total_seconds', 'watched_seconds')
+
+
+def empty_stats():
+    return dict.fromkeys(COUNTER_FIELDS, 0)
+
+
+def counter_updates(deltas):
+    updates = {}
+    for field, delta in deltas.items():
+        if not delta:
+            continue
+        if delta > 0:
+            updates[field] = models.F(field) + delta
+        else:
+            # Counters are unsigned; never let drift push them below zero
+            updates[field] = Greatest(models.F(field) + delta, 0)
+    return updates
+
+
+def save_profile(profile):
+    """
+    Saves a UserProfile without writing progress_version. That is only changed
+    by the F() updates below; a full save from a stale instance would roll it
+    back and make old analytics cache keys valid again.
+    """
+    if profile.pk is None:
+        profile.save()
+        return
+    profile.save(update_fields=[
+        f.name for f in profile._meta.concrete_fields
+        if not f.primary_key and f.name != 'progress_version'
+    ])
+
+
+def bump_progress_version(user):
+    """Invalidates the user's cached analytics (see core.services.analytics)."""
+    UserProfile.objects.filter(user=user).update(progress_version=models.F('progress_version') + 1)
+
+
+def _bump_exam_owner(exam_id):
+    UserProfile.objects.filter(user__exams=exam_id).update(progress_version=models.F('progress_version') + 1)
+
+
+def apply_delta(subject, **deltas):
+    """
+    Atomically adds the given deltas to the subject's and its exam's counters.
+    Keyword arguments are any of COUNTER_FIELDS, e.g. watched_items=1.
+    """
+    updates = counter_updates(deltas)
+    if not updates:
+        return
+    Subject.objects.filter(pk=subject.pk).update(**updates)
+    Exam.objects.filter(pk=subject.exam_id).update(**updates)
+    _bump_exam_owner(subject.exam_id)
+
+
+def video_stats(video, chunks=None):
+    """
+    Counter contribution of a single video. Whole videos are one item,
+    chunked videos contribute one item per chunk.
+    """
+    stats = empty_stats()
+    if video.is_chunked:
+        if chunks is None:
+            chunks = video.chunks.all()
+        for chunk in chunks:
+            duration = chunk.end_seconds - chunk.start_seconds
+            stats['total_items'] += 1
+            stats['total_seconds'] += duration
+            if chunk.is_watched:
+                stats['watched_items'] += 1
+                stats['watched_seconds'] += duration
+    else:
+        stats['total_items'] = 1
+        stats['total_seconds'] = video.duration_seconds
+        if video.is_watched:
+            stats['watched_items'] = 1
+            stats['watched_seconds'] = video.duration_seconds
+    return stats
+
+
+def add_videos(subject, videos):
+    """Adds the counters of newly created videos to their subject and exam."""
+    totals = empty_stats()
+    for video in videos:
+        for field, value in video_stats(video).items():
+            totals[field] += value
+    apply_delta(subject, **totals)
+
+
+def set_video_watched(video, is_watched):
+    """
+    Flips the watched flag of a whole video and updates the counters.
+    Returns True if the state actually changed.
+    """
+    with transaction.atomic():
+        changed = Video.objects.filter(
+            pk=video.pk, is_watched=not is_watched
+        ).update(is_watched=is_watched)
+        video.is_watched = is_watched
+        # Chunked videos are tracked per chunk, not by the video flag
+        if changed and not video.is_chunked:
+            sign = 1 if is_watched else -1
+            apply_delta(
+                video.subject,
+                watched_items=sign,
+                watched_seconds=sign * video.duration_seconds
+            )
+    return bool(changed)
+
+
+def set_chunk_watched(chunk, is_watched):
+    """
+    Flips the watched flag of a chunk and updates the counters.
+    Returns True if the state actually changed.
+    """
+    with transaction.atomic():
+        changed = VideoChunk.objects.filter(
+            pk=chunk.pk, is_watched=not is_watched
+        ).update(is_watched=is_watched)
+        chunk.is_watched = is_watched
+        if changed:
+            sign = 1 if is_watched else -1
+            apply_delta(
+                chunk.video.subject,
+                watched_items=sign,
+                watched_seconds=sign * (chunk.end_seconds - chunk.start_seconds)
+            )
+    return bool(changed)
+
+
+def live_totals(subject):
+    """
+    Running totals of a subject and its exam for the live analytics payload of
+    the toggle endpoints. A single query, however many exams the user has.
+    """
+    row = Subject.objects.filter(pk=subject.pk).values(
+        *COUNTER_FIELDS, exam_name=models.F('exam__name'),
+        exam_watched_seconds=models.F('exam__watched_seconds')
+    ).get()
+    return {
+        'analytics': {row['exam_name']: round(row['exam_watched_seconds'] / 3600, 1)},
+        'subject': {
+            'completed': row['watched_items'],
+            'total': row['total_items'],
+            'watched_hours': "{:.2f}".format(row['watched_seconds'] / 3600),
+            'left_hours': "{:.2f}".format(max(0, row['total_seconds'] - row['watched_seconds']) / 3600),
+            'progress': (row['watched_items'] / row['total_items'] * 360) if row['total_items'] > 0 else 0,
+        },
+    }
+
+
+def delete_subject(subject):
+    """Deletes a subject and takes its counters off the parent exam."""
+    with transaction.atomic():
+        subject.refresh_from_db(fields=COUNTER_FIELDS)
+        updates = counter_updates({f: -getattr(subject, f) for f in COUNTER_FIELDS})
+        if updates:
+            Exam.objects.filter(pk=subject.exam_id).update(**updates)
+        _bump_exam_owner(subject.exam_id)
+        subject.delete()
+
+
+def delete_subject_videos(subject):
+    """Deletes every video of a subject and resets its counters. Returns the delete count."""
+    with transaction.atomic():
+        subject.refresh_from_db(fields=COUNTER_FIELDS)
+        count, _ = subject.videos.all().delete()
+        apply_delta(subject, **{f: -getattr(subject, f) for f in COUNTER_FIELDS})
+    return count
+
+
+def compute_subject_progress(subjects):
+    """
+    Recomputes counters from raw rows for the given Subject queryset.
+    Returns {subject_id: stats}. Two grouped queries regardless of size.
+    """
+    progress = {subject_id: empty_stats() for subject_id in subjects.values_list('id', flat=True)}
+
+    video_rows = Video.objects.filter(
+        subject__in=subjects, is_chunked=False
+    ).values('subject_id').annotate(
+        total_items=models.Count('id'),
+        watched_items=models.Count('id', filter=models.Q(is_watched=True)),
+        total_seconds=models.Sum('duration_seconds'),
+        watched_seconds=models.Sum('duration_seconds', filter=models.Q(is_watched=True)),
+    )
+
+    duration = models.F('end_seconds') - models.F('start_seconds')
+    chunk_rows = VideoChunk.objects.filter(
+        video__subject__in=subjects, video__is_chunked=True
+    ).values(subject_id=models.F('video__subject_id')).annotate(
+        total_items=models.Count('id'),
+        watched_items=models.Count('id', filter=models.Q(is_watched=True)),
+        total_seconds=models.Sum(duration),
+        watched_seconds=models.Sum(duration, filter=models.Q(is_watched=True)),
+    )
+
+    for rows in (video_rows, chunk_rows):
+        for row in rows:
+            stats = progress.setdefault(row['subject_id'], empty_stats())
+            for field in COUNTER_FIELDS:
+                stats[field] += row[field] or 0
+
+    return progress
+
+
+def rebuild_progress(exams=None, commit=True):
+    """
+    Recomputes the counters of the given exams (all exams by default) and
+    writes them back when commit is True.
+    Returns a list of (obj, stored, expected) tuples for every drifted row.
+    """
+    if exams is None:
+        exams = Exam.objects.all()
+    subjects = Subject.objects.filter(exam__in=exams)
+    expected = compute_subject_progress(subjects)
+
+    drifted = []
+    exam_expected = {}
+    changed_subjects = []
+    for subject in subjects.only('id', 'exam_id', *COUNTER_FIELDS):
+        stats = expected.get(subject.id, empty_stats())
+        exam_stats = exam_expected.setdefault(subject.exam_id, empty_stats())
+        for field in COUNTER_FIELDS:
+            exam_stats[field] += stats[field]
+        stored = {f: getattr(subject, f) for f in COUNTER_FIELDS}
+        if stored != stats:
+            drifted.append((subject, stored, stats))
+            for field, value in stats.items():
+                setattr(subject, field, value)
+            changed_subjects.append(subject)
+
+    changed_exams = []
+    for exam in exams.only('id', *COUNTER_FIELDS):
+        stats = exam_expected.get(exam.id, empty_stats())
+        stored = {f: getattr(exam, f) for f in COUNTER_FIELDS}
+        if stored != stats:
+            drifted.append((exam, stored, stats))
+            for field, value in stats.items():
+                setattr(exam, field, value)
+            changed_exams.append(exam)
+
+    if commit:
+        with transaction.atomic():
+            Subject.objects.bulk_update(changed_subjects, COUNTER_FIELDS, batch_size=500)
+            Exam.objects.bulk_update(changed_exams, COUNTER_FIELDS, batch_size=500)
+
+    return drifted
@@ -0,0 +1,165 @@
+import datetime
+import hashlib
+import threading
+import time
+from zoneinfo import ZoneInfo
+from django.conf import settings
+from django.db import connection, models, transaction, IntegrityError
+from core.models import ApiKeyQuota
+
+# Google resets YouTube Data API quotas at midnight Pacific time
+QUOTA_TZ = ZoneInfo('America/Los_Angeles')
+
+# Units per call (https://developers.google.com/youtube/v3/determine_quota_cost)
+ENDPOINT_COSTS = {
+    'playlistItems': 1,
+    'videos': 1,
+    'search': 100,
+}
+
+
+class QuotaExceeded(Exception):
+    """The key's daily quota is used up. The message says when it is reset."""
+    def __init__(self, message=None):
+        super().__init__(message or f"YouTube API quota exceeded, retry after {reset_at():%Y-%m-%d %H:%M %Z}")
+
+
+def key_hash(api_key):
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+def quota_day():
+    return datetime.datetime.now(QUOTA_TZ).date()
+
+
+def reset_at():
+    """When today's quota is reset: the next midnight Pacific time."""
+    return datetime.datetime.combine(quota_day() + datetime.timedelta(days=1), datetime.time(), QUOTA_TZ)
+
+
+class _KeyBudget:
+    """
+    In-process state of one key: a token bucket for the request rate and the
+    units spent today. Units are counted in memory by whichever thread makes the
+    call and written to ApiKeyQuota by sync(), so pooled fetch threads do not
+    open database connections of their own. The day's total is read once per
+    day, by load() on the calling thread or by the first acquire() of the day.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.day = None
+        self.used = 0 # As last read from the database
+        self.pending = 0 # Spent since the last sync
+        self.tokens = None
+        self.refilled_at = time.monotonic()
+
+    def take_token(self, rate, burst):
+        """Returns how long the caller must wait before its request may start."""
+        with self.lock:
+            now = time.monotonic()
+            if self.tokens is None:
+                self.tokens = burst
+            self.tokens = min(burst, self.tokens + (now - self.refilled_at) * rate)
+            self.refilled_at = now
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / rate
+
+
+_budgets = {}
+_budgets_lock = threading.Lock()
+
+
+def _budget(api_key):
+    with _budgets_lock:
+        return _budgets.setdefault(key_hash(api_key), _KeyBudget())
+
+
+def _load_day(api_key, budget):
+    """
+    Starts a new quota day from the units ApiKeyQuota already holds for it, so a
+    fresh process does not spend what other processes used. Called with
+    budget.lock held.
+    """
+    today = quota_day()
+    if budget.day == today:
+        return
+    # A pooled thread that has to read the total closes its connection again
+    opened = connection.connection is None
+    used = ApiKeyQuota.objects.filter(key_hash=key_hash(api_key), day=today).values_list('units_used', flat=True).first() or 0
+    if opened and not connection.in_atomic_block:
+        connection.close()
+    budget.day, budget.used, budget.pending = today, used, 0
+
+
+def load(api_key):
+    """Reads the key's units used today unless that was already done today."""
+    budget = _budget(api_key)
+    with budget.lock:
+        _load_day(api_key, budget)
+
+
+def acquire(api_key, endpoint):
+    """
+    Call before every YouTube request. Waits for a token from the key's bucket
+    (YOUTUBE_RATE_LIMIT requests per second, bursts of YOUTUBE_RATE_BURST) and
+    charges the endpoint's units. Raises QuotaExceeded when the estimated daily
+    usage would go over YOUTUBE_DAILY_QUOTA.
+    """
+    budget = _budget(api_key)
+    units = ENDPOINT_COSTS.get(endpoint, 1)
+    limit = getattr(settings, 'YOUTUBE_DAILY_QUOTA', 10000)
+
+    with budget.lock:
+        _load_day(api_key, budget)
+        if budget.used + budget.pending + units > limit:
+            raise QuotaExceeded()
+        budget.pending += units
+
+    rate = getattr(settings, 'YOUTUBE_RATE_LIMIT', 10)
+    wait = budget.take_token(rate, getattr(settings, 'YOUTUBE_RATE_BURST', rate))
+    if wait:
+        time.sleep(wait)
+
+
+def exhausted(api_key):
+    """
+    Records that the API answered quotaExceeded for the key: the rest of the
+    day's budget counts as spent, and the next sync() writes it to ApiKeyQuota
+    so other processes stop spending on the key too.
+    """
+    budget = _budget(api_key)
+    limit = getattr(settings, 'YOUTUBE_DAILY_QUOTA', 10000)
+    with budget.lock:
+        _load_day(api_key, budget)
+        budget.pending = max(budget.pending, limit - budget.used)
+
+
+def sync(api_key):
+    """
+    Writes the units spent since the last sync to ApiKeyQuota and reloads the
+    day's total (which includes other processes using the same key).
+    Returns the units used today.
+    """
+    budget = _budget(api_key)
+    hashed = key_hash(api_key)
+    with budget.lock:
+        day, pending = budget.day or quota_day(), budget.pending
+        budget.pending = 0
+
+    if pending:
+        lookup = {'key_hash': hashed, 'day': day}
+        if not ApiKeyQuota.objects.filter(**lookup).update(units_used=models.F('units_used') + pending):
+            try:
+                with transaction.atomic():
+                    ApiKeyQuota.objects.create(**lookup, units_used=pending)
+            except IntegrityError:
+                # Another process created today's row in the meantime
+                ApiKeyQuota.objects.filter(**lookup).update(units_used=models.F('units_used') + pending)
+
+    today = quota_day()
+    used = ApiKeyQuota.objects.filter(key_hash=hashed, day=today).values_list('units_used', flat=True).first() or 0
+    with budget.lock:
+        if budget.day != today:
+            budget.day, budget.pending = today, 0
+        budget.used = used
+    return used + budget.pending
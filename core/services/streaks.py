@@ -0,0 +1,138 @@
+import datetime
+from django.db import models, transaction
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from core.models import UserProfile, Streak, DailyGoal
+from core.services import history
+
+
+def record_goal_achieved(user_id, day):
+    """
+    Extends (or restarts) the user's streak for a goal met on `day`.
+    Calling it again for the same day is a no-op.
+    """
+    with transaction.atomic():
+        profile = UserProfile.objects.select_for_update().get(user_id=user_id)
+        if profile.last_goal_date == day:
+            return profile.current_streak
+
+        if profile.last_goal_date == day - datetime.timedelta(days=1):
+            current = profile.current_streak + 1
+        else:
+            current = 1
+
+        UserProfile.objects.filter(pk=profile.pk).update(current_streak=current, last_goal_date=day)
+        Streak.objects.get_or_create(user_id=user_id)
+        Streak.objects.filter(user_id=user_id).update(
+            current_streak=current,
+            best_streak=Greatest(models.F('best_streak'), current),
+            last_updated=day,
+        )
+    return current
+
+
+def add_goal_progress(daily_goal, seconds):
+    """
+    Adds `seconds` (negative to remove time) to a DailyGoal, marks it completed
+    the first time it is met and extends the streak. Also feeds the history rollups.
+    """
+    old_completed, old_achieved = daily_goal.completed_seconds, daily_goal.achieved
+    daily_goal.completed_seconds = max(0, daily_goal.completed_seconds + seconds)
+
+    goal_seconds = int(daily_goal.goal_hours * 3600)
+    if seconds > 0 and daily_goal.completed_seconds >= goal_seconds:
+        daily_goal.is_completed = True
+        if not daily_goal.achieved: # First time met today
+            daily_goal.achieved = True
+            record_goal_achieved(daily_goal.user_id, daily_goal.date)
+
+    daily_goal.save(update_fields=['completed_seconds', 'is_completed', 'achieved'])
+    history.record_goal_change(daily_goal, old_completed, old_achieved)
+
+
+def displayed_streak(user):
+    """
+    Read-only streak for the dashboard. A streak whose last goal is older than
+    yesterday is shown as 0 even if rollover_streaks has not reset it yet.
+    """
+    streak = Streak.objects.filter(user=user).first() or Streak(user=user)
+    last_goal_date = user.profile.last_goal_date
+    yesterday = timezone.localdate() - datetime.timedelta(days=1)
+    if last_goal_date is None or last_goal_date < yesterday:
+        streak.current_streak = 0
+    return streak
+
+
+def _streak_runs(dates, today):
+    """
+    Given a user's sorted achieved dates, returns (current, best, last_date).
+    The current run counts if it ends today or yesterday.
+    """
+    best = run = 0
+    previous = None
+    for day in dates:
+        if previous is not None and day == previous + datetime.timedelta(days=1):
+            run += 1
+        elif day != previous:
+            run = 1
+        best = max(best, run)
+        previous = day
+
+    if previous is None or previous < today - datetime.timedelta(days=1):
+        return 0, best, previous
+    return run, best, previous
+
+
+def rollover_streaks(today=None, chunk_size=1000):
+    """
+    Recomputes every user's streak from their DailyGoal history, chunk_size
+    users at a time, writing only rows that changed with grouped UPDATEs.
+    Idempotent: a second run on the same day changes nothing.
+    Returns the number of profiles updated.
+    """
+    if today is None:
+        today = timezone.localdate()
+
+    updated = 0
+    last_id = 0
+    while True:
+        profiles = list(
+            UserProfile.objects.filter(user_id__gt=last_id).order_by('user_id').values_list(
+                'user_id', 'current_streak', 'last_goal_date'
+            )[:chunk_size]
+        )
+        if not profiles:
+            break
+        last_id = profiles[-1][0]
+        user_ids = [p[0] for p in profiles]
+
+        achieved = {}
+        rows = DailyGoal.objects.filter(
+            user_id__in=user_ids, achieved=True, date__lte=today
+        ).order_by('user_id', 'date').values_list('user_id', 'date')
+        for user_id, day in rows.iterator(chunk_size=5000):
+            achieved.setdefault(user_id, []).append(day)
+
+        Streak.objects.bulk_create([Streak(user_id=user_id) for user_id in user_ids], ignore_conflicts=True)
+        streaks = dict(Streak.objects.filter(user_id__in=user_ids).values_list('user_id', 'best_streak'))
+
+        profile_groups = {}
+        streak_groups = {}
+        for user_id, stored_current, stored_last in profiles:
+            current, best, last_date = _streak_runs(achieved.get(user_id, []), today)
+            best = max(best, current, streaks.get(user_id, 0))
+            if (stored_current, stored_last) != (current, last_date):
+                profile_groups.setdefault((current, last_date), []).append(user_id)
+            streak_groups.setdefault((current, best), []).append(user_id)
+
+        with transaction.atomic():
+            for (current, last_date), ids in profile_groups.items():
+                updated += UserProfile.objects.filter(user_id__in=ids).update(
+                    current_streak=current, last_goal_date=last_date
+                )
+            for (current, best), ids in streak_groups.items():
+                Streak.objects.filter(user_id__in=ids).exclude(
+                    current_streak=current, best_streak=best
+                ).update(current_streak=current, best_streak=best, last_updated=today)
+
+    return updated
@@ -0,0 +1,66 @@
+import datetime
+from django.conf import settings
+from django.utils import timezone
+from core.models import YouTubeVideoCache, YouTubePlaylistCache
+
+LOOKUP_CHUNK = 500
+
+
+def _cutoff(setting, default):
+    return timezone.now() - datetime.timedelta(seconds=getattr(settings, setting, default))
+
+
+def cached_videos(video_ids):
+    """{video_id: {'title', 'duration'}} for the ids with a fresh cache row."""
+    video_ids = list(video_ids)
+    cutoff = _cutoff('YOUTUBE_VIDEO_CACHE_TTL', 7 * 24 * 3600)
+    found = {}
+    # Chunked to stay under the database's bound parameter limit
+    for start in range(0, len(video_ids), LOOKUP_CHUNK):
+        rows = YouTubeVideoCache.objects.filter(
+            video_id__in=video_ids[start:start + LOOKUP_CHUNK], fetched_at__gte=cutoff,
+        ).values_list('video_id', 'title', 'duration_seconds')
+        found.update({video_id: {'title': title, 'duration': duration} for video_id, title, duration in rows})
+    return found
+
+
+def store_videos(metadata):
+    """Upserts {video_id: {'title', 'duration'}} in one statement."""
+    if not metadata:
+        return
+    now = timezone.now()
+    YouTubeVideoCache.objects.bulk_create([
+        YouTubeVideoCache(video_id=video_id, title=data['title'][:255], duration_seconds=data['duration'], fetched_at=now)
+        for video_id, data in metadata.items()
+    ], update_conflicts=True, unique_fields=['video_id'], update_fields=['title', 'duration_seconds', 'fetched_at'],
+       batch_size=500)
+
+
+def get_playlist(playlist_id):
+    """Returns (entry, is_fresh); entry is None when the playlist was never cached."""
+    entry = YouTubePlaylistCache.objects.filter(playlist_id=playlist_id).first()
+    if entry is None:
+        return None, False
+    return entry, entry.fetched_at >= _cutoff('YOUTUBE_PLAYLIST_CACHE_TTL', 24 * 3600)
+
+
+def get_playlists(playlist_ids):
+    """{playlist_id: (entry, is_fresh)} for every requested id, in one query."""
+    cutoff = _cutoff('YOUTUBE_PLAYLIST_CACHE_TTL', 24 * 3600)
+    entries = YouTubePlaylistCache.objects.in_bulk(list(playlist_ids))
+    return {
+        playlist_id: (entries.get(playlist_id), playlist_id in entries and entries[playlist_id].fetched_at >= cutoff)
+        for playlist_id in playlist_ids
+    }
+
+
+def store_playlist(playlist_id, etag, video_ids):
+    YouTubePlaylistCache.objects.update_or_create(
+        playlist_id=playlist_id,
+        defaults={'etag': etag or '', 'video_ids': list(video_ids), 'fetched_at': timezone.now()},
+    )
+
+
+def touch_playlist(playlist_id):
+    """Marks a revalidated (304 Not Modified) playlist as fresh again."""
+    YouTubePlaylistCache.objects.filter(playlist_id=playlist_id).update(fetched_at=timezone.now())
@@ -0,0 +1,122 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+
+class QueryBudgetMixin:
+    """
+    TestCase mixin that fails a request when it runs more SQL queries than allowed.
+    QUERY_BUDGETS maps URL names from core/urls.py to their maximum query count.
+    """
+    QUERY_BUDGETS = {}
+
+    def assertWithinQueryBudget(self, url_name, method='get', args=None, **kwargs):
+        budget = self.QUERY_BUDGETS.get(url_name)
+        if budget is None:
+            self.fail(f"No query budget declared for '{url_name}'")
+
+        with CaptureQueriesContext(connection) as captured:
+            response = getattr(self.client, method)(reverse(url_name, args=args), **kwargs)
+
+        executed = len(captured.captured_queries)
+        if executed > budget:
+            queries = "\n".join(f"  {q['sql']}" for q in captured.captured_queries)
+            self.fail(f"'{url_name}' ran {executed} queries, budget is {budget}:\n{queries}")
+        return response
+
+
+class StubYouTubeServer:
+    """
+    Local HTTP server speaking just enough of the YouTube Data API
+    (playlistItems and videos, including If-None-Match on playlist pages)
+    for tests. Point settings.YOUTUBE_API_URL at .url.
+    playlists maps a playlist id to [(video_id, title, seconds), ...];
+    every handled request is appended to .requests as (endpoint, query dict).
+    """
+    PAGE_SIZE = 50
+
+    def __init__(self, playlists=None):
+        self.playlists = playlists or {}
+        self.requests = []
+        self.error = None # set to a dict to make every call fail with it
+        self.failures = [] # (status, body) answers used, in order, before normal responses
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def videos(self):
+        return {video_id: (title, seconds) for items in self.playlists.values() for video_id, title, seconds in items}
+
+    def playlist_etag(self, playlist_id):
+        return f'"{hash(tuple(self.playlists.get(playlist_id, [])))}"'
+
+    def playlist_items(self, query):
+        items = self.playlists.get(query.get('playlistId'), [])
+        offset = int(query.get('pageToken') or 0)
+        page = items[offset:offset + self.PAGE_SIZE]
+        data = {'etag': self.playlist_etag(query.get('playlistId')), 'items': [
+            {'snippet': {'title': title, 'resourceId': {'videoId': video_id}}} for video_id, title, _ in page
+        ]}
+        if offset + self.PAGE_SIZE < len(items):
+            data['nextPageToken'] = str(offset + self.PAGE_SIZE)
+        return data
+
+    def video_details(self, query):
+        known = self.videos()
+        return {'items': [
+            {
+                'id': video_id,
+                'snippet': {'title': known[video_id][0]},
+                'contentDetails': {'duration': f"PT{known[video_id][1]}S"},
+            }
+            for video_id in query.get('id', '').split(',') if video_id in known
+        ]}
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                endpoint = parsed.path.rsplit('/', 1)[-1]
+                query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+                stub.requests.append((endpoint, query))
+
+                etag = self.headers.get('If-None-Match')
+                if endpoint == 'playlistItems' and etag == stub.playlist_etag(query.get('playlistId')):
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+
+                status = 200
+                if stub.failures:
+                    status, data = stub.failures.pop(0)
+                elif stub.error:
+                    data = {'error': stub.error}
+                elif endpoint == 'playlistItems':
+                    data = stub.playlist_items(query)
+                else:
+                    data = stub.video_details(query)
+
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
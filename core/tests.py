@@ -1,3 +1,1540 @@
-from django.test import TestCase
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+from unittest import mock, skipUnless
+from django.contrib.auth.models import User
+from django.test import RequestFactory, TestCase, override_settings
+from django.core.cache import cache
+from django.db import IntegrityError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.urls import get_resolver, reverse
+from django.utils import timezone
+from .middleware import make_profile_token
+from .models import (
+    Exam, Subject, Video, VideoChunk, Note, YouTubeVideoCache, ImportJob, ApiKeyQuota,
+    DailyGoal, DailyStudyLog, StudyRollup, StudySession, Streak, UserProfile,
+)
+from .services import (
+    analytics, csv_importer, exam_archive, export, history, imports, note_history, note_search, note_store, progress,
+    quota, streaks,
+)
+from .services.benchmark import seed_dataset
+from .testing import QueryBudgetMixin, StubYouTubeServer
+from .utils import fetch_playlist_items, fetch_video_details, parse_duration, validate_api_key
+from .views import accepts_encoding
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), NOTE_WRITE_BEHIND_SECONDS=0)
+class QueryBudgetTests(QueryBudgetMixin, TestCase):
+    # Maximum queries per request (session, user and profile lookups included)
+    QUERY_BUDGETS = {
+        'dashboard': 6,
+        'exam_detail': 5,
+        'subject_detail': 12,
+        'analytics_dashboard': 6,
+        'analytics_subject': 6,
+        'get_analytics_data': 5,
+        'get_history': 4,
+        'get_today_goal': 4,
+        'common_note': 7,
+        'get_note_content': 5,
+        'get_common_note_content': 5,
+        'get_note_outline': 5,
+        'get_note_section': 5,
+        'note_versions': 5,
+        'common_note_versions': 5,
+        'search_notes': 7,
+        'update_video_status': 17,
+        'update_chunk_status': 17,
+        'save_note': 7,
+        'save_common_note': 10,
+        'restore_note_version': 7,
+        'restore_common_note_version': 10,
+        'save_focus_progress': 6,
+        'add_playlist': 6, # enqueues an ImportJob
+        'import_job_status': 4,
+    }
+
+    # Views without a budget: redirects, forms and external API calls
+    UNBUDGETED = {
+        'register', 'api_guide', 'save_api_key', 'setup_api_key', 'create_exam', 'add_video',
+        'set_daily_goal', 'delete_exam', 'delete_subject', 'delete_playlist', 'upload_csv_todo',
+        'set_global_goal', 'start_timer', 'stop_timer', 'resync_playlist', 'import_playlists',
+        'export_history', 'export_exam', # stream their queries after the view returns
+        'import_exam',
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_dataset(videos=40, days=14, chunked_ratio=0.2)[0]
+        cls.exam = Exam.objects.filter(user=cls.user).first()
+        cls.subject = Subject.objects.filter(exam=cls.exam).first()
+        cls.video = Video.objects.filter(subject=cls.subject, is_chunked=False).first()
+        cls.chunk = VideoChunk.objects.filter(video__subject__exam__user=cls.user).first()
+        cls.note = Note.objects.get(subject=cls.subject)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def test_every_core_url_has_a_budget(self):
+        core_names = {
+            name for name in get_resolver('core.urls').reverse_dict.keys() if isinstance(name, str)
+        }
+        missing = core_names - set(self.QUERY_BUDGETS) - self.UNBUDGETED
+        self.assertFalse(missing, f"Declare a query budget for: {sorted(missing)}")
+
+    def test_page_views(self):
+        self.assertWithinQueryBudget('dashboard')
+        self.assertWithinQueryBudget('exam_detail', args=[self.exam.id])
+        self.assertWithinQueryBudget('subject_detail', args=[self.subject.id])
+        self.assertWithinQueryBudget('common_note')
+
+    def test_analytics_views(self):
+        self.assertWithinQueryBudget('analytics_dashboard')
+        self.assertWithinQueryBudget('analytics_subject')
+        self.assertWithinQueryBudget('get_analytics_data')
+        self.assertWithinQueryBudget('get_history')
+        self.assertWithinQueryBudget('get_today_goal')
+
+    def test_toggle_views(self):
+        json_body = {'data': '{"is_watched": true}', 'content_type': 'application/json'}
+        self.assertWithinQueryBudget('update_video_status', 'post', args=[self.video.id], **json_body)
+        self.assertWithinQueryBudget('update_chunk_status', 'post', args=[self.chunk.id], **json_body)
+        self.assertWithinQueryBudget(
+            'save_focus_progress', 'post', data='{"seconds": 5}', content_type='application/json'
+        )
+
+    def test_note_views(self):
+        json_body = {'data': '{"content": "<p>x</p>"}', 'content_type': 'application/json'}
+        self.assertWithinQueryBudget('save_note', 'post', args=[self.note.id], **json_body)
+        self.assertWithinQueryBudget('get_note_content', args=[self.note.id])
+        self.assertWithinQueryBudget('save_common_note', 'post', **json_body)
+        self.assertWithinQueryBudget('get_common_note_content')
+        self.assertWithinQueryBudget('get_note_outline', args=[self.note.id])
+        section = self.client.get(reverse('get_note_outline', args=[self.note.id])).json()['sections'][0]
+        self.assertWithinQueryBudget('get_note_section', args=[self.note.id, section['id']])
+        self.assertWithinQueryBudget('note_versions', args=[self.note.id])
+        self.assertWithinQueryBudget('restore_note_version', 'post', args=[self.note.id, 1])
+        self.assertWithinQueryBudget('common_note_versions')
+        self.assertWithinQueryBudget('restore_common_note_version', 'post', args=[1])
+
+    def test_search(self):
+        self.assertWithinQueryBudget('search_notes', data={'q': 'lecture'})
+
+    def test_add_playlist(self):
+        self.assertWithinQueryBudget(
+            'add_playlist', 'post', args=[self.subject.id], data={'playlist_url': 'https://www.youtube.com/playlist?list=x'}
+        )
+        job = ImportJob.objects.get(subject=self.subject)
+        self.assertWithinQueryBudget('import_job_status', args=[job.id])
+
+
+class ProgressServiceTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_dataset(exams=1, subjects=2, videos=6, chunked_ratio=0.3, days=0, prefix='progress')[0]
+
+    def test_counters_match_rebuild_after_toggles(self):
+        exams = Exam.objects.filter(user=self.user)
+        self.assertEqual(progress.rebuild_progress(exams, commit=False), [])
+        videos = Video.objects.filter(subject__exam__user=self.user, is_chunked=False).select_related('subject')
+        chunks = VideoChunk.objects.filter(video__subject__exam__user=self.user).select_related('video__subject')
+        for i, video in enumerate(videos):
+            was_watched = video.is_watched
+            self.assertEqual(progress.set_video_watched(video, i % 2 == 0), was_watched != (i % 2 == 0))
+            self.assertFalse(progress.set_video_watched(video, i % 2 == 0)) # Repeats change nothing
+        for chunk in chunks:
+            progress.set_chunk_watched(chunk, not chunk.is_watched)
+        self.assertEqual(progress.rebuild_progress(exams, commit=False), [])
+
+        subject = Subject.objects.filter(exam__user=self.user).first()
+        progress.delete_subject_videos(subject)
+        subject.refresh_from_db()
+        self.assertEqual([getattr(subject, f) for f in progress.COUNTER_FIELDS], [0, 0, 0, 0])
+        self.assertEqual(progress.rebuild_progress(exams, commit=False), [])
+
+    def test_negative_deltas_stop_at_zero_and_rebuild_repairs_drift(self):
+        subject = Subject.objects.filter(exam__user=self.user).first()
+        progress.apply_delta(subject, watched_items=-10 ** 6, watched_seconds=-10 ** 9)
+        subject.refresh_from_db()
+        self.assertEqual((subject.watched_items, subject.watched_seconds), (0, 0))
+
+        drifted = progress.rebuild_progress(Exam.objects.filter(user=self.user))
+        self.assertEqual({type(obj) for obj, _, _ in drifted}, {Subject, Exam})
+        self.assertEqual(progress.rebuild_progress(Exam.objects.filter(user=self.user), commit=False), [])
+
+    def test_stale_profile_save_keeps_progress_version(self):
+        stale = UserProfile.objects.get(user=self.user)
+        progress.bump_progress_version(self.user)
+        stale.google_api_key = 'new-key'
+        progress.save_profile(stale)
+        profile = UserProfile.objects.get(user=self.user)
+        self.assertEqual(profile.google_api_key, 'new-key')
+        self.assertEqual(profile.progress_version, stale.progress_version + 1)
+
+        self.user.save() # Saves the user's cached profile through the post_save signal
+        self.assertEqual(UserProfile.objects.get(user=self.user).progress_version, stale.progress_version + 1)
+
+
+class AnalyticsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user, cls.other = seed_dataset(users=2, exams=2, subjects=3, videos=8, chunked_ratio=0.3, days=0, prefix='analytics')
+
+    def test_exam_breakdown_matches_watched_rows(self):
+        data = analytics.build_exam_analytics(self.user)
+        exams = list(Exam.objects.filter(user=self.user).order_by('id'))
+        self.assertEqual([e['goal_name'] for e in data], [exam.name for exam in exams])
+        for exam, entry in zip(exams, data):
+            per_subject = {}
+            for video in Video.objects.filter(subject__exam=exam, is_chunked=False, is_watched=True):
+                per_subject[video.subject.name] = per_subject.get(video.subject.name, 0) + video.duration_seconds
+            for chunk in VideoChunk.objects.filter(video__subject__exam=exam, is_watched=True).select_related('video__subject'):
+                name = chunk.video.subject.name
+                per_subject[name] = per_subject.get(name, 0) + chunk.end_seconds - chunk.start_seconds
+
+            self.assertEqual(entry['total_seconds'], sum(per_subject.values()))
+            self.assertEqual({s['name']: s['seconds'] for s in entry['subjects']}, per_subject)
+            seconds = [s['seconds'] for s in entry['subjects']]
+            self.assertEqual(seconds, sorted(seconds, reverse=True))
+            self.assertAlmostEqual(sum(s['percentage'] for s in entry['subjects']), 100, delta=0.5)
+
+    def test_data_endpoint_honours_etag(self):
+        self.client.force_login(self.user)
+        url = reverse('get_analytics_data')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        video = Video.objects.filter(subject__exam__user=self.user, is_chunked=False, is_watched=False).first()
+        progress.set_video_watched(video, True)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_cache_is_invalidated_by_progress_version_bump(self):
+        cache.clear()
+        before = analytics.get_exam_analytics(self.user)
+        subject = Subject.objects.filter(exam__user=self.user).first()
+        # A write that skips the progress service is not seen until the version moves
+        Subject.objects.filter(pk=subject.pk).update(watched_seconds=subject.watched_seconds + 3600)
+        self.assertEqual(analytics.get_exam_analytics(self.user), before)
+
+        progress.bump_progress_version(self.user)
+        after = analytics.get_exam_analytics(self.user)
+        self.assertEqual(after, analytics.build_exam_analytics(self.user))
+        self.assertNotEqual(after, before)
+
+
+class ToggleStatusTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_dataset(exams=1, subjects=1, videos=5, chunked_ratio=0, days=0, prefix='toggle')[0]
+        cls.video = Video.objects.filter(subject__exam__user=cls.user, is_watched=False).first()
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def toggle(self, is_watched):
+        return self.client.post(
+            reverse('update_video_status', args=[self.video.id]),
+            json.dumps({'is_watched': is_watched}), content_type='application/json',
+        ).json()
+
+    def test_repeated_toggle_books_time_once(self):
+        today = timezone.localdate()
+        DailyGoal.objects.create(user=self.user, date=today, goal_hours=10)
+        minutes = round(self.video.duration_seconds / 60, 1)
+        self.assertEqual(self.toggle(True)['today_minutes'], minutes)
+        repeated = self.toggle(True)
+        self.assertEqual(repeated['today_minutes'], minutes)
+        self.assertEqual(repeated['subject']['completed'], Subject.objects.get(id=self.video.subject_id).watched_items)
+        self.assertEqual(DailyGoal.objects.get(user=self.user).completed_seconds, self.video.duration_seconds)
+        self.assertEqual(
+            StudyRollup.objects.get(user=self.user, subject=self.video.subject_id, granularity='day').seconds_watched,
+            self.video.duration_seconds,
+        )
+
+        self.assertEqual(self.toggle(False)['today_minutes'], 0)
+        self.assertEqual(self.toggle(False)['today_minutes'], 0)
+        self.assertEqual(DailyGoal.objects.get(user=self.user).completed_seconds, 0)
+
+    def test_query_count_does_not_depend_on_history(self):
+        DailyGoal.objects.create(user=self.user, date=timezone.localdate(), goal_hours=10)
+        # Session, user, profile and video; the flag and counters; the log,
+        # rollups and goal with one INSERT OR IGNORE and one UPDATE per table;
+        # the running totals
+        with self.assertNumQueries(20):
+            self.toggle(True)
+        with self.assertNumQueries(19): # The log and rollup rows exist now
+            self.toggle(False)
+        with self.assertNumQueries(9): # Nothing changed, nothing to book
+            self.toggle(False)
+
+    def test_live_totals_match_subject_rows(self):
+        subject = self.video.subject
+        progress.set_video_watched(self.video, True)
+        with self.assertNumQueries(1):
+            totals = progress.live_totals(subject)
+
+        videos = Video.objects.filter(subject=subject)
+        watched = [v.duration_seconds for v in videos if v.is_watched]
+        total = sum(v.duration_seconds for v in videos)
+        self.assertEqual(totals['subject'], {
+            'completed': len(watched),
+            'total': len(videos),
+            'watched_hours': "{:.2f}".format(sum(watched) / 3600),
+            'left_hours': "{:.2f}".format((total - sum(watched)) / 3600),
+            'progress': len(watched) / len(videos) * 360,
+        })
+        self.assertEqual(totals['analytics'], {subject.exam.name: round(sum(watched) / 3600, 1)})
+        self.assertEqual(self.toggle(True)['subject'], totals['subject'])
+
+
+class HistoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_dataset(exams=1, subjects=2, videos=6, days=45, prefix='history')[0]
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def expected(self, granularity, start, end):
+        totals = {}
+        for day, seconds in DailyStudyLog.objects.filter(user=self.user).values_list('date', 'seconds_watched'):
+            bucket = history.period_start(day, granularity)
+            if history.period_start(start, granularity) <= bucket <= end:
+                totals[bucket.isoformat()] = totals.get(bucket.isoformat(), 0) + seconds
+        return {date: seconds for date, seconds in totals.items() if seconds}
+
+    def watched(self, rows):
+        return {row['date']: row['seconds_watched'] for row in rows if row['seconds_watched']}
+
+    def test_rollups_match_logs_for_every_granularity(self):
+        today = timezone.localdate()
+        start = today - datetime.timedelta(days=60)
+        for granularity in history.GRANULARITIES:
+            rows = history.get_history(self.user, start, today, granularity)
+            self.assertEqual(self.watched(rows), self.expected(granularity, start, today), granularity)
+
+        subject = Subject.objects.filter(exam__user=self.user).first()
+        history.record_watch(self.user, subject, today, 600)
+        history.record_watch(self.user, subject, today, -10 ** 6) # Clamped to what was booked
+        history.record_watch(self.user, subject, today, 300)
+        for granularity in history.GRANULARITIES:
+            rows = history.get_history(self.user, start, today, granularity)
+            self.assertEqual(self.watched(rows), self.expected(granularity, start, today), granularity)
+        rebuilt = {g: history.get_history(self.user, start, today, g) for g in history.GRANULARITIES}
+        history.rebuild_history(self.user)
+        self.assertEqual({g: history.get_history(self.user, start, today, g) for g in history.GRANULARITIES}, rebuilt)
+
+    def test_api_returns_buckets_in_range(self):
+        today = timezone.localdate()
+        start, end = today - datetime.timedelta(days=30), today - datetime.timedelta(days=10)
+        response = self.client.get(reverse('get_history'), {
+            'from': start.isoformat(), 'to': end.isoformat(), 'granularity': 'week',
+        }).json()
+        self.assertEqual((response['from'], response['to']), (start.isoformat(), end.isoformat()))
+        dates = [row['date'] for row in response['data']]
+        self.assertEqual(dates, sorted(dates))
+        self.assertGreaterEqual(dates[0], history.period_start(start, 'week').isoformat())
+        self.assertLessEqual(dates[-1], end.isoformat())
+        self.assertEqual(self.watched(response['data']), self.expected('week', start, end))
+
+        subject = Subject.objects.filter(exam__user=self.user).first()
+        response = self.client.get(reverse('get_history'), {'subject': subject.id, 'granularity': 'month'}).json()
+        self.assertEqual(
+            sum(row['seconds_watched'] for row in response['data']),
+            sum(DailyStudyLog.objects.filter(subject=subject).values_list('seconds_watched', flat=True)),
+        )
+
+    def test_api_rejects_bad_params(self):
+        url = reverse('get_history')
+        self.assertEqual(self.client.get(url, {'granularity': 'year'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'from': '2024-02-01', 'to': '2024-01-01'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'subject': 'x'}).status_code, 400)
+
+
+class RolloverStreakTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = seed_dataset(users=3, exams=1, subjects=1, videos=1, days=0, prefix='streak')
+        today = timezone.localdate()
+        offsets = {cls.users[0]: [1, 2, 3], cls.users[1]: [5, 6, 7, 9], cls.users[2]: []}
+        DailyGoal.objects.bulk_create([
+            DailyGoal(user=user, date=today - datetime.timedelta(days=offset), goal_hours=1,
+                      completed_seconds=3600, is_completed=True, achieved=True)
+            for user, days in offsets.items() for offset in days
+        ])
+
+    def state(self):
+        return (
+            list(UserProfile.objects.order_by('user_id').values_list('user_id', 'current_streak', 'last_goal_date')),
+            list(Streak.objects.order_by('user_id').values_list('user_id', 'current_streak', 'best_streak', 'last_updated')),
+        )
+
+    def test_second_run_changes_nothing(self):
+        today = timezone.localdate()
+        self.assertEqual(streaks.rollover_streaks(today, chunk_size=2), 2)
+        streak_of = dict(Streak.objects.values_list('user__username', 'current_streak'))
+        best_of = dict(Streak.objects.values_list('user__username', 'best_streak'))
+        self.assertEqual([streak_of[u.username] for u in self.users], [3, 0, 0])
+        self.assertEqual([best_of[u.username] for u in self.users], [3, 3, 0])
+
+        before = self.state()
+        self.assertEqual(streaks.rollover_streaks(today, chunk_size=2), 0)
+        self.assertEqual(self.state(), before)
+
+        # A day later the first user's run has lapsed too, and is reset once
+        tomorrow = today + datetime.timedelta(days=1)
+        self.assertEqual(streaks.rollover_streaks(tomorrow), 1)
+        self.assertEqual(streaks.rollover_streaks(tomorrow), 0)
+        self.assertEqual(Streak.objects.get(user=self.users[0]).current_streak, 0)
+        self.assertEqual(Streak.objects.get(user=self.users[0]).best_streak, 3)
+
+
+class ExportHistoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_dataset(exams=1, subjects=2, videos=6, chunked_ratio=0.3, days=10, prefix='export')[0]
+
+    def expected_count(self, start=None):
+        logs, sessions, goals = (
+            model.objects.filter(user=self.user, **({'date__gte': start} if start else {}))
+            for model in (DailyStudyLog, StudySession, DailyGoal)
+        )
+        return (logs.count() + sessions.count() + goals.count()
+                + Video.objects.filter(subject__exam__user=self.user, is_chunked=False).count()
+                + VideoChunk.objects.filter(video__subject__exam__user=self.user).count())
+
+    def test_command_writes_to_its_stdout(self):
+        out = io.StringIO()
+        call_command('export_history', self.user.username, '--format', 'ndjson', stdout=out)
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(rows), self.expected_count())
+        self.assertEqual(rows[0]['record'], 'study_log')
+        self.assertEqual(rows[-1]['record'], 'chunk')
+
+        out = io.StringIO()
+        call_command('export_history', self.user.username, stdout=out)
+        lines = list(csv.reader(io.StringIO(out.getvalue())))
+        self.assertEqual(lines[0], export.EXPORT_FIELDS)
+        self.assertEqual(len(lines) - 1, self.expected_count())
+
+    def test_view_streams_in_blocks(self):
+        self.client.force_login(self.user)
+        start = timezone.localdate() - datetime.timedelta(days=3)
+        response = self.client.get(reverse('export_history'), {'format': 'ndjson', 'from': start.isoformat()})
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        blocks = list(response.streaming_content)
+        lines = b''.join(blocks).decode().splitlines()
+        self.assertEqual(len(lines), self.expected_count(start))
+        self.assertEqual(len(blocks), -(-len(lines) // 500))
+        self.assertEqual(self.client.get(reverse('export_history'), {'format': 'xml'}).status_code, 400)
+
+
+class SeedBenchmarkDataTests(TestCase):
+    def seed(self):
+        out = io.StringIO()
+        call_command(
+            'seed_benchmark_data', users=2, exams=2, subjects=3, videos=10, chunked_ratio=0.5, days=4,
+            prefix='seedcmd', seed=3, stdout=out,
+        )
+        return out.getvalue()
+
+    def test_row_counts(self):
+        self.assertIn('Created 2 users with 60 videos each: seedcmd0, seedcmd1', self.seed())
+        users = User.objects.filter(username__startswith='seedcmd')
+        self.assertEqual(users.count(), 2)
+        self.assertEqual(UserProfile.objects.filter(user__in=users).count(), 2)
+        self.assertEqual(Streak.objects.filter(user__in=users).count(), 2)
+        self.assertEqual(Exam.objects.filter(user__in=users).count(), 2 * 2)
+        self.assertEqual(Subject.objects.filter(exam__user__in=users).count(), 2 * 2 * 3)
+        self.assertEqual(Note.objects.filter(subject__exam__user__in=users).count(), 2 * 2 * 3)
+        videos = Video.objects.filter(subject__exam__user__in=users)
+        self.assertEqual(videos.count(), 2 * 2 * 3 * 10)
+        self.assertEqual(
+            VideoChunk.objects.filter(video__in=videos).count(),
+            sum(-(-v.duration_seconds // (20 * 60)) for v in videos.filter(is_chunked=True)),
+        )
+        self.assertFalse(videos.filter(is_chunked=True, is_watched=True).exists())
+        self.assertEqual(DailyStudyLog.objects.filter(user__in=users).count(), 2 * 4 * 3)
+        self.assertEqual(DailyGoal.objects.filter(user__in=users).count(), 2 * 4)
+        self.assertEqual(StudySession.objects.filter(user__in=users).count(), 2 * 4)
+
+        # Counters and rollups are built from the seeded rows
+        self.assertEqual(progress.rebuild_progress(Exam.objects.filter(user__in=users), commit=False), [])
+        rollups = StudyRollup.objects.filter(user__in=users).count()
+        self.assertEqual(sum(history.rebuild_history(user) for user in users), rollups)
+
+        # Running it again adds new users rather than clashing with the old ones
+        self.assertIn('seedcmd2, seedcmd3', self.seed())
+        self.assertEqual(User.objects.filter(username__startswith='seedcmd').count(), 4)
+
+
+class ProfilingMiddlewareTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_dataset(videos=5, days=1, prefix='prof')[0]
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.directory = tempfile.mkdtemp()
+
+    def profile_files(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_signed_token_writes_dump_and_summary(self):
+        with self.settings(PROFILING_ENABLED=True, PROFILING_DIR=self.directory):
+            self.client.get(reverse('dashboard'), HTTP_X_PROFILE='forged')
+            self.assertEqual(self.profile_files(), [])
+
+            self.client.get(reverse('dashboard'), HTTP_X_PROFILE=make_profile_token())
+        files = self.profile_files()
+        self.assertEqual([f.rsplit('.', 1)[1] for f in files], ['prof', 'txt'])
+        self.assertTrue(files[0].startswith('dashboard.'))
+
+    def test_old_dumps_are_rotated(self):
+        with self.settings(PROFILING_ENABLED=True, PROFILING_DIR=self.directory,
+                           PROFILING_SAMPLE_RATE=1, PROFILING_MAX_FILES=2):
+            for _ in range(4):
+                self.client.get(reverse('dashboard'))
+        self.assertEqual(len(self.profile_files()), 4) # 2 .prof + 2 .txt
+
+
+class YouTubeFetcherTests(TestCase):
+    def setUp(self):
+        items = [(f"v{i}", f"Lecture {i}", 60 + i) for i in range(120)]
+        items[3] = ('gone', 'Deleted video', 0)
+        self.stub = StubYouTubeServer({'PL1': items})
+        self.stub.__enter__()
+        self.addCleanup(self.stub.__exit__)
+        self.settings_override = override_settings(YOUTUBE_API_URL=self.stub.url, YOUTUBE_MAX_WORKERS=2)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        quota._budgets.clear()
+        cache.clear()
+
+    def test_parse_duration(self):
+        self.assertEqual(parse_duration('PT1H2M3S'), 3723)
+        self.assertEqual(parse_duration('PT45S'), 45)
+        self.assertEqual(parse_duration('P1D'), 0)
+
+    def test_playlist_pages_keep_order_and_durations(self):
+        videos = fetch_playlist_items('https://www.youtube.com/playlist?list=PL1&si=x', 'key')
+
+        self.assertEqual(len(videos), 119)
+        self.assertEqual([v['video_id'] for v in videos[:4]], ['v0', 'v1', 'v2', 'v4'])
+        self.assertEqual(videos[-1], {
+            'title': 'Lecture 119', 'video_id': 'v119',
+            'url': 'https://www.youtube.com/watch?v=v119', 'duration': 179,
+        })
+        endpoints = [endpoint for endpoint, _ in self.stub.requests]
+        self.assertEqual(endpoints.count('playlistItems'), 3)
+        self.assertEqual(endpoints.count('videos'), 3)
+
+    def test_api_error_returns_none(self):
+        self.stub.error = {'code': 403, 'message': 'quotaExceeded'}
+        with self.assertLogs('core.utils', 'ERROR'):
+            self.assertIsNone(fetch_playlist_items('https://www.youtube.com/playlist?list=PL1', 'key'))
+            self.assertIsNone(fetch_video_details('https://youtu.be/v1', 'key'))
+
+    def test_transient_errors_are_retried(self):
+        rate_limited = {'error': {'code': 403, 'errors': [{'reason': 'rateLimitExceeded'}]}}
+        self.stub.failures = [(503, {}), (403, rate_limited)]
+        with self.settings(YOUTUBE_BACKOFF_BASE=0):
+            self.assertEqual(fetch_video_details('https://youtu.be/v1', 'key')['duration'], 61)
+        self.assertEqual(len(self.stub.requests), 3)
+        self.assertEqual(ApiKeyQuota.objects.get(key_hash=quota.key_hash('key')).units_used, 3)
+
+    def test_daily_quota_stops_requests(self):
+        with self.settings(YOUTUBE_DAILY_QUOTA=3), self.assertRaisesMessage(quota.QuotaExceeded, 'retry after'):
+            fetch_playlist_items('https://www.youtube.com/playlist?list=PL1', 'key')
+        self.assertLessEqual(len(self.stub.requests), 3)
+        self.assertEqual(ApiKeyQuota.objects.get(key_hash=quota.key_hash('key')).units_used, len(self.stub.requests))
+
+    def test_quota_is_shared_with_other_processes(self):
+        # A fresh process starts from the units already spent today
+        ApiKeyQuota.objects.create(key_hash=quota.key_hash('key'), day=quota.quota_day(), units_used=3)
+        with self.settings(YOUTUBE_DAILY_QUOTA=3):
+            self.assertEqual(validate_api_key('key'), "This key has exceeded its quota.")
+        self.assertEqual(self.stub.requests, [])
+
+        # The API running out is recorded for the other processes
+        ApiKeyQuota.objects.all().delete()
+        quota._budgets.clear()
+        self.stub.error = {'code': 403, 'errors': [{'reason': 'quotaExceeded'}]}
+        with self.assertRaises(quota.QuotaExceeded):
+            fetch_playlist_items('https://www.youtube.com/playlist?list=PL1', 'key')
+        self.assertEqual(ApiKeyQuota.objects.get(key_hash=quota.key_hash('key')).units_used, 10000)
+        quota._budgets.clear()
+        self.assertEqual(validate_api_key('key'), "This key has exceeded its quota.")
+        self.assertEqual(len(self.stub.requests), 1)
+
+    def test_key_validation_is_cached(self):
+        self.stub.failures = [(400, {'error': {'code': 400, 'errors': [{'reason': 'keyInvalid'}]}})]
+        self.assertEqual(validate_api_key('key'), "Invalid API Key.")
+        self.assertIsNone(validate_api_key('key'))
+        self.assertIsNone(validate_api_key('key'))
+        self.assertEqual(len(self.stub.requests), 2)
+
+    def test_video_details(self):
+        details = fetch_video_details('https://www.youtube.com/watch?v=v7&t=3', 'key')
+        self.assertEqual(details['title'], 'Lecture 7')
+        self.assertEqual(details['duration'], 67)
+
+    def test_second_import_is_served_from_cache(self):
+        url = 'https://www.youtube.com/playlist?list=PL1'
+        first = fetch_playlist_items(url, 'key')
+        self.stub.requests.clear()
+
+        self.assertEqual(fetch_playlist_items(url, 'key'), first)
+        self.assertEqual(fetch_video_details('https://youtu.be/v7', 'key')['duration'], 67)
+        self.assertEqual(self.stub.requests, [])
+
+    def test_forced_fetch_revalidates_fresh_playlist(self):
+        url = 'https://www.youtube.com/playlist?list=PL1'
+        first = fetch_playlist_items(url, 'key')
+        self.stub.requests.clear()
+
+        self.assertEqual(fetch_playlist_items(url, 'key', force=True), first)
+        (listing, _), = self.stub.requests # answered 304 Not Modified, details stay cached
+
+        self.stub.playlists['PL1'].insert(0, ('v200', 'Lecture 200', 30))
+        self.stub.requests.clear()
+        videos = fetch_playlist_items(url, 'key', force=True)
+        self.assertEqual(videos[0]['duration'], 30)
+        self.assertEqual([query['id'] for endpoint, query in self.stub.requests if endpoint == 'videos'], ['v200'])
+
+    def test_stale_entries_are_revalidated(self):
+        url = 'https://www.youtube.com/playlist?list=PL1'
+        fetch_playlist_items(url, 'key')
+        YouTubeVideoCache.objects.filter(video_id='v5').delete()
+        self.stub.requests.clear()
+
+        with self.settings(YOUTUBE_PLAYLIST_CACHE_TTL=0):
+            videos = fetch_playlist_items(url, 'key')
+
+        self.assertEqual(len(videos), 119)
+        self.assertEqual(videos[4]['duration'], 65)
+        (listing, listing_query), (details, details_query) = self.stub.requests
+        self.assertEqual(listing, 'playlistItems') # answered 304 Not Modified
+        self.assertEqual((details, details_query['id']), ('videos', 'v5'))
+
+
+class ImportJobTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_dataset(videos=0, days=1, prefix='imp')[0]
+        cls.subject = Subject.objects.filter(exam__user=cls.user).first()
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.stub = StubYouTubeServer({'PL1': [(f"v{i}", f"Lecture {i}", 300) for i in range(75)]})
+        self.stub.__enter__()
+        self.addCleanup(self.stub.__exit__)
+        self.settings_override = override_settings(YOUTUBE_API_URL=self.stub.url)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        quota._budgets.clear()
+
+    def enqueue(self, playlist_id):
+        self.client.post(
+            reverse('add_playlist', args=[self.subject.id]),
+            {'playlist_url': f"https://www.youtube.com/playlist?list={playlist_id}"}
+        )
+        return ImportJob.objects.latest('id')
+
+    def test_worker_imports_queued_playlist(self):
+        job = self.enqueue('PL1')
+        self.assertEqual(job.status, 'queued')
+        self.assertEqual(self.stub.requests, []) # nothing fetched inside the request
+
+        call_command('run_import_worker', '--once', stdout=io.StringIO())
+
+        response = self.client.get(reverse('import_job_status', args=[job.id])).json()
+        self.assertEqual(response['job'], {
+            'id': job.id, 'state': 'done', 'pages_fetched': 2,
+            'videos_found': 75, 'videos_inserted': 75, 'videos_updated': 0, 'errors': [],
+        })
+        self.subject.refresh_from_db()
+        self.assertEqual(self.subject.total_items, 75)
+        self.assertEqual(list(self.subject.videos.values_list('order', flat=True)[:3]), [0, 1, 2])
+
+    def test_failed_fetch_is_reported(self):
+        self.stub.error = {'code': 403, 'message': 'quotaExceeded'}
+        job = self.enqueue('PL1')
+        with self.assertLogs('core.utils', 'ERROR'):
+            call_command('run_import_worker', '--once', stdout=io.StringIO())
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.errors, [imports.FETCH_ERROR])
+
+    def test_quota_exhaustion_is_reported(self):
+        self.stub.error = {'code': 403, 'errors': [{'reason': 'quotaExceeded'}]}
+        job = self.enqueue('PL1')
+        call_command('run_import_worker', '--once', stdout=io.StringIO())
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        reset = quota.reset_at()
+        self.assertEqual(job.errors, [f"YouTube API quota exceeded, retry after {reset:%Y-%m-%d %H:%M %Z}"])
+
+        response = self.client.post(reverse('import_playlists', args=[self.subject.exam_id]), {'playlists': [
+            {'subject': self.subject.name, 'url': 'https://www.youtube.com/playlist?list=PL1'},
+        ]}, content_type='application/json').json()
+        self.assertEqual(response['results'][0]['error'], job.errors[0])
+
+    def test_running_job_with_recent_heartbeat_is_not_requeued(self):
+        job = self.enqueue('PL1')
+        claimed = imports.claim_next('worker-1')
+        self.assertEqual(claimed.id, job.id)
+        long_ago = timezone.now() - datetime.timedelta(hours=2)
+        ImportJob.objects.filter(id=job.id).update(started_at=long_ago)
+        self.assertEqual(imports.requeue_stale(30 * 60), 0) # Still beating
+
+        ImportJob.objects.filter(id=job.id).update(heartbeat_at=long_ago)
+        self.assertEqual(imports.requeue_stale(30 * 60), 1)
+        self.assertEqual(ImportJob.objects.get(id=job.id).status, 'queued')
+
+    def test_pages_update_the_heartbeat(self):
+        job = self.enqueue('PL1')
+        job = imports.claim_next('worker-1')
+        ImportJob.objects.filter(id=job.id).update(heartbeat_at=None)
+        imports.run_job(job)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'done')
+        self.assertGreaterEqual(job.heartbeat_at, job.started_at)
+
+    def test_resync_appends_new_videos_and_keeps_watched_state(self):
+        self.enqueue('PL1')
+        call_command('run_import_worker', '--once', stdout=io.StringIO())
+        first = self.subject.videos.get(video_id='v0')
+        progress.set_video_watched(first, True)
+
+        # Re-uploaded under the same id; both caches are still fresh
+        self.stub.playlists['PL1'][0] = ('v0', 'Lecture 0 (re-upload)', 400)
+        self.stub.playlists['PL1'].append(('v75', 'Lecture 75', 300))
+        self.stub.requests.clear()
+        self.client.post(reverse('resync_playlist', args=[self.subject.id]))
+        call_command('run_import_worker', '--once', stdout=io.StringIO())
+        looked_up = [query['id'] for endpoint, query in self.stub.requests if endpoint == 'videos']
+        self.assertEqual(looked_up, ['v0', 'v75']) # One lookup per listing page
+
+        job = ImportJob.objects.latest('id')
+        self.assertEqual((job.status, job.videos_inserted, job.videos_updated), ('done', 1, 1))
+        first.refresh_from_db()
+        self.assertEqual((first.is_watched, first.duration_seconds, first.order), (True, 400, 0))
+        self.assertEqual(self.subject.videos.get(video_id='v75').order, 75)
+
+        self.subject.refresh_from_db()
+        self.assertEqual((self.subject.total_items, self.subject.watched_items), (76, 1))
+        self.assertEqual((self.subject.total_seconds, self.subject.watched_seconds), (76 * 300 + 100, 400))
+
+    def test_reimport_does_not_duplicate(self):
+        self.enqueue('PL1')
+        self.enqueue('PL1')
+        call_command('run_import_worker', '--once', stdout=io.StringIO())
+        self.assertEqual(self.subject.videos.count(), 75)
+        self.assertEqual(ImportJob.objects.latest('id').videos_inserted, 0)
+
+    def test_batch_import_reports_each_playlist(self):
+        self.stub.playlists['PL2'] = [('v0', 'Lecture 0', 300), ('w1', 'Extra', 120)]
+        exam = self.subject.exam
+        response = self.client.post(reverse('import_playlists', args=[exam.id]), {'playlists': [
+            {'subject': self.subject.name, 'url': 'https://www.youtube.com/playlist?list=PL1'},
+            {'subject': 'Revision', 'url': 'https://www.youtube.com/playlist?list=PL2'},
+            {'subject': 'Broken', 'url': 'https://www.youtube.com/watch?v=x'},
+        ]}, content_type='application/json').json()
+
+        ok, revision, broken = response['results']
+        self.assertEqual((ok['status'], ok['inserted'], ok['created_subject']), ('ok', 75, False))
+        self.assertEqual((revision['status'], revision['videos'], revision['created_subject']), ('ok', 2, True))
+        self.assertEqual((broken['status'], broken['subject_id'], broken['created_subject']), ('error', None, False))
+        self.assertFalse(exam.subjects.filter(name='Broken').exists()) # Not left behind empty
+        self.assertEqual(Subject.objects.get(id=revision['subject_id']).total_seconds, 420)
+
+        looked_up = [vid for endpoint, query in self.stub.requests if endpoint == 'videos' for vid in query['id'].split(',')]
+        self.assertEqual(sorted(looked_up), sorted(set(looked_up))) # v0 is fetched once for both playlists
+        self.assertEqual(len(looked_up), 76)
+
+    def test_import_playlists_command(self):
+        path = os.path.join(tempfile.mkdtemp(), 'playlists.csv')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write("Mechanics,https://www.youtube.com/playlist?list=PL1\n")
+
+        out = io.StringIO()
+        call_command('import_playlists', self.user.username, 'New Exam', path, '--create-exam', stdout=out)
+        self.assertIn("Imported 1 of 1 playlists.", out.getvalue())
+        self.assertEqual(Subject.objects.get(exam__name='New Exam', name='Mechanics').videos.count(), 75)
+
+    def test_job_is_claimed_once(self):
+        job = self.enqueue('PL1')
+        self.assertEqual(imports.claim_next('a').id, job.id)
+        self.assertIsNone(imports.claim_next('b'))
+
+
+class CsvImporterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_dataset(videos=2, days=1, prefix='csv')[0]
+        cls.subject = Subject.objects.filter(exam__user=cls.user).first()
+
+    def test_decoder_handles_split_multibyte_characters(self):
+        data = 'title,duration\n"Café, part 1",10:00\n'.encode('utf-8-sig')
+        pieces = iter([data[:1], data[1:22], data[22:], b''])
+        upload = mock.Mock(spec=['read'], read=lambda size: next(pieces))
+        self.assertEqual(list(csv_importer.iter_lines(upload)), ['title,duration\n', '"Café, part 1",10:00\n'])
+
+    def test_lines_end_in_cr_lf_or_crlf(self):
+        data = b'title,duration\rA,1:00\r\nB,2:00\nC,3:00'
+        pieces = iter([data[:15], data[15:22], data[22:], b'']) # Splits the \r\n after A
+        upload = mock.Mock(spec=['read'], read=lambda size: next(pieces))
+        self.assertEqual(list(csv_importer.iter_lines(upload)), [
+            'title,duration\r', 'A,1:00\r\n', 'B,2:00\n', 'C,3:00',
+        ])
+
+        upload = SimpleUploadedFile('mac.csv', b'title,duration\rOne,1:00\rTwo,2:00\r')
+        result = csv_importer.import_videos_from_csv(upload, self.subject)
+        self.assertEqual((result['items_created'], result['errors']), (2, []))
+
+    def test_unparsable_rows_are_reported(self):
+        upload = SimpleUploadedFile('big.csv', (
+            'title,duration\n'
+            f'"{"x" * (csv.field_size_limit() + 1)}",1:00\n'
+            'After,2:00\n'
+        ).encode())
+        result = csv_importer.import_videos_from_csv(upload, self.subject)
+        self.assertEqual(result['items_created'], 1)
+        self.assertEqual(result['errors'], [
+            f"Row 1: could not be parsed (field larger than field limit ({csv.field_size_limit()}))",
+        ])
+
+    def test_import_streams_rows_and_reports_errors(self):
+        upload = SimpleUploadedFile('todo.csv', (
+            'Title,Duration,video_id\n'
+            'Intro,05:00,\n'
+            ',01:00,\n'
+            'Bad duration,soon,\n'
+            '"Multi\nline",1:00:00,abc\n'
+            'Lecture 1,10:00,\n' # already in the subject (seeded)
+            'Intro,05:00,\n'
+        ).encode())
+
+        with mock.patch.object(csv_importer, 'BATCH_SIZE', 1):
+            result = csv_importer.import_videos_from_csv(upload, self.subject, dedupe='title')
+
+        self.assertEqual(result['items_created'], 2)
+        self.assertEqual(result['skipped'], 2)
+        self.assertEqual(result['errors'], [
+            "Row 2: missing title",
+            "Row 3: invalid duration 'soon' (use MM:SS or HH:MM:SS)",
+        ])
+        self.assertEqual(
+            list(self.subject.videos.filter(title__in=['Intro', 'Multi\nline']).values_list('duration_seconds', 'video_id')),
+            [(300, mock.ANY), (3600, 'abc')]
+        )
+        self.subject.refresh_from_db()
+        self.assertEqual(self.subject.total_items, 4)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), NOTE_WRITE_BEHIND_SECONDS=0)
+class ExamArchiveTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_dataset(exams=1, subjects=2, videos=30, chunked_ratio=0.3, days=1, prefix='arc')[0]
+        cls.exam = Exam.objects.get(user=cls.user)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.note = Note.objects.filter(subject__exam=self.exam).first()
+        self.note.save_content_to_file('<p>Kinematics $v = u + at$</p>')
+
+    def export(self, **params):
+        response = self.client.get(reverse('export_exam', args=[self.exam.id]), params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content)
+
+    def test_round_trip_remaps_ids_and_rebuilds_counters(self):
+        archive = self.export(gzip=1)
+        self.assertEqual(archive[:2], b'\x1f\x8b')
+
+        response = self.client.post(reverse('import_exam'), {
+            'archive': SimpleUploadedFile('exam.jsonl.gz', archive), 'name': 'Restored',
+        })
+        self.assertEqual(response.json()['status'], 'ok')
+        restored = Exam.objects.get(id=response.json()['exam_id'])
+
+        def snapshot(exam):
+            return sorted(
+                (video.subject.name, video.order, video.title, video.is_watched,
+                 tuple(video.chunks.order_by('part_number').values_list('part_number', 'is_watched')))
+                for video in Video.objects.filter(subject__exam=exam).select_related('subject')
+            )
+        self.assertEqual(snapshot(restored), snapshot(self.exam))
+        self.assertFalse(Video.objects.filter(subject__exam=restored, id__in=Video.objects.filter(subject__exam=self.exam)).exists())
+        for field in progress.COUNTER_FIELDS:
+            self.assertEqual(getattr(restored, field), getattr(self.exam, field))
+        self.assertEqual(
+            Note.objects.get(subject__exam=restored, subject__name=self.note.subject.name).get_content_from_file(),
+            '<p>Kinematics $v = u + at$</p>'
+        )
+
+    def test_command_export_and_batched_import_with_reset_progress(self):
+        path = os.path.join(tempfile.mkdtemp(), 'exam.jsonl.gz')
+        call_command('export_exam', self.user.username, str(self.exam.id), '-o', path, stdout=io.StringIO())
+
+        with open(path, 'rb') as f:
+            restored = exam_archive.import_archive(f, self.user, reset_progress=True, batch_size=7)
+        self.assertEqual(restored.name, self.exam.name)
+        self.assertEqual(restored.total_items, self.exam.total_items)
+        self.assertEqual(restored.watched_items, 0)
+        self.assertFalse(VideoChunk.objects.filter(video__subject__exam=restored, is_watched=True).exists())
+
+    def test_rejects_other_files(self):
+        upload = SimpleUploadedFile('todo.csv', b'title,duration\nIntro,05:00\n')
+        response = self.client.post(reverse('import_exam'), {'archive': upload})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Exam.objects.filter(user=self.user).count(), 1)
+
+    def test_rejects_malformed_headers(self):
+        headers = [
+            {'format': exam_archive.FORMAT, 'version': '1', 'fields': exam_archive.FIELDS},
+            {'format': exam_archive.FORMAT, 'version': 1},
+            {'format': exam_archive.FORMAT, 'version': 1, 'fields': ['subject']},
+            {'format': exam_archive.FORMAT, 'version': 1, 'fields': {'subject': 'id,name'}},
+            {'format': exam_archive.FORMAT, 'version': 1, 'fields': exam_archive.FIELDS, 'exam': 'Physics'},
+            {'format': exam_archive.FORMAT, 'version': 1, 'fields': exam_archive.FIELDS, 'exam': {'name': 3}},
+        ]
+        for header in headers:
+            upload = SimpleUploadedFile('exam.jsonl', (json.dumps(header) + '\n').encode())
+            response = self.client.post(reverse('import_exam'), {'archive': upload})
+            self.assertEqual(response.status_code, 400, header)
+        self.assertEqual(Exam.objects.filter(user=self.user).count(), 1)
+
+        # The exam entry is optional
+        header = {'format': exam_archive.FORMAT, 'version': 1, 'fields': exam_archive.FIELDS}
+        exam = exam_archive.import_archive(io.BytesIO((json.dumps(header) + '\n').encode()), self.user)
+        self.assertEqual(exam.name, 'Imported exam')
+
+    def test_rejects_invalid_rows(self):
+        header = {'format': exam_archive.FORMAT, 'version': 1, 'fields': exam_archive.FIELDS}
+        subject = ['subject', 1, 'S', 0, '']
+        video = ['video', 1, 1, 'V', 'abc', 'https://example.com', False, 0, 60, True]
+        rows = [
+            [['subject', 1, None, 0, '']],
+            [['subject', 1, 'S', -5, '']],
+            [['subject', 1, 'S' * 101, 0, '']],
+            [['subject', 1, 'S', True, '']],
+            [subject, ['video', 1, 1, 'V', 'abc', 'https://example.com', 1, 0, 60, True]],
+            [subject, ['note', 1, 7]],
+            [subject, video, ['chunk', 1, 1, 'Part 1', 60, 30, False]],
+        ]
+        for archive in rows:
+            lines = [json.dumps(header)] + [json.dumps(row) for row in archive]
+            upload = SimpleUploadedFile('exam.jsonl', '\n'.join(lines).encode())
+            response = self.client.post(reverse('import_exam'), {'archive': upload})
+            self.assertEqual(response.status_code, 400, archive)
+        self.assertEqual(Exam.objects.filter(user=self.user).count(), 1)
+
+        # Anything the checks miss is still reported as a bad archive
+        lines = [json.dumps(header), json.dumps(subject)]
+        with mock.patch.object(Subject.objects, 'bulk_create', side_effect=IntegrityError('NOT NULL')):
+            with self.assertRaises(exam_archive.ArchiveError):
+                exam_archive.import_archive(io.BytesIO('\n'.join(lines).encode()), self.user)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), NOTE_JOURNAL_MAX_ENTRIES=3, NOTE_COMPRESSION='gzip', NOTE_WRITE_BEHIND_SECONDS=0)
+class NoteDeltaSaveTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_dataset(exams=1, subjects=1, videos=1, days=1, prefix='delta')[0]
+        cls.note = Note.objects.get(subject__exam__user=cls.user)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.blocks = [f'<p>Paragraph {i} {os.urandom(100).hex()}</p>' for i in range(10)]
+        self.path = self.note.get_file_path()
+
+    def save(self, body, url=None):
+        return self.client.post(url or reverse('save_note', args=[self.note.id]), json.dumps(body), content_type='application/json')
+
+    def test_deltas_are_journaled_and_folded_on_read(self):
+        version = self.save({'blocks': self.blocks}).json()['version']
+        response = self.save({'base_version': version, 'ops': [[2, 1, ['<p>Changed</p>', '<h2>New</h2>']]]})
+        self.assertEqual(response.json()['version'], version + 1)
+        self.assertTrue(os.path.exists(self.path + '.journal'))
+
+        stale = self.save({'base_version': version, 'ops': [[0, 1, []]]})
+        self.assertEqual(stale.status_code, 409)
+        self.assertEqual(stale.json()['version'], version + 1)
+        self.assertEqual(self.save({'base_version': version + 1, 'ops': [[0, 20, []]]}).status_code, 400)
+
+        expected = self.blocks[:2] + ['<p>Changed</p>', '<h2>New</h2>'] + self.blocks[3:]
+        response = self.client.get(reverse('get_note_content', args=[self.note.id]))
+        self.assertEqual(b''.join(response.streaming_content).decode(), ''.join(expected))
+        self.assertFalse(os.path.exists(self.path + '.journal'))
+
+        # Block boundaries survive compaction, so deltas keep working on the result
+        self.save({'base_version': version + 1, 'ops': [[3, 1, []]]})
+        self.assertEqual(self.note.get_content_from_file(), ''.join(expected[:3] + expected[4:]))
+
+    def test_journal_is_compacted_after_max_entries(self):
+        version = self.save({'blocks': self.blocks}).json()['version']
+        for i in range(3):
+            version = self.save({'base_version': version, 'ops': [[i, 1, [f'<p>{i}</p>']]]}).json()['version']
+        self.assertFalse(os.path.exists(self.path + '.journal'))
+        self.assertTrue(self.note.get_content_from_file().startswith('<p>0</p><p>1</p><p>2</p><p>Paragraph 3'))
+
+    def test_delta_saves_write_only_the_changed_section(self):
+        version = self.save({'blocks': self.blocks}).json()['version']
+        with self.settings(NOTE_SECTION_MAX_BYTES=500):
+            version = self.save({'blocks': ['<h2>Part 2</h2>'] + self.blocks}).json()['version']
+            sections = note_store.outline(self.path)[1]
+            self.assertGreater(len(sections), 3)
+            with mock.patch.object(note_store, '_write_bytes', wraps=note_store._write_bytes) as write, \
+                    mock.patch.object(note_store, '_open_body', wraps=note_store._open_body) as opened:
+                self.save({'base_version': version, 'ops': [[6, 1, [f'<p>Changed {"x" * 200}</p>']]]})
+                after = note_store.outline(self.path)[1]
+        # Only the section holding block 6 is read and written, plus the layout
+        changed = [s for s in sections if s not in after]
+        self.assertEqual(len(changed), 1)
+        self.assertEqual([os.path.basename(call.args[0]) for call in opened.call_args_list], [changed[0]['id'] + '.part.gz'])
+        self.assertEqual(len(write.call_args_list), 2)
+        self.assertEqual(len(after), len(sections))
+        self.assertFalse(os.path.exists(self.path + '.gz'))
+
+    def test_interrupted_compaction_is_not_applied_twice(self):
+        version = self.save({'blocks': self.blocks}).json()['version']
+        self.save({'base_version': version, 'ops': [[0, 1, ['<p>A</p>']]]})
+        with open(self.path + '.journal', encoding='utf-8') as f:
+            journal = f.read()
+        self.assertEqual(note_store.outline(self.path)[0], version + 1)
+        with open(self.path + '.journal', 'w', encoding='utf-8') as f: # Layout replaced, journal not dropped yet
+            f.write(journal)
+
+        self.assertEqual(self.save({'base_version': version + 1, 'ops': [[0, 0, ['<p>B</p>']]]}).status_code, 200)
+        self.assertEqual(self.note.get_content_from_file(), '<p>B</p><p>A</p>' + ''.join(self.blocks[1:]))
+
+    def test_body_is_rebuilt_when_outdated(self):
+        version = self.save({'blocks': self.blocks}).json()['version']
+        response = self.client.get(reverse('get_note_content', args=[self.note.id]))
+        self.assertEqual(b''.join(response.streaming_content).decode(), ''.join(self.blocks))
+        self.assertTrue(os.path.exists(self.path + '.gz'))
+
+        self.save({'base_version': version, 'ops': [[0, 1, ['<p>A</p>']]]})
+        note_store.compact(self.path)
+        self.assertFalse(os.path.exists(self.path + '.gz'))
+        with gzip.open(self.path + '.gz', 'wt', encoding='utf-8') as f: # A rebuild stopped before the layout was updated
+            f.write('<p>Stale</p>')
+        response = self.client.get(reverse('get_note_content', args=[self.note.id]))
+        self.assertEqual(b''.join(response.streaming_content).decode(), '<p>A</p>' + ''.join(self.blocks[1:]))
+
+    @skipUnless(hasattr(os, 'fork') and note_store.fcntl, "needs fork and flock")
+    def test_saves_from_two_processes(self):
+        version = self.save({'blocks': self.blocks}).json()['version']
+        children = []
+        for name in 'ab':
+            pid = os.fork()
+            if pid == 0: # A second worker process saving the same note
+                try:
+                    base = version
+                    for i in range(15):
+                        while True:
+                            try:
+                                base = note_store.append_delta(self.path, base, [[0, 0, [f'<p>{name}{i}</p>']]])
+                                break
+                            except note_store.DeltaConflict as e:
+                                base = e.version
+                finally:
+                    os._exit(0)
+            children.append(pid)
+        for pid in children:
+            os.waitpid(pid, 0)
+
+        content = note_store.read(self.path)
+        self.assertTrue(all(f'<p>{name}{i}</p>' in content for name in 'ab' for i in range(15)))
+        self.assertTrue(content.endswith(''.join(self.blocks)))
+        self.assertEqual(note_store.version(self.path), version + 30)
+
+    def test_missing_section_files_are_rebuilt(self):
+        version = self.save({'blocks': self.blocks}).json()['version']
+        self.save({'base_version': version, 'ops': [[0, 1, ['<p>A</p>']]]})
+        note_store.compact(self.path)
+        directory = self.path + '.sections'
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+
+        expected = '<p>A</p>' + ''.join(self.blocks[1:])
+        with self.assertLogs('core.services.note_store', 'WARNING'):
+            self.assertEqual(self.note.get_content_from_file(), expected) # From the history
+        self.assertEqual(self.save({'base_version': version + 1, 'ops': [[0, 1, []]]}).status_code, 409)
+        self.assertEqual(self.save({'blocks': ['<p>B</p>']}).status_code, 200)
+        self.assertEqual(self.note.get_content_from_file(), '<p>B</p>')
+
+    def test_common_note_delta_save(self):
+        url = reverse('save_common_note')
+        version = self.save({'blocks': ['<p>a</p>', '<p>b</p>']}, url).json()['version']
+        self.save({'base_version': version, 'ops': [[1, 0, ['<p>between</p>']]]}, url)
+        self.assertEqual(self.user.common_note.get_content_from_file(), '<p>a</p><p>between</p><p>b</p>')
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), NOTE_COMPRESSION='gzip', NOTE_WRITE_BEHIND_SECONDS=60)
+class NoteWriteBehindTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_dataset(exams=1, subjects=1, videos=1, days=1, prefix='behind')[0]
+        cls.note = Note.objects.get(subject__exam__user=cls.user)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.path = self.note.get_file_path()
+        shutil.rmtree(os.path.dirname(self.path), ignore_errors=True)
+        self.addCleanup(note_store.flush_all)
+
+    def save(self, body):
+        return self.client.post(reverse('save_note', args=[self.note.id]), json.dumps(body), content_type='application/json')
+
+    def test_bursts_are_written_once(self):
+        first = f'<p>{"a" * 500}</p>' # Keeps the one-line journal below the note's size
+        version = self.save({'blocks': [first, '<p>b</p>']}).json()['version']
+        note_store.flush_all()
+        updated_at = Note.objects.get(id=self.note.id).updated_at
+        with mock.patch.object(note_store, '_write_bytes', wraps=note_store._write_bytes) as write:
+            for i in range(20):
+                version = self.save({'base_version': version, 'ops': [[1, 1, [f'<p>b{i}</p>']]]}).json()['version']
+            self.assertEqual(self.save({'base_version': version - 1, 'ops': [[0, 1, []]]}).status_code, 409)
+            self.save({'content': first + '<p>last</p>'})
+            self.assertEqual(self.note.get_content_from_file(), first + '<p>last</p>')
+            self.assertEqual(Note.objects.get(id=self.note.id).updated_at, updated_at)
+
+            with override_settings(NOTE_FSYNC=True), mock.patch('os.fsync') as fsync:
+                note_store.flush_all()
+            self.assertTrue(fsync.called)
+            write.assert_not_called() # Journaled, not rewritten
+        with open(self.path + '.journal', encoding='utf-8') as f:
+            journal = [json.loads(line) for line in f]
+        self.assertEqual(journal, [{'version': version + 1, 'ops': [[1, 1, ['<p>last</p>']]]}])
+        self.assertNotEqual(Note.objects.get(id=self.note.id).updated_at, updated_at)
+        self.assertEqual(note_store.version(self.path), version + 1)
+        self.assertEqual(note_store.read(self.path), first + '<p>last</p>')
+        self.assertEqual([r['note_id'] for r in note_search.search(self.user, 'last')], [self.note.id])
+
+    def test_save_from_another_process_is_not_corrupted(self):
+        version = self.save({'blocks': ['<p>a</p>', '<p>b</p>', '<p>c</p>']}).json()['version']
+        note_store.flush_all()
+        self.save({'base_version': version, 'ops': [[2, 1, []]]})
+        pending = note_store._pending.pop(self.path) # Another worker saves meanwhile
+        with override_settings(NOTE_WRITE_BEHIND_SECONDS=0):
+            note_store.write_full(self.path, ['<p>other</p>'])
+        note_store._pending[self.path] = pending
+        with self.assertLogs('core.services.note_store', 'WARNING'):
+            note_store.flush_all()
+        self.assertEqual(note_store.read(self.path), '<p>a</p><p>b</p>')
+        self.assertEqual(note_store.version(self.path), version + 2) # Past the other save
+
+    def test_reads_of_the_file_flush_first(self):
+        self.save({'content': '<h1>Title</h1><p>body</p>'})
+        self.assertFalse(os.path.exists(self.path + '.gz'))
+        response = self.client.get(reverse('get_note_content', args=[self.note.id]))
+        self.assertEqual(b''.join(response.streaming_content), b'<h1>Title</h1><p>body</p>')
+        self.assertTrue(os.path.exists(self.path + '.gz'))
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), NOTE_COMPRESSION='gzip', NOTE_WRITE_BEHIND_SECONDS=0)
+class NoteCompressionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_dataset(exams=1, subjects=1, videos=1, days=1, prefix='gz')[0]
+        cls.note = Note.objects.get(subject__exam__user=cls.user)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.content = '<p>Thermodynamics</p>' * 5000
+        self.url = reverse('get_note_content', args=[self.note.id])
+
+    def test_serves_stored_gzip_or_decompresses(self):
+        self.note.save_content_to_file(self.content)
+        self.assertFalse(os.path.exists(self.note.get_file_path()))
+
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='br, gzip;q=0.8')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        body = b''.join(response.streaming_content)
+        self.assertLess(len(body), len(self.content) // 20)
+        self.assertEqual(gzip.decompress(body).decode(), self.content)
+
+        for accept in ('br', 'gzip;q=0'):
+            response = self.client.get(self.url, HTTP_ACCEPT_ENCODING=accept)
+            self.assertFalse(response.has_header('Content-Encoding'))
+            self.assertEqual(b''.join(response.streaming_content).decode(), self.content)
+            self.assertIn('Accept-Encoding', response['Vary'])
+
+    def test_accept_encoding_weights(self):
+        cases = {
+            'gzip': True,
+            'GZIP ; q=0.5': True,
+            'gzip;q=0': False,
+            'gzip;q=0.000': False,
+            'gzip;q=0.001': True,
+            'gzip;q=oops': False,
+            '*': True,
+            '*;q=0': False,
+            'br, *;q=0.1': True,
+            '*, gzip;q=0': False, # The explicit entry wins
+            'gzip;q=0, *': False,
+            'br, deflate': False,
+            'identity': False,
+            '': False,
+        }
+        for header, accepted in cases.items():
+            request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING=header)
+            self.assertEqual(accepts_encoding(request, 'gzip'), accepted, header)
+
+    def test_recompress_converts_section_files(self):
+        self.note.save_content_to_file('<h1>One</h1><p>a</p><h2>Two</h2><p>b</p>')
+        path = self.note.get_file_path()
+        sections = path + '.sections'
+        self.assertEqual(sorted(name.split('.', 1)[1] for name in os.listdir(sections)), ['part.gz', 'part.gz'])
+
+        self.assertIsNotNone(note_store.recompress(path, 'identity'))
+        self.assertEqual(sorted(name.split('.', 1)[1] for name in os.listdir(sections)), ['part', 'part'])
+        self.assertIsNone(note_store.recompress(path, 'identity'))
+
+        # A body already in the codec still gets its sections converted
+        for name in os.listdir(sections):
+            section = os.path.join(sections, name)
+            with open(section, 'rb') as f:
+                data = f.read()
+            os.remove(section)
+            with open(section + '.gz', 'wb') as f:
+                f.write(gzip.compress(data))
+        self.assertIsNotNone(note_store.recompress(path, 'identity'))
+        self.assertEqual(sorted(name.split('.', 1)[1] for name in os.listdir(sections)), ['part', 'part'])
+
+    def test_compress_notes_converts_existing_files(self):
+        path = self.note.get_file_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f: # Written before compression existed
+            f.write(self.content)
+
+        out = io.StringIO()
+        call_command('compress_notes', stdout=out)
+        self.assertIn("Converted 1 of 1 notes to gzip", out.getvalue())
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.note.get_content_from_file(), self.content)
+
+        call_command('compress_notes', '--codec', 'identity', stdout=out)
+        with open(path, encoding='utf-8') as f:
+            self.assertEqual(f.read(), self.content)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), NOTE_COMPRESSION='gzip', NOTE_WRITE_BEHIND_SECONDS=0)
+class NoteConditionalGetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_dataset(exams=1, subjects=1, videos=1, days=1, prefix='etag')[0]
+        cls.note = Note.objects.get(subject__exam__user=cls.user)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.content = ''.join(f'<p>Section {i} é</p>' for i in range(1000))
+        self.note.save_content_to_file(self.content)
+        self.note.save()
+        self.url = reverse('get_note_content', args=[self.note.id])
+
+    def test_unchanged_note_is_not_modified(self):
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(
+            self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304
+        )
+        # Each encoding is its own representation
+        self.assertNotEqual(self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip')['ETag'], etag)
+
+        self.note.save_content_to_file(self.content + '<p>More</p>')
+        self.note.save()
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_byte_ranges_of_the_decompressed_note(self):
+        data = self.content.encode()
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-99', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 206)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response['Content-Range'], f'bytes 10-99/{len(data)}')
+        self.assertEqual(b''.join(response.streaming_content), data[10:100])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-50')
+        self.assertEqual(b''.join(response.streaming_content), data[-50:])
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={len(data)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(data)}')
+
+        # A stale If-Range gets the whole current note
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), data)
+
+    def test_save_while_serving_does_not_pull_the_body(self):
+        stored_body = note_store.stored_body
+
+        def save_after_opening(path):
+            opened = stored_body(path)
+            self.note.save_content_to_file('<p>Rewritten</p>')
+            self.assertFalse(os.path.exists(opened[0].name)) # The save dropped the old body
+            return opened
+
+        for encoding in ('', 'gzip'):
+            note_store.stored_body(self.note.get_file_path())[0].close() # The body exists again
+            with mock.patch.object(note_store, 'stored_body', side_effect=save_after_opening):
+                response = self.client.get(self.url, HTTP_ACCEPT_ENCODING=encoding)
+            self.assertEqual(response.status_code, 200)
+            content = b''.join(response.streaming_content)
+            if encoding:
+                content = gzip.decompress(content)
+            self.assertEqual(content, self.content.encode())
+            self.note.save_content_to_file(self.content)
+
+    def test_ranges_only_decompress_the_sections_they_cover(self):
+        shutil.rmtree(os.path.dirname(self.note.get_file_path())) # Indexed again at the smaller section size
+        with self.settings(NOTE_SECTION_MAX_BYTES=2000):
+            self.note.save_content_to_file(self.content)
+        data = self.content.encode()
+        sections = note_store.outline(self.note.get_file_path())[1]
+        self.assertGreater(len(sections), 10)
+        note_store.stored_body(self.note.get_file_path())[0].close() # Builds the body for the validators
+
+        loaded = []
+        with mock.patch.object(note_store, '_open_body', wraps=note_store._open_body) as opened:
+            for start in range(0, len(data), 4096):
+                end = min(start + 4096, len(data)) - 1
+                response = self.client.get(self.url, HTTP_RANGE=f'bytes={start}-{end}')
+                self.assertEqual(response.status_code, 206)
+                loaded.append(b''.join(response.streaming_content))
+        self.assertEqual(b''.join(loaded), data)
+        # Each range opens the two or three sections it overlaps, never the whole body
+        self.assertLessEqual(opened.call_count, len(sections) + 2 * len(loaded))
+        self.assertTrue(all(call.args[0].endswith('.part.gz') for call in opened.call_args_list))
+
+    def test_common_note_page_loads_content_lazily(self):
+        self.client.post(reverse('save_common_note'), '{"content": "<p>Formula sheet</p>"}', content_type='application/json')
+        self.assertNotContains(self.client.get(reverse('common_note')), 'Formula sheet')
+        response = self.client.get(reverse('get_common_note_content'))
+        self.assertEqual(b''.join(response.streaming_content), b'<p>Formula sheet</p>')
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), NOTE_COMPRESSION='gzip', NOTE_SECTION_MAX_BYTES=2000, NOTE_WRITE_BEHIND_SECONDS=0)
+class NoteSectionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_dataset(exams=1, subjects=1, videos=1, days=1, prefix='sect')[0]
+        cls.note = Note.objects.get(subject__exam__user=cls.user)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.chapters = [
+            f'<h2>Chapter {c}</h2>' + ''.join(f'<p>Chapter {c} paragraph {i} {"." * 80}</p>' for i in range(30))
+            for c in range(3)
+        ]
+        self.outline_url = reverse('get_note_outline', args=[self.note.id])
+
+    def outline(self):
+        return self.client.get(self.outline_url).json()
+
+    def section(self, section_id):
+        response = self.client.get(reverse('get_note_section', args=[self.note.id, section_id]))
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_outline_splits_on_headings_and_size(self):
+        self.note.save_content_to_file(''.join(self.chapters))
+        sections = self.outline()['sections']
+
+        self.assertEqual([s['title'] for s in sections if s['title']], ['Chapter 0', 'Chapter 1', 'Chapter 2'])
+        self.assertTrue(all(s['bytes'] <= 2000 for s in sections))
+        self.assertEqual(sum(s['blocks'] for s in sections), 93)
+
+        response, html = self.section(sections[0]['id'])
+        self.assertTrue(html.startswith('<h2>Chapter 0</h2><p>Chapter 0 paragraph 0'))
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(''.join(self.section(s['id'])[1] for s in sections), ''.join(self.chapters))
+        self.assertEqual(self.client.get(reverse('get_note_section', args=[self.note.id, '0' * 16])).status_code, 404)
+
+    def test_saving_one_section_rewrites_only_that_section(self):
+        self.note.save_content_to_file(''.join(self.chapters))
+        data = self.outline()
+        sections = data['sections']
+        directory = self.note.get_file_path() + '.sections'
+        before = {name: os.stat(os.path.join(directory, name)).st_mtime_ns for name in os.listdir(directory)}
+
+        # Replace the second section, the way the editor does
+        index = sections[0]['blocks']
+        response = self.client.post(reverse('save_note', args=[self.note.id]), json.dumps({
+            'base_version': data['version'], 'ops': [[index, sections[1]['blocks'], ['<p>Rewritten</p>']]],
+        }), content_type='application/json')
+        self.assertEqual(response.json()['status'], 'ok')
+
+        after = self.outline()['sections']
+        self.assertEqual(self.section(after[1]['id'])[1], '<p>Rewritten</p>')
+        files = {name: os.stat(os.path.join(directory, name)).st_mtime_ns for name in os.listdir(directory)}
+        self.assertNotIn(sections[1]['id'] + '.part.gz', files)
+        unchanged = [s['id'] + '.part.gz' for s in sections if s['id'] != sections[1]['id']]
+        self.assertEqual({name: files[name] for name in unchanged}, {name: before[name] for name in unchanged})
+
+    def test_notes_from_before_sections_are_indexed_on_first_use(self):
+        path = self.note.get_file_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.chapters[0])
+
+        data = self.outline()
+        self.assertEqual(data['version'], 1)
+        self.assertEqual(data['sections'][0]['title'], 'Chapter 0')
+        self.assertEqual(self.note.get_content_from_file(), self.chapters[0])
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), NOTE_WRITE_BEHIND_SECONDS=0)
+class NoteSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user, cls.other = seed_dataset(users=2, exams=1, subjects=2, videos=1, days=1, prefix='fts')
+        cls.notes = list(Note.objects.filter(subject__exam__user=cls.user).select_related('subject__exam').order_by('id'))
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def save(self, url, body):
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def search(self, q):
+        return self.client.get(reverse('search_notes'), {'q': q}).json()['results']
+
+    def test_saves_are_searchable_with_context(self):
+        first, second = self.notes
+        self.save(reverse('save_note', args=[first.id]), {'content': '<h2>Entropy</h2><p>Entropy &amp; the <b>second law</b> <script>x()</script></p>'})
+        self.save(reverse('save_note', args=[second.id]), {'content': '<p>Entropy appears once</p>'})
+        self.save(reverse('save_common_note'), {'blocks': ['<p>Second law &lt;summary&gt;</p>']})
+
+        results = self.search('entropy')
+        self.assertEqual([r['note_id'] for r in results], [first.id, second.id]) # Two hits rank first
+        self.assertEqual(results[0]['subject'], first.subject.name)
+        self.assertEqual(results[0]['exam'], first.subject.exam.name)
+        self.assertEqual(results[0]['url'], reverse('subject_detail', args=[first.subject_id]))
+        self.assertIn('<mark>Entropy</mark> &amp; the second law', results[0]['snippet'])
+
+        self.assertEqual(self.search('seco'), [])
+        common = self.search('seco*')
+        self.assertEqual({r['kind'] for r in common}, {'note', 'common'})
+        self.assertIn('&lt;summary&gt;', [r for r in common if r['kind'] == 'common'][0]['snippet'])
+        self.assertEqual(self.search('x'), [])
+
+    def test_delta_saves_are_indexed_before_the_next_search(self):
+        note = self.notes[0]
+        version = self.save(reverse('save_note', args=[note.id]), {'blocks': ['<p>Kinematics</p>']})['version']
+        self.save(reverse('save_note', args=[note.id]), {'base_version': version, 'ops': [[0, 1, ['<p>Dynamics</p>']]]})
+        self.assertEqual(len(self.search('dynamics')), 1)
+        self.assertEqual(self.search('kinematics'), [])
+
+    def test_only_own_notes_and_rebuild(self):
+        other_note = Note.objects.filter(subject__exam__user=self.other).first()
+        note_store.write_full(other_note.get_file_path(), ['<p>Private optics notes</p>'])
+        note_store.write_full(self.notes[1].get_file_path(), ['<p>Optics revision</p>'])
+        self.assertEqual(self.search('optics'), []) # Written around the models, so not indexed yet
+
+        out = io.StringIO()
+        call_command('rebuild_note_search', stdout=out)
+        self.assertIn('Indexed', out.getvalue())
+        self.assertEqual([r['note_id'] for r in self.search('optics')], [self.notes[1].id])
+
+        self.notes[1].subject.delete()
+        self.assertEqual(self.search('optics'), [])
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), NOTE_WRITE_BEHIND_SECONDS=0)
+class NoteHistoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user, cls.other = seed_dataset(users=2, exams=1, subjects=1, videos=1, days=1, prefix='history')
+        cls.note = Note.objects.get(subject__exam__user=cls.user)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.path = self.note.get_file_path()
+        shutil.rmtree(os.path.dirname(note_history.objects_dir()), ignore_errors=True)
+        self.blocks = [f'<p>{i} {random.Random(i).randbytes(200).hex()}</p>' for i in range(200)]
+
+    def save(self, blocks):
+        return self.client.post(reverse('save_note', args=[self.note.id]), json.dumps({'blocks': blocks}), content_type='application/json')
+
+    def objects(self):
+        return {name for _, _, names in os.walk(note_history.objects_dir()) for name in names}
+
+    def object_bytes(self):
+        return sum(os.path.getsize(os.path.join(dirpath, name)) for dirpath, _, names in os.walk(note_history.objects_dir()) for name in names)
+
+    def test_edits_store_only_changed_chunks(self):
+        chunks = note_history.split_chunks(self.blocks)
+        self.assertGreater(len(chunks), 10)
+        self.assertEqual(''.join(chunks), ''.join(self.blocks))
+        # Boundaries are content-defined: an insert at the start only changes the first chunk
+        shifted = note_history.split_chunks(['<h1>New</h1>'] + self.blocks)
+        self.assertEqual(shifted[1:], chunks[1:])
+
+        self.save(self.blocks)
+        stored = self.objects()
+        for i in range(20):
+            self.blocks[100] = f'<p>edit {i}</p>'
+            self.save(self.blocks)
+        self.assertLessEqual(len(self.objects() - stored), 20)
+
+        versions = self.client.get(reverse('note_versions', args=[self.note.id])).json()['versions']
+        self.assertEqual([v['id'] for v in versions], list(range(21, 0, -1)))
+        self.assertEqual(versions[0]['bytes'], len(''.join(self.blocks)))
+
+        note_store.recompress(self.path, 'identity') # Same content: no new entry
+        self.assertEqual(len(note_history.versions(self.path)), 21)
+
+    def test_edits_inside_a_huge_block_store_only_changed_chunks(self):
+        lines = [f'<p>{i} {random.Random(i).randbytes(50).hex()}</p>\n' for i in range(5000)]
+        self.save(['<div>' + ''.join(lines) + '</div>']) # One block, larger than a section
+        stored = self.object_bytes()
+        for i in range(20):
+            lines[i * 200] = f'<p>edit {i}</p>\n'
+            self.save(['<div>' + ''.join(lines) + '</div>'])
+        self.assertLess(self.object_bytes() - stored, stored / 2)
+        self.assertEqual(note_history.latest(self.path), '<div>' + ''.join(lines) + '</div>')
+
+    def test_restore_and_garbage_collection(self):
+        self.save(self.blocks)
+        self.save(['<p>replaced</p>'])
+        response = self.client.post(reverse('restore_note_version', args=[self.note.id, 1]))
+        self.assertEqual(response.json()['status'], 'ok')
+        self.assertEqual(self.note.get_content_from_file(), ''.join(self.blocks))
+        self.assertEqual(len(note_history.versions(self.path)), 3)
+        self.assertEqual(self.client.post(reverse('restore_note_version', args=[self.note.id, 9])).status_code, 404)
+
+        self.client.force_login(self.other)
+        self.assertEqual(self.client.get(reverse('note_versions', args=[self.note.id])).status_code, 404)
+        self.assertEqual(self.client.post(reverse('restore_note_version', args=[self.note.id, 1])).status_code, 404)
+
+        self.client.post(reverse('save_common_note'), '{"content": "<p>mine</p>"}', content_type='application/json')
+        self.assertEqual(len(self.client.get(reverse('common_note_versions')).json()['versions']), 1)
+
+        before = len(self.objects())
+        out = io.StringIO()
+        call_command('gc_note_objects', keep=1, grace=0, stdout=out)
+        self.assertIn('Dropped 2 old versions', out.getvalue())
+        self.assertEqual(len(self.objects()), before - 1) # Only '<p>replaced</p>' is unused
+        self.assertEqual(note_history.content(self.path, 3), ''.join(self.blocks))
 
-# Create your tests here.
@@ -13,16 +13,28 @@ urlpatterns = [
     path('setup-api-key/', views.setup_api_key, name='setup_api_key'),
     path('create_exam/', views.create_exam, name='create_exam'),
     path('exam/<int:exam_id>/', views.exam_detail, name='exam_detail'),
+    path('exam/<int:exam_id>/import-playlists/', views.import_playlists, name='import_playlists'),
+    path('exam/<int:exam_id>/export/', views.export_exam, name='export_exam'),
+    path('exams/import/', views.import_exam, name='import_exam'),
     path('subject/<int:subject_id>/', views.subject_detail, name='subject_detail'),
     path('subject/<int:subject_id>/add_playlist/', views.add_playlist, name='add_playlist'),
+    path('subject/<int:subject_id>/resync_playlist/', views.resync_playlist, name='resync_playlist'),
+    path('import/<int:job_id>/', views.import_job_status, name='import_job_status'),
     path('subject/<int:subject_id>/add_video/', views.add_video, name='add_video'),
     path('subject/<int:subject_id>/set_goal/', views.set_daily_goal, name='set_daily_goal'),
     path('video/<int:video_id>/status/', views.update_video_status, name='update_video_status'),
     path('chunk/<int:chunk_id>/status/', views.update_chunk_status, name='update_chunk_status'),
     path('note/<int:note_id>/save/', views.save_note, name='save_note'),
     path('note/<int:note_id>/content/', views.get_note_content, name='get_note_content'),
+    path('note/<int:note_id>/sections/', views.get_note_outline, name='get_note_outline'),
+    path('note/<int:note_id>/sections/<str:section_id>/', views.get_note_section, name='get_note_section'),
+    path('note/<int:note_id>/versions/', views.note_versions, name='note_versions'),
+    path('note/<int:note_id>/versions/<int:history_id>/restore/', views.restore_note_version, name='restore_note_version'),
     path('common-notes/', views.common_note_view, name='common_note'),
+    path('common-notes/content/', views.get_common_note_content, name='get_common_note_content'),
     path('common-notes/save/', views.save_common_note, name='save_common_note'),
+    path('common-notes/versions/', views.common_note_versions, name='common_note_versions'),
+    path('common-notes/versions/<int:history_id>/restore/', views.restore_common_note_version, name='restore_common_note_version'),
     path('exam/<int:exam_id>/delete/', views.delete_exam, name='delete_exam'),
     path('subject/<int:subject_id>/delete/', views.delete_subject, name='delete_subject'),
     path('subject/<int:subject_id>/delete-playlist/', views.delete_playlist, name='delete_playlist'),
@@ -32,4 +44,7 @@ urlpatterns = [
     path('api/save-focus-progress/', views.save_focus_progress, name='save_focus_progress'),
     path('api/timer/start/', views.start_timer, name='start_timer'),
     path('api/timer/stop/', views.stop_timer, name='stop_timer'),
+    path('api/history/', views.get_history, name='get_history'),
+    path('api/search/', views.search_notes, name='search_notes'),
+    path('api/export/', views.export_history, name='export_history'),
 ]
@@ -1,137 +1,418 @@
+import logging
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
-# REMOVED: from django.conf import settings
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.core.cache import cache
+from core.services import youtube_cache, quota
 
-def fetch_playlist_items(playlist_url, api_key):
+logger = logging.getLogger(__name__)
+
+DURATION_RE = re.compile(r'PT((?P<hours>\d+)H)?((?P<minutes>\d+)M)?((?P<seconds>\d+)S)?')
+
+# Error reasons worth retrying besides 5xx responses
+RETRY_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded', 'backendError'}
+# Error reasons meaning the key has no quota left today
+QUOTA_REASONS = {'quotaExceeded', 'dailyLimitExceeded'}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def parse_duration(duration_str):
+    """Parses ISO 8601 duration string to seconds."""
+    match = DURATION_RE.match(duration_str or '')
+    if not match:
+        return 0
+
+    hours = int(match.group('hours') or 0)
+    minutes = int(match.group('minutes') or 0)
+    seconds = int(match.group('seconds') or 0)
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def get_session():
+    """
+    Shared requests.Session so every YouTube call reuses pooled keep-alive
+    connections. The pool is sized for YOUTUBE_MAX_WORKERS concurrent calls.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            pool_size = getattr(settings, 'YOUTUBE_MAX_WORKERS', 4)
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size + 1)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+
+def error_reason(data):
+    """First error reason of an API error body, e.g. 'quotaExceeded'."""
+    errors = data.get('error', {}).get('errors') or [{}]
+    return errors[0].get('reason')
+
+
+def _backoff(attempt):
+    """Full-jitter exponential backoff: a random wait of up to base * 2^attempt seconds."""
+    base = getattr(settings, 'YOUTUBE_BACKOFF_BASE', 0.5)
+    time.sleep(random.uniform(0, base * 2 ** attempt))
+
+
+def youtube_get(endpoint, params, etag=None):
+    """
+    GETs a YouTube Data API endpoint and returns the decoded JSON body.
+    With an etag the request is conditional and None means "not modified".
+    Every attempt goes through the key's rate limiter and quota budget
+    (core.services.quota); connection errors, 5xx and rate limit errors are
+    retried up to YOUTUBE_MAX_RETRIES times with jittered exponential backoff.
+    Raises quota.QuotaExceeded when the key's quota is used up, whether by our
+    own estimate or according to the API.
+    """
+    base_url = getattr(settings, 'YOUTUBE_API_URL', 'https://www.googleapis.com/youtube/v3')
+    timeout = getattr(settings, 'YOUTUBE_TIMEOUT', (3.05, 10))
+    retries = getattr(settings, 'YOUTUBE_MAX_RETRIES', 3)
+    headers = {'If-None-Match': etag} if etag else None
+
+    for attempt in range(retries + 1):
+        quota.acquire(params['key'], endpoint)
+        try:
+            response = get_session().get(f"{base_url}/{endpoint}", params=params, headers=headers, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+            _backoff(attempt)
+            continue
+
+        if response.status_code == 304:
+            return None
+        try:
+            data = response.json()
+        except ValueError:
+            data = {'error': {'code': response.status_code, 'message': response.text[:200]}}
+
+        if attempt < retries and (response.status_code >= 500 or error_reason(data) in RETRY_REASONS):
+            logger.info("Retrying YouTube %s after %s (attempt %d)", endpoint, response.status_code, attempt + 1)
+            _backoff(attempt)
+            continue
+        if error_reason(data) in QUOTA_REASONS:
+            quota.exhausted(params['key'])
+            raise quota.QuotaExceeded()
+        return data
+
+
+def _fetch_metadata(video_ids, api_key):
+    """{video_id: {'title', 'duration'}} for up to 50 ids, from one videos.list call."""
+    data = youtube_get('videos', {
+        'part': 'snippet,contentDetails',
+        'id': ','.join(video_ids),
+        'key': api_key
+    })
+    if 'error' in data:
+        raise ValueError(f"YouTube API Error: {data['error']}")
+
+    return {
+        item['id']: {
+            'title': item['snippet']['title'],
+            'duration': parse_duration(item['contentDetails']['duration']),
+        }
+        for item in data.get('items', [])
+    }
+
+
+def playlist_id_from_url(playlist_url):
+    """The list= parameter of a playlist URL, or None."""
+    if not playlist_url or "list=" not in playlist_url:
+        return None
+    return playlist_url.split("list=")[1].split("&")[0] or None
+
+
+def _parse_page(items):
+    """(video_ids, {video_id: title}) of one playlistItems page."""
+    video_ids = []
+    titles = {}
+    for item in items:
+        snippet = item['snippet']
+        resource = snippet.get('resourceId', {})
+        video_id = resource.get('videoId')
+
+        if not video_id: continue
+
+        title = snippet.get('title', 'Unknown')
+
+        # Filter out deleted/private videos
+        if title == "Private video" or title == "Deleted video":
+            continue
+
+        video_ids.append(video_id)
+        titles[video_id] = title
+    return video_ids, titles
+
+
+def _list_playlist(playlist_id, api_key, etag=None):
+    """
+    Reads every playlistItems page of a playlist. Makes no database queries,
+    so it can run on a pool thread. Returns None when `etag` still matches,
+    else (etag, video_ids, titles). Raises ValueError on API errors.
+    """
+    params = {'part': 'snippet', 'maxResults': 50, 'playlistId': playlist_id, 'key': api_key}
+    video_ids, titles = [], {}
+    first_etag = None
+    while True:
+        data = youtube_get('playlistItems', params, etag=etag if first_etag is None else None)
+        if data is None:
+            return None
+        if 'error' in data:
+            raise ValueError(f"YouTube API Error: {data['error']}")
+        if first_etag is None:
+            first_etag = data.get('etag') or ''
+
+        items = data.get('items', [])
+        page_ids, page_titles = _parse_page(items)
+        video_ids.extend(page_ids)
+        titles.update(page_titles)
+
+        if not items or not data.get('nextPageToken'):
+            return first_etag, video_ids, titles
+        params['pageToken'] = data['nextPageToken']
+
+
+def fetch_playlists(playlist_urls, api_key):
+    """
+    Fetches several playlists at once for batch imports. The listings run
+    concurrently on a pool of YOUTUBE_MAX_WORKERS threads; the videos of all
+    playlists then go through one cache lookup, and the ids still missing are
+    deduplicated and sent to videos.list in full batches of 50 on the same pool.
+    Cache and quota bookkeeping stays on the calling thread.
+    Returns (results, errors): {playlist_url: [video dicts]} and {playlist_url: message}.
+    """
+    playlist_ids = {url: playlist_id_from_url(url) for url in playlist_urls}
+    errors = {url: "Invalid playlist URL" for url, playlist_id in playlist_ids.items() if not playlist_id}
+    cached = youtube_cache.get_playlists({pid for pid in playlist_ids.values() if pid})
+
+    listings = {} # playlist_id -> (video_ids, titles)
+    failed = {} # playlist_id -> message
+    metadata = {}
+    quota.load(api_key) # Before the pool, so its threads need no connection
+
+    try:
+        with ThreadPoolExecutor(max_workers=getattr(settings, 'YOUTUBE_MAX_WORKERS', 4)) as pool:
+            futures = {}
+            for playlist_id, (entry, is_fresh) in cached.items():
+                if is_fresh:
+                    listings[playlist_id] = (list(entry.video_ids), {})
+                else:
+                    futures[playlist_id] = pool.submit(_list_playlist, playlist_id, api_key, entry.etag if entry else None)
+
+            for playlist_id, future in futures.items():
+                try:
+                    result = future.result()
+                except Exception as e:
+                    failed[playlist_id] = str(e)
+                    continue
+                if result is None: # Not modified since it was cached
+                    youtube_cache.touch_playlist(playlist_id)
+                    listings[playlist_id] = (list(cached[playlist_id][0].video_ids), {})
+                else:
+                    etag, video_ids, titles = result
+                    youtube_cache.store_playlist(playlist_id, etag, video_ids)
+                    listings[playlist_id] = (video_ids, titles)
+
+            all_ids = list(dict.fromkeys(vid for video_ids, _ in listings.values() for vid in video_ids))
+            metadata.update(youtube_cache.cached_videos(all_ids))
+            missing = [vid for vid in all_ids if vid not in metadata]
+            lookups = [
+                (set(missing[start:start + 50]), pool.submit(_fetch_metadata, missing[start:start + 50], api_key))
+                for start in range(0, len(missing), 50)
+            ]
+
+            fetched = {}
+            for batch, future in lookups:
+                try:
+                    fetched.update(future.result())
+                except Exception as e:
+                    for playlist_id, (video_ids, _) in listings.items():
+                        if not batch.isdisjoint(video_ids):
+                            failed.setdefault(playlist_id, str(e))
+
+        youtube_cache.store_videos(fetched)
+        metadata.update(fetched)
+    finally:
+        quota.sync(api_key)
+
+    results = {}
+    for url, playlist_id in playlist_ids.items():
+        if not playlist_id:
+            continue
+        if playlist_id in failed:
+            errors[url] = failed[playlist_id]
+            continue
+        video_ids, titles = listings[playlist_id]
+        results[url] = [
+            {
+                'title': titles.get(vid) or metadata.get(vid, {}).get('title', 'Unknown'),
+                'video_id': vid,
+                'url': f"https://www.youtube.com/watch?v={vid}",
+                'duration': metadata.get(vid, {}).get('duration', 0)
+            }
+            for vid in video_ids
+        ]
+    return results, errors
+
+
+def fetch_playlist_items(playlist_url, api_key, on_page=None, force=False):
     """
     Fetches videos from a YouTube playlist URL.
+    The playlist's video ids come from the shared playlist cache while it is fresh;
+    a stale entry is revalidated with its etag. Only videos missing from the shared
+    metadata cache (or stale there) are looked up with videos.list, on a thread pool
+    that runs the lookup for page N while page N+1 is listed. At most
+    YOUTUBE_MAX_WORKERS lookups are in flight.
+    With force (resyncs) the cached playlist is always revalidated, and videos that
+    are new to it or listed under a different title are looked up again even when
+    their metadata is still cached.
+    on_page(pages_fetched, videos_found) is called after every listing page.
     Returns:
-       - Success: List of dicts [{'title':..., 'video_id':..., 'url':...}]
+       - Success: List of dicts [{'title':..., 'video_id':..., 'url':..., 'duration':...}]
        - Failure: Returns None (logs error) or empty list
+    Raises quota.QuotaExceeded when the key's quota runs out, so callers can say so.
     """
     if not api_key:
-        print("Error: No API Key provided to fetch_playlist_items")
+        logger.error("No API Key provided to fetch_playlist_items")
         return None
 
     # Extract playlist ID from URL
-    if "list=" not in playlist_url:
-        print("Error: Invalid Playlist URL")
+    playlist_id = playlist_id_from_url(playlist_url)
+    if not playlist_id:
+        logger.error("Invalid Playlist URL: %s", playlist_url)
         return None
-    
-    try:
-        playlist_id = playlist_url.split("list=")[1].split("&")[0]
-    except IndexError:
-         return None
-    
-    api_url = "https://www.googleapis.com/youtube/v3/playlistItems"
+
     params = {
         'part': 'snippet',
         'maxResults': 50,
         'playlistId': playlist_id,
         'key': api_key
     }
-    
-    videos = []
-    next_page_token = None
-    
-    import re
-    def parse_duration(duration_str):
-        """Parses ISO 8601 duration string to seconds."""
-        match = re.match(
-            r'PT((?P<hours>\d+)H)?((?P<minutes>\d+)M)?((?P<seconds>\d+)S)?',
-            duration_str
-        )
-        if not match:
-            return 0
-        
-        hours = int(match.group('hours') or 0)
-        minutes = int(match.group('minutes') or 0)
-        seconds = int(match.group('seconds') or 0)
-        return hours * 3600 + minutes * 60 + seconds
 
-    while True:
-        if next_page_token:
-            params['pageToken'] = next_page_token
-            
-        try:
-            response = requests.get(api_url, params=params)
-            data = response.json()
-            
-            if 'error' in data:
-                print(f"YouTube API Error: {data['error']}")
-                return None
-                
-            items = data.get('items', [])
-            if not items:
-                break
-
-            # Collect video IDs for batch details fetch
-            video_ids = []
-            snippet_map = {}
-            
-            for item in items:
-                snippet = item['snippet']
-                resource = snippet.get('resourceId', {})
-                video_id = resource.get('videoId')
-                
-                if not video_id: continue
-                
-                title = snippet.get('title', 'Unknown')
-                
-                # Filter out deleted/private videos
-                if title == "Private video" or title == "Deleted video":
-                    continue
-                
-                video_ids.append(video_id)
-                snippet_map[video_id] = title
-
-            # Fetch content details (duration)
-            if video_ids:
-                details_url = "https://www.googleapis.com/youtube/v3/videos"
-                details_params = {
-                    'part': 'contentDetails',
-                    'id': ','.join(video_ids),
-                    'key': api_key
-                }
-                details_resp = requests.get(details_url, params=details_params)
-                details_data = details_resp.json()
-                
-                duration_map = {}
-                for vid_item in details_data.get('items', []):
-                     vid_id = vid_item['id']
-                     duration_str = vid_item['contentDetails']['duration']
-                     duration_map[vid_id] = parse_duration(duration_str)
-
-                # Assemble final list
-                for vid_id in video_ids:
-                    videos.append({
-                        'title': snippet_map.get(vid_id, 'Unknown'),
-                        'video_id': vid_id,
-                        'url': f"https://www.youtube.com/watch?v={vid_id}",
-                        'duration': duration_map.get(vid_id, 0)
-                    })
-            
-            next_page_token = data.get('nextPageToken')
-            if not next_page_token:
-                break
-                
-        except Exception as e:
-            print(f"Error fetching playlist: {e}")
-            return None
-            
+    max_workers = getattr(settings, 'YOUTUBE_MAX_WORKERS', 4)
+    cached, is_fresh = youtube_cache.get_playlist(playlist_id)
+    known_ids = None # Ids of the cached listing, when forcing a refresh
+    if force:
+        is_fresh = False
+        known_ids = set(cached.video_ids) if cached else set()
+
+    video_ids = []
+    titles = {} # From the listing, fresher than the cache
+    metadata = {}
+    pending = []
+    quota.load(api_key) # Before the pool, so its threads need no connection
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            def lookup(ids):
+                found = youtube_cache.cached_videos(ids)
+                if known_ids is not None:
+                    found = {
+                        vid: details for vid, details in found.items()
+                        if vid in known_ids and titles.get(vid, details['title']) == details['title']
+                    }
+                metadata.update(found)
+                missing = [vid for vid in ids if vid not in metadata]
+                for start in range(0, len(missing), 50):
+                    # Keep the number of pending lookups bounded
+                    in_flight = [future for future in pending if not future.done()]
+                    if len(in_flight) >= max_workers:
+                        in_flight[0].result()
+                    pending.append(pool.submit(_fetch_metadata, missing[start:start + 50], api_key))
+
+            if is_fresh:
+                video_ids = list(cached.video_ids)
+                lookup(video_ids)
+                if on_page:
+                    on_page(0, len(video_ids))
+
+            etag = None
+            pages = 0
+            while not is_fresh:
+                first_page = 'pageToken' not in params
+                data = youtube_get('playlistItems', params, etag=cached.etag if cached and first_page else None)
+
+                if data is None: # Not modified since it was cached
+                    pages += 1
+                    youtube_cache.touch_playlist(playlist_id)
+                    video_ids = list(cached.video_ids)
+                    lookup(video_ids)
+                    if on_page:
+                        on_page(pages, len(video_ids))
+                    break
+
+                if 'error' in data:
+                    logger.error("YouTube API Error: %s", data['error'])
+                    return None
+
+                if first_page:
+                    etag = data.get('etag')
+
+                items = data.get('items', [])
+                page_ids, page_titles = _parse_page(items)
+                titles.update(page_titles)
+
+                video_ids.extend(page_ids)
+                lookup(page_ids)
+                pages += 1
+                if on_page:
+                    on_page(pages, len(video_ids))
+
+                next_page_token = data.get('nextPageToken')
+                if not items or not next_page_token:
+                    youtube_cache.store_playlist(playlist_id, etag, video_ids)
+                    break
+                params['pageToken'] = next_page_token
+
+            fetched = {}
+            for future in pending:
+                fetched.update(future.result())
+
+        youtube_cache.store_videos(fetched)
+        metadata.update(fetched)
+
+    except quota.QuotaExceeded:
+        raise
+    except Exception as e:
+        logger.error("Error fetching playlist: %s", e)
+        return None
+    finally:
+        quota.sync(api_key)
+
+    # Assemble final list
+    videos = []
+    for vid_id in video_ids:
+        details = metadata.get(vid_id, {})
+        videos.append({
+            'title': titles.get(vid_id) or details.get('title', 'Unknown'),
+            'video_id': vid_id,
+            'url': f"https://www.youtube.com/watch?v={vid_id}",
+            'duration': details.get('duration', 0)
+        })
     return videos
 
+
 def fetch_video_details(video_url, api_key):
     """
-    Fetches details for a single video.
+    Fetches details for a single video, from the shared metadata cache when it is fresh.
     Returns:
         - Success: dict {'title':, 'video_id':, 'duration':, 'url':}
         - Failure: None
     """
     if not api_key:
-        print("Error: No API Key provided to fetch_video_details")
+        logger.error("No API Key provided to fetch_video_details")
         return None
 
-    import re
     # Extract Video ID
     # Supports: youtube.com/watch?v=ID, youtu.be/ID
     video_id = None
@@ -144,53 +425,81 @@ def fetch_video_details(video_url, api_key):
         try:
             video_id = video_url.split("/")[-1].split("?")[0]
         except IndexError: pass
-        
+
     if not video_id:
         return None
 
-    api_url = "https://www.googleapis.com/youtube/v3/videos"
+    cached = youtube_cache.cached_videos([video_id]).get(video_id)
+    if cached:
+        return {
+            'title': cached['title'],
+            'video_id': video_id,
+            'duration': cached['duration'],
+            'url': f"https://www.youtube.com/watch?v={video_id}"
+        }
+
     params = {
         'part': 'snippet,contentDetails',
         'id': video_id,
         'key': api_key
     }
-    
+
     try:
-        response = requests.get(api_url, params=params)
-        data = response.json()
-        
+        data = youtube_get('videos', params)
+
         if 'error' in data:
-            print(f"YouTube API Error: {data['error']}")
+            logger.error("YouTube API Error: %s", data['error'])
             return None
-        
+
         if 'items' not in data or not data['items']:
             return None
-            
+
         item = data['items'][0]
         snippet = item['snippet']
         content_details = item['contentDetails']
-        
-        # Parse Duration
-        def parse_duration(duration_str):
-             match = re.match(
-                r'PT((?P<hours>\d+)H)?((?P<minutes>\d+)M)?((?P<seconds>\d+)S)?',
-                duration_str
-            )
-             if not match: return 0
-             hours = int(match.group('hours') or 0)
-             minutes = int(match.group('minutes') or 0)
-             seconds = int(match.group('seconds') or 0)
-             return hours * 3600 + minutes * 60 + seconds
 
         duration = parse_duration(content_details['duration'])
-        
+        youtube_cache.store_videos({video_id: {'title': snippet['title'], 'duration': duration}})
+
         return {
             'title': snippet['title'],
             'video_id': video_id,
             'duration': duration,
             'url': f"https://www.youtube.com/watch?v={video_id}"
         }
-        
+
     except Exception as e:
-        print(f"Error fetching video details: {e}")
+        logger.error("Error fetching video details: %s", e)
+        return None
+    finally:
+        quota.sync(api_key)
+
+
+def validate_api_key(api_key):
+    """
+    Probes a key with a one-result mostPopular videos.list call.
+    Returns None for a working key or a user-facing error message.
+    Successful validations are cached for YOUTUBE_KEY_VALIDATION_TTL seconds,
+    so saving the same key again does not spend quota.
+    """
+    cache_key = f"youtube-key-valid:{quota.key_hash(api_key)}"
+    if cache.get(cache_key):
         return None
+
+    try:
+        data = youtube_get('videos', {'part': 'id', 'chart': 'mostPopular', 'maxResults': 1, 'key': api_key})
+    except quota.QuotaExceeded:
+        return "This key has exceeded its quota."
+    except Exception as e:
+        return f"Network Error: {str(e)}"
+    finally:
+        quota.sync(api_key)
+
+    if 'error' in data:
+        reason = error_reason(data)
+        if reason == 'keyInvalid':
+            return "Invalid API Key."
+        return f"API Error: {data['error'].get('message', 'Unknown')}"
+
+    cache.set(cache_key, True, getattr(settings, 'YOUTUBE_KEY_VALIDATION_TTL', 24 * 3600))
+    return None
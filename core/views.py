@@ -1,16 +1,20 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.db import models
+from django.db import models, transaction
 from django.contrib import messages
 from django.contrib.auth import login
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse, FileResponse, HttpResponse
+from django.http import JsonResponse, FileResponse, HttpResponse, StreamingHttpResponse
+from django.conf import settings
+from django.urls import reverse
 from django.utils import timezone
-from django.views.decorators.http import require_POST
-from .models import Exam, Subject, Video, Note, UserProfile, DailyStudyLog, CommonNote, StudySession, DailyGoal, Streak, VideoChunk
-from .utils import fetch_playlist_items, fetch_video_details
+from django.views.decorators.http import require_POST, etag
+from .models import Exam, Subject, Video, Note, UserProfile, DailyStudyLog, CommonNote, StudySession, DailyGoal, VideoChunk, ImportJob
+from .utils import fetch_video_details, validate_api_key
+from .services.analytics import get_exam_analytics, analytics_etag
+from .services import progress, history, streaks, imports, note_store, note_search, note_history
 import os
-import requests
+import re
 
 def register(request):
     if request.method == 'POST':
@@ -32,34 +36,19 @@ def setup_api_key(request):
         if not key:
             error = "API Key cannot be empty."
         else:
-            # Validate Key with a simple list request
-            try:
-                test_url = "https://www.googleapis.com/youtube/v3/videos?part=snippet&chart=mostPopular&maxResults=1&key=" + key
-                response = requests.get(test_url)
-                data = response.json()
-                
-                if 'error' in data:
-                    reason = data['error'].get('errors', [{}])[0].get('reason', 'Unknown')
-                    if reason == 'quotaExceeded':
-                         error = "This key has exceeded its quota."
-                    elif reason == 'keyInvalid':
-                         error = "Invalid API Key."
-                    else:
-                         error = f"API Error: {data['error']['message']}"
-                else:
-                    # Valid!
-                    profile, _ = UserProfile.objects.get_or_create(user=request.user)
-                    profile.google_api_key = key
-                    profile.save()
-                    return redirect('dashboard')
-            except Exception as e:
-                error = f"Network Error: {str(e)}"
+            # Validate Key with a simple list request (cached once it succeeds)
+            error = validate_api_key(key)
+            if not error:
+                profile, _ = UserProfile.objects.get_or_create(user=request.user)
+                profile.google_api_key = key
+                progress.save_profile(profile)
+                return redirect('dashboard')
     
     return render(request, 'setup_api_key.html', {'error': error})
 
 @login_required
 def dashboard(request):
-    exams = request.user.exams.all()
+    exams = request.user.exams.annotate(subject_count=models.Count('subjects'))
     # API Key check handled by middleware now.
     
     skill_analytics = [] 
@@ -67,17 +56,8 @@ def dashboard(request):
     today = timezone.localdate()
     todays_goal = DailyGoal.objects.filter(user=request.user, date=today).first()
     show_modal = not todays_goal
-    streak, _ = Streak.objects.get_or_create(user=request.user)
-    
-    # Check for streak reset (if yesterday goal missed)
-    profile = request.user.profile
-    
-    # Logic: If last goal achieved was before yesterday, reset streak.
-    if profile.last_goal_date and profile.last_goal_date < (today - timezone.timedelta(days=1)):
-        profile.current_streak = 0
-        profile.save()
-        streak.current_streak = 0
-        streak.save()
+    # Read-only: resets are written by the nightly `manage.py rollover_streaks`
+    streak = streaks.displayed_streak(request.user)
     
     context = {
         'exams': exams,
@@ -92,132 +72,19 @@ def dashboard(request):
 
 @login_required
 def analytics_dashboard(request):
-    analytics_data = []
-    
-    # 1. Fetch Goals (Exams)
-    goals = Exam.objects.filter(user=request.user).prefetch_related('subjects')
-    
-    for goal in goals:
-        goal_total_seconds = 0
-        subjects_data = []
-        
-        # 2. Iterate Subjects
-        for subject in goal.subjects.all():
-            # Calculate Chunk Hours
-            chunk_seconds = VideoChunk.objects.filter(
-                video__subject=subject,
-                is_watched=True
-            ).aggregate(
-                total=models.Sum(models.F('end_seconds') - models.F('start_seconds'))
-            )['total'] or 0
-            
-            # Calculate Whole Video Hours (exclude chunked videos)
-            video_seconds = Video.objects.filter(
-                subject=subject,
-                is_watched=True,
-                is_chunked=False
-            ).aggregate(
-                total=models.Sum('duration_seconds')
-            )['total'] or 0
-            
-            subject_total_seconds = chunk_seconds + video_seconds
-            goal_total_seconds += subject_total_seconds
-            
-            if subject_total_seconds > 0:
-                subjects_data.append({
-                    'name': subject.name,
-                    'seconds': subject_total_seconds,
-                    'hours': round(subject_total_seconds / 3600, 1)
-                })
-        
-        # 3. Calculate Percentages
-        for sub in subjects_data:
-            sub['percent'] = round((sub['seconds'] / goal_total_seconds) * 100, 1) if goal_total_seconds > 0 else 0
-            
-        # Sort subjects by contribution (optional but nice)
-        subjects_data.sort(key=lambda x: x['seconds'], reverse=True)
-        
-        analytics_data.append({
-            'goal_name': goal.name,
-            'total_hours': round(goal_total_seconds / 3600, 1),
-            'subjects': subjects_data
-        })
-        
+    analytics_data = get_exam_analytics(request.user)
     return render(request, 'analytics_dashboard.html', {'analytics_data': analytics_data})
 
 
 @login_required
+@etag(analytics_etag)
 def get_analytics_data(request):
-    exams = Exam.objects.filter(user=request.user).prefetch_related('subjects')
-    analytics_data = []
-    
-    for exam in exams:
-        subjects_data = []
-        exam_total_seconds = 0
-        
-        for subject in exam.subjects.all():
-            watched_seconds = Video.objects.filter(
-                subject=subject,
-                is_watched=True
-            ).aggregate(models.Sum('duration_seconds'))['duration_seconds__sum'] or 0
-            
-            exam_total_seconds += watched_seconds
-            
-            if watched_seconds > 0:
-                subjects_data.append({
-                    'name': subject.name,
-                    'seconds': watched_seconds,
-                    'hours': round(watched_seconds / 3600, 1)
-                })
-        
-        # Calculate percentages
-        for sub in subjects_data:
-            sub['percentage'] = round((sub['seconds'] / exam_total_seconds) * 100, 1) if exam_total_seconds > 0 else 0
-            
-        analytics_data.append({
-            'goal_name': exam.name,
-            'total_hours': round(exam_total_seconds / 3600, 1),
-            'subjects': sorted(subjects_data, key=lambda x: x['hours'], reverse=True)
-        })
-        
+    analytics_data = get_exam_analytics(request.user)
     return JsonResponse({'status': 'ok', 'data': analytics_data})
 
 @login_required
 def analytics_details(request):
-
-    exams = Exam.objects.filter(user=request.user).prefetch_related('subjects')
-    
-    analytics_data = []
-    
-    for exam in exams:
-        subjects_data = []
-        exam_total_seconds = 0
-        
-        for subject in exam.subjects.all():
-            watched_seconds = Video.objects.filter(
-                subject=subject,
-                is_watched=True
-            ).aggregate(models.Sum('duration_seconds'))['duration_seconds__sum'] or 0
-            
-            exam_total_seconds += watched_seconds
-            
-            if watched_seconds > 0:
-                subjects_data.append({
-                    'name': subject.name,
-                    'seconds': watched_seconds,
-                    'hours': round(watched_seconds / 3600, 1)
-                })
-        
-        # Calculate percentages
-        for sub in subjects_data:
-            sub['percentage'] = round((sub['seconds'] / exam_total_seconds) * 100, 1) if exam_total_seconds > 0 else 0
-            
-        analytics_data.append({
-            'goal_name': exam.name,
-            'total_hours': round(exam_total_seconds / 3600, 1),
-            'subjects': sorted(subjects_data, key=lambda x: x['hours'], reverse=True)
-        })
-        
+    analytics_data = get_exam_analytics(request.user)
     return render(request, 'analytics_subject.html', {'analytics_data': analytics_data})
 
 @login_required
@@ -231,49 +98,181 @@ def create_exam(request):
         name = request.POST.get('name')
         if name:
             Exam.objects.create(user=request.user, name=name)
+            progress.bump_progress_version(request.user)
         return redirect('dashboard')
     return render(request, 'create_exam.html')
 
 @login_required
 def exam_detail(request, exam_id):
     exam = get_object_or_404(Exam, id=exam_id, user=request.user)
-    subjects = exam.subjects.all()
+    subjects = exam.subjects.annotate(video_count=models.Count('videos'))
     if request.method == 'POST': # Create Subject
         sub_name = request.POST.get('name')
         if sub_name:
             Subject.objects.create(exam=exam, name=sub_name)
+            progress.bump_progress_version(request.user)
             return redirect('exam_detail', exam_id=exam.id)
     return render(request, 'exam_detail.html', {'exam': exam, 'subjects': subjects})
 
+def accepts_encoding(request, encoding):
+    """
+    True when the request's Accept-Encoding gives `encoding` a q-value above 0.
+    The encoding's own entry wins over '*'; a malformed q-value counts as 0.
+    """
+    qualities = {}
+    for item in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, *params = item.split(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value.strip())
+                except ValueError:
+                    quality = 0.0
+        qualities[name] = max(quality, qualities.get(name, 0.0))
+    return qualities.get(encoding, qualities.get('*', 0.0)) > 0
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def parse_range(header, size):
+    """
+    (start, end) of a single 'bytes=' range, end inclusive. Returns None when
+    the header should be ignored (bad syntax or several ranges, served in
+    full) and raises ValueError when the range cannot be satisfied.
+    """
+    match = RANGE_RE.match(header.replace(' ', ''))
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first:
+        start, end = int(first), int(last) if last else size - 1
+        if last and end < start:
+            return None
+    else:
+        start, end = size - int(last), size - 1
+        if not int(last):
+            raise ValueError(header)
+    if start >= size:
+        raise ValueError(header)
+    return max(start, 0), min(end, size - 1)
+
+def note_body_response(body, encoding, size, byte_range, encoded, note_path=None):
+    """Streams an open body file, or a range of the note's content (closing the body)."""
+    content_type = 'text/html; charset=utf-8'
+    if byte_range:
+        body.close()
+        start, end = byte_range
+        response = StreamingHttpResponse(
+            note_store.open_range(note_path, start, end - start + 1),
+            status=206, content_type=content_type,
+        )
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = end - start + 1
+    elif encoded or encoding == 'identity':
+        response = FileResponse(body, content_type=content_type)
+        if encoded:
+            response['Content-Encoding'] = encoding
+    else:
+        response = StreamingHttpResponse(note_store.iter_decompressed(body, encoding), content_type=content_type)
+        response['Content-Length'] = size
+    return response
+
+def note_content_response(request, note):
+    """
+    Serves a note body (Note or CommonNote) with strong validators, so an
+    unchanged note is answered with 304, and single byte ranges of the
+    decompressed content for progressive loading. Full responses are the
+    stored bytes when the client accepts their compression, otherwise the
+    body is decompressed on the fly.
+    """
+    from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+    from django.utils.http import http_date, quote_etag
+    body, encoding, size, stat = note_store.stored_body(note.get_file_path())
+    if body is None:
+        return HttpResponse("")
+
+    # Cheap to compute: the save timestamp plus the stored file's size and mtime
+    validator = f"{note.id}-{int(note.updated_at.timestamp() * 1e6)}-{stat.st_size}-{stat.st_mtime_ns}"
+    last_modified = int(max(note.updated_at.timestamp(), stat.st_mtime))
+
+    byte_range = None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if request.META.get('HTTP_RANGE') and if_range in (None, quote_etag(validator), http_date(last_modified)):
+        try:
+            byte_range = parse_range(request.META['HTTP_RANGE'], size)
+        except ValueError:
+            body.close()
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+    # Ranges are always over the decompressed content
+    encoded = byte_range is None and encoding != 'identity' and accepts_encoding(request, encoding)
+    etag = quote_etag(f"{validator}-{encoding}" if encoded else validator)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = note_body_response(body, encoding, size, byte_range, encoded, note.get_file_path())
+    else:
+        body.close()
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Accept-Ranges'] = 'bytes'
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
+
 @login_required
 def get_note_content(request, note_id):
     note = get_object_or_404(Note, id=note_id, subject__exam__user=request.user)
     # type param ignored, always content
-    file_path = note.get_file_path()
-        
-    if os.path.exists(file_path):
-        return FileResponse(open(file_path, 'rb'))
-    return HttpResponse("")
+    return note_content_response(request, note)
+
+@login_required
+def get_note_outline(request, note_id):
+    """The note's section index, for loading long notes a section at a time."""
+    note = get_object_or_404(Note, id=note_id, subject__exam__user=request.user)
+    version, sections = note_store.outline(note.get_file_path())
+    return JsonResponse({'status': 'ok', 'version': version, 'sections': sections})
+
+@login_required
+def get_note_section(request, note_id, section_id):
+    """
+    One section's HTML. Sections are named by a hash of their content, so a
+    response never goes stale and may be cached for good.
+    """
+    from django.http import Http404
+    from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+    from django.utils.http import quote_etag
+    note = get_object_or_404(Note, id=note_id, subject__exam__user=request.user)
+    body, encoding, size = note_store.section_body(note.get_file_path(), section_id)
+    if body is None:
+        raise Http404("No such section")
+
+    encoded = encoding != 'identity' and accepts_encoding(request, encoding)
+    etag = quote_etag(f"{section_id}-{encoding}" if encoded else section_id)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = note_body_response(body, encoding, size, None, encoded)
+    else:
+        body.close()
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, max_age=365 * 24 * 3600, immutable=True)
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
 
 @login_required
 def subject_detail(request, subject_id):
-    subject = get_object_or_404(Subject, id=subject_id, exam__user=request.user)
+    subject = get_object_or_404(Subject.objects.select_related('exam'), id=subject_id, exam__user=request.user)
     
-    # Optimize: Fetch all videos once, calculate stats in python
     videos = list(subject.videos.all().prefetch_related('chunks')) 
     
-    total_items = 0
-    completed_items = 0
-    
-    for v in videos:
-        if v.is_chunked:
-            chunks = v.chunks.all()
-            total_items += len(chunks)
-            completed_items += sum(1 for c in chunks if c.is_watched)
-        else:
-            total_items += 1
-            if v.is_watched:
-                completed_items += 1
+    # Progress comes from the denormalized counters (core.services.progress)
+    total_items = subject.total_items
+    completed_items = subject.watched_items
                 
     note, created = Note.objects.get_or_create(subject=subject)
     # CONTENT LOAD REMOVED - Handled by lazy loading via get_note_content
@@ -286,29 +285,14 @@ def subject_detail(request, subject_id):
     today_minutes = round(daily_log.seconds_watched / 60, 1)
     
     # Playlist Stats (Hours)
-    total_seconds_watched = 0
-    total_seconds_left = 0
-    
-    for v in videos:
-        if v.is_chunked:
-            # For chunked, we calculate based on watched chunks
-             # This is tricky without exact chunk duration if slightly uneven, but valid enough
-             for c in v.chunks.all():
-                 dur = c.end_seconds - c.start_seconds
-                 if c.is_watched:
-                     total_seconds_watched += dur
-                 else:
-                     total_seconds_left += dur
-        else:
-            if v.is_watched:
-                total_seconds_watched += v.duration_seconds
-            else:
-                total_seconds_left += v.duration_seconds
-
+    total_seconds_watched = subject.watched_seconds
+    total_seconds_left = max(0, subject.total_seconds - subject.watched_seconds)
     
     watched_hours = "{:.2f}".format(total_seconds_watched / 3600)
     left_hours = "{:.2f}".format(total_seconds_left / 3600)
 
+    import_jobs = list(ImportJob.objects.filter(subject=subject, status__in=['queued', 'running']))
+
     return render(request, 'subject_detail.html', {
         'subject': subject,
         'videos': videos,
@@ -321,6 +305,7 @@ def subject_detail(request, subject_id):
         'remaining_goal': max(0, subject.daily_goal_minutes - today_minutes),
         'watched_hours': watched_hours,
         'left_hours': left_hours,
+        'import_jobs': import_jobs,
     })
 
 @login_required
@@ -334,23 +319,94 @@ def add_playlist(request, subject_id):
         if not api_key:
             return redirect('setup_api_key')
             
-        videos_data = fetch_playlist_items(url, api_key)
-        if videos_data:
-            for idx, vid in enumerate(videos_data):
-                Video.objects.create(
-                    subject=subject,
-                    title=vid['title'],
-                    video_id=vid['video_id'],
-                    url=vid['url'],
-                    order=idx,
-                    duration_seconds=vid.get('duration', 0)
-                )
-            messages.success(request, f"Successfully added {len(videos_data)} videos from playlist.")
-        else:
-            messages.error(request, 'Failed to fetch playlist items. Please check the URL and your API Key.')
+        if not url or "list=" not in url:
+            messages.error(request, 'Invalid playlist URL.')
+            return redirect('subject_detail', subject_id=subject.id)
+
+        # Fetching and inserting happens in `manage.py run_import_worker`
+        imports.enqueue(request.user, subject, url)
+        messages.success(request, "Playlist import started. Videos will appear here when it finishes.")
 
     return redirect('subject_detail', subject_id=subject.id)
 
+@require_POST
+@login_required
+def resync_playlist(request, subject_id):
+    subject = get_object_or_404(Subject, id=subject_id, exam__user=request.user)
+    if not subject.playlist_url:
+        messages.error(request, 'No playlist has been imported into this subject yet.')
+        return redirect('subject_detail', subject_id=subject.id)
+
+    # Same job as an import: existing videos are matched on video_id and keep their watched state.
+    # Forced, so the playlist is checked with YouTube even while our cached copy is fresh.
+    imports.enqueue(request.user, subject, subject.playlist_url, force=True)
+    messages.success(request, "Playlist resync started.")
+    return redirect('subject_detail', subject_id=subject.id)
+
+@require_POST
+@login_required
+def import_playlists(request, exam_id):
+    import json
+    exam = get_object_or_404(Exam, id=exam_id, user=request.user)
+    if not request.user.profile.google_api_key:
+        return JsonResponse({'status': 'error', 'message': 'Set up your YouTube API key first.'}, status=400)
+
+    try:
+        data = json.loads(request.body)
+        pairs = [(item['subject'].strip(), item['url'].strip()) for item in data['playlists']]
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return JsonResponse({
+            'status': 'error',
+            'message': 'Expected {"playlists": [{"subject": ..., "url": ...}, ...]}'
+        }, status=400)
+
+    limit = getattr(settings, 'IMPORT_BATCH_LIMIT', 50)
+    if not pairs or len(pairs) > limit:
+        return JsonResponse({'status': 'error', 'message': f'Send between 1 and {limit} playlists.'}, status=400)
+    if not all(name for name, _ in pairs):
+        return JsonResponse({'status': 'error', 'message': 'Every playlist needs a subject name.'}, status=400)
+
+    report = imports.import_playlists(request.user, exam, pairs)
+    return JsonResponse({'status': 'ok', 'results': report})
+
+@login_required
+def export_exam(request, exam_id):
+    """Streams the whole exam as a JSON Lines archive (?gzip=1 to compress it)."""
+    from core.services import export, exam_archive
+    exam = get_object_or_404(Exam, id=exam_id, user=request.user)
+    blocks = export.buffered(exam_archive.export_lines(exam))
+    filename = f"exam-{exam.id}.jsonl"
+    if request.GET.get('gzip') in ('1', 'true'):
+        response = StreamingHttpResponse(exam_archive.gzip_stream(blocks), content_type='application/gzip')
+        filename += '.gz'
+    else:
+        response = StreamingHttpResponse(blocks, content_type='application/x-ndjson')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+@require_POST
+@login_required
+def import_exam(request):
+    """Restores an uploaded exam archive (plain or gzipped) as a new exam."""
+    from core.services import exam_archive
+    archive = request.FILES.get('archive')
+    if not archive:
+        return JsonResponse({'status': 'error', 'message': 'Upload an exam archive as "archive".'}, status=400)
+    try:
+        exam = exam_archive.import_archive(
+            archive, request.user,
+            name=request.POST.get('name', '').strip() or None,
+            reset_progress=request.POST.get('reset_progress') in ('1', 'true', 'on'),
+        )
+    except (exam_archive.ArchiveError, OSError, EOFError) as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    return JsonResponse({'status': 'ok', 'exam_id': exam.id, 'name': exam.name})
+
+@login_required
+def import_job_status(request, job_id):
+    job = get_object_or_404(ImportJob, id=job_id, user=request.user)
+    return JsonResponse({'status': 'ok', 'job': imports.job_progress(job)})
+
 @login_required
 def add_video(request, subject_id):
     subject = get_object_or_404(Subject, id=subject_id, exam__user=request.user)
@@ -370,185 +426,164 @@ def add_video(request, subject_id):
         # Determine Order
         existing_count = Video.objects.filter(subject=subject).count()
         
-        video = Video.objects.create(
-            subject=subject,
-            title=details['title'],
-            video_id=details['video_id'],
-            url=details['url'],
-            order=existing_count,
-            duration_seconds=details['duration'],
-            is_chunked=(mode == 'chunk')
-        )
-        
-        if mode == 'chunk':
-            try:
-                interval_mins = int(request.POST.get('interval', 20))
-            except: interval_mins = 20
-            
-            interval_seconds = interval_mins * 60
-            duration = details['duration']
+        with transaction.atomic():
+            video = Video.objects.create(
+                subject=subject,
+                title=details['title'],
+                video_id=details['video_id'],
+                url=details['url'],
+                order=existing_count,
+                duration_seconds=details['duration'],
+                is_chunked=(mode == 'chunk')
+            )
             
             chunks = []
-            start = 0
-            part = 1
-            while start < duration:
-                end = min(start + interval_seconds, duration)
+            if mode == 'chunk':
+                try:
+                    interval_mins = int(request.POST.get('interval', 20))
+                except: interval_mins = 20
+            
+                interval_seconds = interval_mins * 60
+                duration = details['duration']
+            
+                start = 0
+                part = 1
+                while start < duration:
+                    end = min(start + interval_seconds, duration)
                 
-                # Title
-                # Convert seconds to MM:SS
-                def fmt(s): return f"{s//60:02d}:{s%60:02d}"
-                chunk_title = f"Part {part} ({fmt(start)} - {fmt(end)})"
+                    # Title
+                    # Convert seconds to MM:SS
+                    def fmt(s): return f"{s//60:02d}:{s%60:02d}"
+                    chunk_title = f"Part {part} ({fmt(start)} - {fmt(end)})"
                 
-                chunks.append(VideoChunk(
-                    video=video,
-                    part_number=part,
-                    title=chunk_title,
-                    start_seconds=start,
-                    end_seconds=end
-                ))
+                    chunks.append(VideoChunk(
+                        video=video,
+                        part_number=part,
+                        title=chunk_title,
+                        start_seconds=start,
+                        end_seconds=end
+                    ))
                 
-                start = end
-                part += 1
+                    start = end
+                    part += 1
+            
+                VideoChunk.objects.bulk_create(chunks)
             
-            VideoChunk.objects.bulk_create(chunks)
+            progress.apply_delta(subject, **progress.video_stats(video, chunks))
             
     return redirect('subject_detail', subject_id=subject.id)
 
+def _toggle_response(request, subject, seconds):
+    """
+    Books `seconds` of watch time (negative when unchecking, 0 when the
+    toggle changed nothing) on today's study log, history rollups and daily
+    goal, and returns the subject's and exam's running totals. A handful of
+    set-based queries, however much history the user has.
+    """
+    today = timezone.localdate()
+    today_seconds = history.record_watch(request.user, subject, today, seconds)
+
+    # Video time counts towards the global DailyGoal too (it tracks all study
+    # time, not only the focus timer); unchecking takes the time back off
+    if seconds:
+        daily_goal = DailyGoal.objects.filter(user=request.user, date=today).select_related('user').first()
+        if daily_goal:
+            streaks.add_goal_progress(daily_goal, seconds)
+
+    # --- Live Analytics ---
+    # Only the toggled item's subject and exam change, so return just their running totals
+    today_minutes = round(today_seconds / 60, 1)
+    totals = progress.live_totals(subject)
+    return JsonResponse({
+        'status': 'ok',
+        'today_minutes': today_minutes,
+        'remaining_goal': max(0, subject.daily_goal_minutes - today_minutes),
+        'analytics': totals['analytics'],
+        'subject': totals['subject']
+    })
+
 @require_POST
 @login_required
 def update_video_status(request, video_id):
-    video = get_object_or_404(Video, id=video_id, subject__exam__user=request.user)
+    video = get_object_or_404(Video.objects.select_related('subject'), id=video_id, subject__exam__user=request.user)
     import json
     data = json.loads(request.body)
-    video.is_watched = data.get('is_watched', False)
-    video.save()
-    
-    # Update Daily Log
-    today = timezone.localdate()
-    # Ensure log exists for this specific subject
-    daily_log, _ = DailyStudyLog.objects.get_or_create(
-        user=request.user, 
-        subject=video.subject, 
-        date=today
-    )
-    
-    if video.is_watched:
-        daily_log.seconds_watched += video.duration_seconds
-    else:
-        # Prevent negative values if unchecking
-        daily_log.seconds_watched = max(0, daily_log.seconds_watched - video.duration_seconds)
-    
-    daily_log.save()
-    today_minutes = round(daily_log.seconds_watched / 60, 1)
-
-    # Update Global Daily Goal from Video Watch Time
-    # If video is watched, we add the duration to the *Global* Daily Goal progress
-    # NOTE: This assumes `DailyGoal` tracks TOTAL study time, including videos.
-    # If `DailyGoal` is only for "Focus Timer", then we shouldn't add this.
-    # BUT, usually users want *all* study time to count.
-    # Let's add video duration to DailyGoal if it exists.
-    daily_goal = DailyGoal.objects.filter(user=request.user, date=today).first()
-    if daily_goal and video.is_watched:
-         daily_goal.completed_seconds += video.duration_seconds
-         # Check Goal
-         goal_seconds = int(daily_goal.goal_hours * 3600)
-         if daily_goal.completed_seconds >= goal_seconds and not daily_goal.achieved:
-            daily_goal.achieved = True
-            profile = request.user.profile
-            streak, _ = Streak.objects.get_or_create(user=request.user)
-            profile.current_streak += 1
-            profile.last_goal_date = today
-            profile.save()
-            streak.current_streak = profile.current_streak
-            streak.best_streak = max(streak.best_streak, streak.current_streak)
-            streak.save()
-         daily_goal.save()
-    elif daily_goal and not video.is_watched: # Unchecking
-         daily_goal.completed_seconds = max(0, daily_goal.completed_seconds - video.duration_seconds)
-         daily_goal.save()
-
-    # --- Live Analytics Calculation ---
-    # We want to return the updated total hours for ALL exams to update any listeners
-    all_exams = Exam.objects.filter(user=request.user)
-    analytics_response = {}
-    
-    for exam in all_exams:
-        total_seconds = Video.objects.filter(
-            subject__exam=exam, 
-            is_watched=True
-        ).aggregate(models.Sum('duration_seconds'))['duration_seconds__sum'] or 0
-        analytics_response[exam.name] = round(total_seconds / 3600, 1)
-    
-    return JsonResponse({
-        'status': 'ok', 
-        'today_minutes': today_minutes,
-        'remaining_goal': max(0, video.subject.daily_goal_minutes - today_minutes),
-        'analytics': analytics_response
-    })
+    seconds = 0 # Already in that state: nothing to book
+    if progress.set_video_watched(video, bool(data.get('is_watched', False))):
+        seconds = video.duration_seconds if video.is_watched else -video.duration_seconds
+    return _toggle_response(request, video.subject, seconds)
 
 @require_POST
 @login_required
 def update_chunk_status(request, chunk_id):
-    chunk = get_object_or_404(VideoChunk, id=chunk_id, video__subject__exam__user=request.user)
+    chunk = get_object_or_404(VideoChunk.objects.select_related('video__subject'), id=chunk_id, video__subject__exam__user=request.user)
     import json
     data = json.loads(request.body)
-    chunk.is_watched = data.get('is_watched', False)
-    chunk.save()
-    
-    # Update Daily Log
-    today = timezone.localdate()
-    daily_log, _ = DailyStudyLog.objects.get_or_create(
-        user=request.user, 
-        subject=chunk.video.subject, 
-        date=today
-    )
-    
-    duration = chunk.end_seconds - chunk.start_seconds
-    if chunk.is_watched:
-        daily_log.seconds_watched += duration
-    else:
-        daily_log.seconds_watched = max(0, daily_log.seconds_watched - duration)
-        
-    daily_log.save()
-    today_minutes = round(daily_log.seconds_watched / 60, 1)
-
-    # Update Global Goal for Chunk
-    daily_goal = DailyGoal.objects.filter(user=request.user, date=today).first()
-    if daily_goal:
-        if chunk.is_watched:
-             daily_goal.completed_seconds += duration
-             goal_seconds = int(daily_goal.goal_hours * 3600)
-             if daily_goal.completed_seconds >= goal_seconds and not daily_goal.achieved:
-                daily_goal.achieved = True
-                profile = request.user.profile
-                streak, _ = Streak.objects.get_or_create(user=request.user)
-                profile.current_streak += 1
-                profile.last_goal_date = today
-                profile.save()
-                streak.current_streak = profile.current_streak
-                streak.best_streak = max(streak.best_streak, streak.current_streak)
-                streak.save()
+    seconds = 0
+    if progress.set_chunk_watched(chunk, bool(data.get('is_watched', False))):
+        duration = chunk.end_seconds - chunk.start_seconds
+        seconds = duration if chunk.is_watched else -duration
+    return _toggle_response(request, chunk.video.subject, seconds)
+
+def _save_note_body(note, request):
+    """
+    Saves a note from a JSON body in one of three forms:
+    {"content": "..."} or {"blocks": [...]} replace the whole note;
+    {"base_version": n, "ops": [[index, delete_count, [blocks]], ...]} sends
+    only the changed blocks (see core.services.note_store). A delta against a
+    stale version gets a 409 with the current version; the client then falls
+    back to a full save.
+    """
+    import json
+    try:
+        data = json.loads(request.body)
+        if 'ops' in data:
+            version = note.apply_delta_to_file(data['base_version'], data['ops'])
+        elif 'blocks' in data:
+            if not all(isinstance(block, str) for block in data['blocks']):
+                raise ValueError("blocks must be strings")
+            version = note.save_blocks_to_file(data['blocks'])
         else:
-             daily_goal.completed_seconds = max(0, daily_goal.completed_seconds - duration)
-        daily_goal.save()
-    
-    return JsonResponse({
-        'status': 'ok',
-        'today_minutes': today_minutes
-    })
+            version = note.save_content_to_file(data.get('content', ''))
+    except note_store.DeltaConflict as e:
+        return JsonResponse({'status': 'conflict', 'version': e.version}, status=409)
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        return JsonResponse({'status': 'error', 'message': f'Invalid note data: {e}'}, status=400)
+
+    # The timestamp and search index are updated when the file is written
+    # (Note.file_written), once per write-behind window
+    return JsonResponse({'status': 'ok', 'version': version})
 
 @require_POST
 @login_required
 def save_note(request, note_id):
+    note = get_object_or_404(Note.objects.select_related('subject__exam'), id=note_id, subject__exam__user=request.user)
+    return _save_note_body(note, request)
+
+def note_versions_response(note):
+    path = note.get_file_path()
+    note_store.compact(path) # Writes pending saves, so they are listed
+    return JsonResponse({'status': 'ok', 'versions': note_history.versions(path)})
+
+def restore_note_version_response(note, history_id):
+    """Saves an old version as the note's newest one (the history itself is kept)."""
+    from django.http import Http404
+    content = note_history.content(note.get_file_path(), history_id)
+    if content is None:
+        raise Http404("No such version")
+    version = note.save_content_to_file(content)
+    return JsonResponse({'status': 'ok', 'version': version})
+
+@login_required
+def note_versions(request, note_id):
     note = get_object_or_404(Note, id=note_id, subject__exam__user=request.user)
-    import json
-    data = json.loads(request.body)
-    # note_type = data.get('note_type', 'content') # Removed screenshot support
-    
-    note.save_content_to_file(data.get('content', ''))
-        
-    note.save() # Update timestamp
-    return JsonResponse({'status': 'ok'})
+    return note_versions_response(note)
+
+@require_POST
+@login_required
+def restore_note_version(request, note_id, history_id):
+    note = get_object_or_404(Note.objects.select_related('subject__exam'), id=note_id, subject__exam__user=request.user)
+    return restore_note_version_response(note, history_id)
 
 @require_POST
 @login_required
@@ -565,19 +600,31 @@ def set_daily_goal(request, subject_id):
 @login_required
 def common_note_view(request):
     note, created = CommonNote.objects.get_or_create(user=request.user)
-    # Load content from file
-    note.content = note.get_content_from_file()
+    # The content is fetched by the page from get_common_note_content
     return render(request, 'common_note.html', {'note': note})
 
+@login_required
+def get_common_note_content(request):
+    note, created = CommonNote.objects.get_or_create(user=request.user)
+    return note_content_response(request, note)
+
 @require_POST
 @login_required
 def save_common_note(request):
     note, created = CommonNote.objects.get_or_create(user=request.user)
-    import json
-    data = json.loads(request.body)
-    note.save_content_to_file(data.get('content', ''))
-    note.save() # Update timestamp
-    return JsonResponse({'status': 'ok'})
+    return _save_note_body(note, request)
+
+@login_required
+def common_note_versions(request):
+    note, created = CommonNote.objects.get_or_create(user=request.user)
+    return note_versions_response(note)
+
+@require_POST
+@login_required
+def restore_common_note_version(request, history_id):
+    note, created = CommonNote.objects.get_or_create(user=request.user)
+    return restore_note_version_response(note, history_id)
+
 @login_required
 def get_today_goal(request):
     today = timezone.localdate()
@@ -610,32 +657,8 @@ def save_focus_progress(request):
     if not daily_goal:
         return JsonResponse({'status': 'no_goal', 'message': 'No goal found for today'})
         
-    daily_goal.completed_seconds += new_seconds
-    
-    # Check completion
-    goal_seconds = int(daily_goal.goal_hours * 3600)
-    if daily_goal.completed_seconds >= goal_seconds: # Check if met
-        if not daily_goal.achieved: # First time met today
-            daily_goal.achieved = True
-            
-            # Update Streak
-            profile = request.user.profile
-            streak, _ = Streak.objects.get_or_create(user=request.user)
-            
-            profile.current_streak += 1
-            profile.last_goal_date = today
-            profile.save()
-            
-            streak.current_streak = profile.current_streak
-            streak.best_streak = max(streak.best_streak, streak.current_streak)
-            streak.save()
-            
-        daily_goal.is_completed = True
-        
-        # Streak logic is handled above by checking if it wasn't achieved yet
-        pass 
-
-    daily_goal.save()
+    # Marks completion and extends the streak the first time the goal is met
+    streaks.add_goal_progress(daily_goal, new_seconds)
     
     return JsonResponse({
         'status': 'ok',
@@ -648,6 +671,7 @@ def save_focus_progress(request):
 def delete_exam(request, exam_id):
     exam = get_object_or_404(Exam, id=exam_id, user=request.user)
     exam.delete()
+    progress.bump_progress_version(request.user)
     return redirect('dashboard')
 
 @require_POST
@@ -655,7 +679,7 @@ def delete_exam(request, exam_id):
 def delete_subject(request, subject_id):
     subject = get_object_or_404(Subject, id=subject_id, exam__user=request.user)
     exam_id = subject.exam.id
-    subject.delete()
+    progress.delete_subject(subject)
     return redirect('exam_detail', exam_id=exam_id)
 
 @require_POST
@@ -663,7 +687,8 @@ def delete_subject(request, subject_id):
 def delete_playlist(request, subject_id):
     subject = get_object_or_404(Subject, id=subject_id, exam__user=request.user)
     try:
-        count, _ = subject.videos.all().delete()
+        count = progress.delete_subject_videos(subject)
+        Subject.objects.filter(pk=subject.pk).update(playlist_url='')
         messages.success(request, f"Successfully deleted {count} videos from playlist.")
     except Exception as e:
         messages.error(request, f"Error deleting playlist: {e}")
@@ -684,10 +709,8 @@ def upload_csv_todo(request, subject_id):
         
     try:
         from core.services.csv_importer import import_videos_from_csv
-        # Read file content safely
-        file_data = file.read().decode('utf-8')
-        
-        result = import_videos_from_csv(file_data, subject)
+        # The importer streams the upload chunk by chunk
+        result = import_videos_from_csv(file, subject, dedupe=request.POST.get('dedupe') or None)
         return JsonResponse(result)
     except Exception as e:
         return JsonResponse({'success': False, 'message': str(e)})
@@ -703,6 +726,7 @@ def set_global_goal(request):
     obj, created = DailyGoal.objects.get_or_create(user=request.user, date=today, defaults={'goal_hours': hours})
     if not created:
         return JsonResponse({'status': 'exists', 'message': 'Goal already set for today!'})
+    history.record(request.user, today, goal_seconds=int(obj.goal_hours * 3600))
         
     return JsonResponse({'status': 'ok'})
 
@@ -732,10 +756,99 @@ def stop_timer(request):
         diff = (session.end_time - session.start_time).total_seconds()
         session.total_seconds = int(diff)
         session.save()
+        history.record(request.user, session.date, focus_seconds=session.total_seconds)
         
         # Check daily goal achievement (Global timer + Video time?)
         # For now just log it.
         return JsonResponse({'status': 'stopped', 'seconds': session.total_seconds})
     return JsonResponse({'status': 'error', 'message': 'No running session'})
 
+def parse_date_range(params):
+    """Reads optional 'from'/'to' (YYYY-MM-DD) query params. Raises ValueError on bad input."""
+    import datetime
+    try:
+        start = datetime.date.fromisoformat(params['from']) if params.get('from') else None
+        end = datetime.date.fromisoformat(params['to']) if params.get('to') else None
+    except ValueError:
+        raise ValueError('Dates must be in YYYY-MM-DD format')
+    if start and end and start > end:
+        raise ValueError("'from' must not be after 'to'")
+    return start, end
 
+@login_required
+def get_history(request):
+    """
+    Study history for heatmaps and trend charts, answered from the rollups.
+    Query params: from, to (YYYY-MM-DD), granularity (day/week/month), subject (optional ID).
+    """
+    import datetime
+    granularity = request.GET.get('granularity', 'day')
+    if granularity not in history.GRANULARITIES:
+        return JsonResponse({'status': 'error', 'message': 'granularity must be day, week or month'}, status=400)
+
+    try:
+        start, end = parse_date_range(request.GET)
+    except ValueError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    end = end or timezone.localdate()
+    start = start or end - datetime.timedelta(days=365)
+
+    subject = None
+    subject_id = request.GET.get('subject')
+    if subject_id:
+        if not subject_id.isdigit():
+            return JsonResponse({'status': 'error', 'message': 'subject must be an ID'}, status=400)
+        subject = get_object_or_404(Subject, id=subject_id, exam__user=request.user)
+
+    return JsonResponse({
+        'status': 'ok',
+        'granularity': granularity,
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'data': history.get_history(request.user, start, end, granularity, subject=subject),
+    })
+
+@login_required
+def search_notes(request):
+    """
+    Full-text search over the user's subject notes and common notes.
+    Query params: q, limit (default 20, at most 100).
+    """
+    if not note_search.available():
+        return JsonResponse({'status': 'error', 'message': 'Search needs the SQLite database'}, status=400)
+    query = request.GET.get('q', '').strip()
+    if not query:
+        return JsonResponse({'status': 'error', 'message': 'q is required'}, status=400)
+    try:
+        limit = min(max(int(request.GET.get('limit', 20)), 1), 100)
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'limit must be a number'}, status=400)
+
+    results = note_search.search(request.user, query, limit)
+    for result in results:
+        if result['kind'] == 'note':
+            result['url'] = reverse('subject_detail', args=[result['subject_id']])
+        else:
+            result['url'] = reverse('common_note')
+    return JsonResponse({'status': 'ok', 'query': query, 'results': results})
+
+@login_required
+def export_history(request):
+    """
+    Streams the user's study logs, sessions, goals and watched state.
+    Query params: format (csv/ndjson), from, to (YYYY-MM-DD).
+    """
+    from core.services import export
+    fmt = request.GET.get('format', 'csv')
+    if fmt not in export.FORMATS:
+        return JsonResponse({'status': 'error', 'message': 'format must be csv or ndjson'}, status=400)
+    try:
+        start, end = parse_date_range(request.GET)
+    except ValueError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+
+    stream, content_type = export.FORMATS[fmt]
+    rows = export.export_rows(request.user, start, end)
+    response = StreamingHttpResponse(export.buffered(stream(rows)), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="study-history.{fmt}"'
+    return response
@@ -53,6 +53,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.QueryBudgetMiddleware',
+    'core.middleware.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -63,6 +65,18 @@ MIDDLEWARE = [
     'core.middleware.EnsureAPIKeyMiddleware',
 ]
 
+# Per-request query count / DB time in a Server-Timing header and the 'core.queries' logger
+QUERY_INSTRUMENTATION = os.environ.get('QUERY_INSTRUMENTATION', str(DEBUG)) == 'True'
+QUERY_DUPLICATE_THRESHOLD = 3
+
+# Sampled cProfile dumps; a request can also opt in with a signed token
+# (manage.py profile_report --token). Summarise with manage.py profile_report.
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', 'False') == 'True'
+PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', '0'))
+PROFILING_DIR = Path(os.environ.get('PROFILING_DIR', BASE_DIR / 'profiles'))
+PROFILING_MAX_FILES = 200
+PROFILING_TOP_N = 30
+
 ROOT_URLCONF = 'done_dusted.urls'
 
 TEMPLATES = [
@@ -94,6 +108,48 @@ DATABASES = {
 }
 
 
+# Cache
+# Local memory by default; set CACHE_DIR to share the cache between worker processes
+# without running Redis. Analytics payloads are cached here (core.services.analytics).
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+if os.environ.get('CACHE_DIR'):
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ['CACHE_DIR'],
+    }
+
+
+# YouTube Data API client (core.utils)
+# Timeouts are (connect, read) seconds; workers bound the concurrent videos.list lookups.
+
+YOUTUBE_API_URL = os.environ.get('YOUTUBE_API_URL', 'https://www.googleapis.com/youtube/v3')
+YOUTUBE_TIMEOUT = (
+    float(os.environ.get('YOUTUBE_CONNECT_TIMEOUT', '3.05')),
+    float(os.environ.get('YOUTUBE_READ_TIMEOUT', '10')),
+)
+YOUTUBE_MAX_WORKERS = int(os.environ.get('YOUTUBE_MAX_WORKERS', '4'))
+IMPORT_BATCH_LIMIT = 50 # Playlists per batch import request
+
+# Cross-user metadata cache (core.services.youtube_cache), in seconds
+YOUTUBE_VIDEO_CACHE_TTL = 7 * 24 * 3600
+YOUTUBE_PLAYLIST_CACHE_TTL = 24 * 3600
+YOUTUBE_KEY_VALIDATION_TTL = 24 * 3600
+
+# Per-key budget (core.services.quota): estimated units per Pacific-time day,
+# token bucket rate in requests/second, and retries with jittered exponential backoff
+YOUTUBE_DAILY_QUOTA = int(os.environ.get('YOUTUBE_DAILY_QUOTA', '10000'))
+YOUTUBE_RATE_LIMIT = 10
+YOUTUBE_RATE_BURST = 10
+YOUTUBE_MAX_RETRIES = 3
+YOUTUBE_BACKOFF_BASE = 0.5
+
+
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
 
@@ -138,7 +194,51 @@ MEDIA_ROOT = BASE_DIR / 'media'
 # Increase request body size limit to 50MB to support large notes (1000+ pages)
 DATA_UPLOAD_MAX_MEMORY_SIZE = 52428800 # 50 MB
 
+# Delta note saves are journaled next to the note file and folded into it
+# after this many saves (or once the journal outgrows the note)
+NOTE_JOURNAL_MAX_ENTRIES = int(os.environ.get('NOTE_JOURNAL_MAX_ENTRIES', '100'))
+
+# Note bodies are stored compressed: 'auto' (zstd if the zstandard package is
+# installed, else gzip), 'zstd', 'gzip' or 'identity' (uncompressed).
+# Existing files are converted with `manage.py compress_notes`.
+NOTE_COMPRESSION = os.environ.get('NOTE_COMPRESSION', 'auto')
+
+# Long notes are indexed into sections (at headings, or once a section
+# reaches this size) that the editor loads as they scroll into view
+NOTE_SECTION_MAX_BYTES = int(os.environ.get('NOTE_SECTION_MAX_BYTES', str(64 * 1024)))
+
+# Opt-in, single process only: autosaves of a note within this many seconds
+# are coalesced in memory and journaled as one delta (0, the default, writes
+# every save). The buffer is per process, so with several workers (e.g.
+# gunicorn) saves can be lost; keep it at 0 there.
+NOTE_WRITE_BEHIND_SECONDS = float(os.environ.get('NOTE_WRITE_BEHIND_SECONDS', '0'))
+
+# Keep every written version of a note (deduplicated chunks under
+# MEDIA_ROOT/notes/objects; `manage.py gc_note_objects` drops unused ones)
+NOTE_HISTORY = os.environ.get('NOTE_HISTORY', 'True') == 'True'
+
+# fsync note files (and their directory) after every write
+NOTE_FSYNC = os.environ.get('NOTE_FSYNC', 'False') == 'True'
+
 
 LOGIN_REDIRECT_URL = 'dashboard'
 LOGOUT_REDIRECT_URL = 'login'
 
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'core.queries': {
+            'handlers': ['console'],
+            'level': os.environ.get('QUERY_LOG_LEVEL', 'WARNING'),
+        },
+        'core.utils': { # YouTube API client
+            'handlers': ['console'],
+            'level': os.environ.get('YOUTUBE_LOG_LEVEL', 'WARNING'),
+        },
+    },
+}
@@ -29,8 +29,9 @@ echo.
 echo [INFO] Starting Django server...
 echo.
 
-:: 3. Run server in background
+:: 3. Run server and playlist import worker in background
 start cmd /k python manage.py runserver
+start cmd /k python manage.py run_import_worker
 
 :: 4. Wait 5 seconds
 timeout /t 5 /nobreak >nul
@@ -0,0 +1,257 @@
+// Block-level note saving. The editor's top-level nodes are the blocks: the
+// first save of a page sends them all, later saves send one op
+// [index, delete_count, [changed blocks]] against the version the server
+// returned. A 409 (someone else saved in between) falls back to a full save.
+class NoteSync {
+    constructor(saveUrl, csrfToken) {
+        this.saveUrl = saveUrl;
+        this.csrfToken = csrfToken;
+        this.version = null;
+        this.savedBlocks = null;
+    }
+
+    // Fetches a note in RANGE_SIZE pieces, so a long note can be shown while
+    // the rest is still loading (onProgress gets the HTML received so far).
+    // If-Range makes the server send the whole note if it changes meanwhile.
+    static async load(url, onProgress) {
+        const decoder = new TextDecoder();
+        let html = '', start = 0, total = null, etag = null;
+        while (total === null || start < total) {
+            const headers = { Range: `bytes=${start}-${start + NoteSync.RANGE_SIZE - 1}` };
+            if (etag) headers['If-Range'] = etag;
+            const response = await fetch(url, { headers: headers });
+            if (response.status === 416) return ''; // Empty note
+            if (!response.ok) throw new Error(`Loading note failed: ${response.status}`);
+            if (response.status === 200) return response.text();
+
+            etag = response.headers.get('ETag');
+            total = parseInt(response.headers.get('Content-Range').split('/')[1], 10);
+            const bytes = await response.arrayBuffer();
+            start += bytes.byteLength;
+            html += decoder.decode(bytes, { stream: start < total });
+            if (onProgress && start < total) onProgress(html);
+        }
+        return html;
+    }
+
+    static blocks(editor) {
+        const holder = document.createElement('div');
+        return Array.from(editor.childNodes, (node) => {
+            holder.replaceChildren(node.cloneNode(true));
+            return holder.innerHTML;
+        });
+    }
+
+    static diff(before, after) {
+        let start = 0;
+        while (start < before.length && start < after.length && before[start] === after[start]) start++;
+        let end = 0;
+        while (end < before.length - start && end < after.length - start
+            && before[before.length - 1 - end] === after[after.length - 1 - end]) end++;
+        if (start === before.length && start === after.length) return null;
+        return [start, before.length - start - end, after.slice(start, after.length - end)];
+    }
+
+    async post(body) {
+        return fetch(this.saveUrl, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-CSRFToken': this.csrfToken
+            },
+            body: JSON.stringify(body)
+        });
+    }
+
+    async save(editor) {
+        const blocks = NoteSync.blocks(editor);
+        let response;
+        if (this.version !== null) {
+            const op = NoteSync.diff(this.savedBlocks, blocks);
+            if (!op) return true;
+            response = await this.post({ base_version: this.version, ops: [op] });
+        }
+        if (!response || response.status === 409) {
+            response = await this.post({ blocks: blocks });
+        }
+        if (!response.ok) return false;
+        const data = await response.json();
+        this.version = data.version;
+        this.savedBlocks = blocks;
+        return true;
+    }
+}
+NoteSync.RANGE_SIZE = 1024 * 1024;
+
+// Loads a long note section by section. The editor gets one container per
+// section from the outline; a container's HTML is fetched (and handed to
+// onLoad for typesetting) only when it comes close to the viewport. Saving
+// replaces just the sections whose HTML changed since they were loaded.
+class SectionedNote {
+    constructor(editor, noteUrl, csrfToken, onLoad) {
+        this.editor = editor;
+        this.noteUrl = noteUrl; // .../note/<id>/
+        this.sync = new NoteSync(noteUrl + 'save/', csrfToken);
+        this.onLoad = onLoad || (() => Promise.resolve());
+        this.sections = [];
+        this.observer = new IntersectionObserver((entries) => {
+            entries.filter((entry) => entry.isIntersecting)
+                .forEach((entry) => this.loadSection(this.sectionOf(entry.target)));
+        }, { root: editor, rootMargin: '1500px 0px' }); // The editor is the scroll container
+    }
+
+    sectionOf(container) {
+        return this.sections.find((section) => section.container === container);
+    }
+
+    container(loaded) {
+        const container = document.createElement('div');
+        container.className = 'note-section';
+        if (!loaded) {
+            container.contentEditable = 'false';
+            container.textContent = 'Loading…';
+        }
+        return container;
+    }
+
+    async open() {
+        const response = await fetch(this.noteUrl + 'sections/');
+        if (!response.ok) throw new Error(`Loading outline failed: ${response.status}`);
+        const data = await response.json();
+        this.sync.version = data.version;
+        this.observer.disconnect();
+        this.editor.replaceChildren();
+        this.sections = data.sections.map((entry) => {
+            const container = this.container(false);
+            // Roughly the rendered height, so the scrollbar is about right before loading
+            container.style.minHeight = `${Math.max(40, Math.round(entry.bytes / 25))}px`;
+            this.editor.appendChild(container);
+            this.observer.observe(container);
+            return { id: entry.id, blocks: entry.blocks, container: container, loaded: false, snapshot: '' };
+        });
+        if (!this.sections.length) {
+            const container = this.container(true);
+            this.editor.appendChild(container);
+            this.sections.push({ id: null, blocks: 0, container: container, loaded: true, snapshot: '' });
+        }
+    }
+
+    // Callers share the fetch of a section already on its way, so awaiting
+    // this always means the section is in (or could not be loaded)
+    loadSection(section) {
+        if (!section || section.loaded) return Promise.resolve();
+        if (!section.loading) {
+            section.loading = this.fetchSection(section).finally(() => { section.loading = null; });
+        }
+        return section.loading;
+    }
+
+    async fetchSection(section) {
+        const response = await fetch(`${this.noteUrl}sections/${section.id}/`);
+        if (!response.ok) return; // Re-indexed by a save elsewhere; the next open() picks up the new outline
+        section.container.innerHTML = await response.text();
+        section.container.removeAttribute('contenteditable');
+        section.container.style.minHeight = '';
+        this.observer.unobserve(section.container);
+        await this.onLoad(section.container);
+        section.snapshot = NoteSync.blocks(section.container).join('');
+        section.loaded = true;
+    }
+
+    // Resolves to true once every section is loaded, false if some could not be
+    async loadAll() {
+        await Promise.all(this.sections.map((section) => this.loadSection(section)));
+        return this.sections.every((section) => section.loaded);
+    }
+
+    // Editor nodes typed outside any container belong to the section before
+    // them (container null: the nodes before the first container)
+    strays(container) {
+        const nodes = [];
+        let node = container ? container.nextSibling : this.editor.firstChild;
+        for (; node && !(node.classList && node.classList.contains('note-section')); node = node.nextSibling) {
+            nodes.push(node);
+        }
+        return nodes;
+    }
+
+    ops() {
+        const ops = [];
+        let index = 0;
+        const leading = this.strays(null);
+        if (leading.length) {
+            const blocks = NoteSync.blocks({ childNodes: leading });
+            ops.push([0, 0, blocks]);
+            index += blocks.length;
+        }
+        for (const section of this.sections) {
+            if (section.container.parentNode !== this.editor) { // Deleted along with its container
+                if (section.blocks) ops.push([index, section.blocks, []]);
+                continue;
+            }
+            const strays = NoteSync.blocks({ childNodes: this.strays(section.container) });
+            if (section.loaded) {
+                const blocks = NoteSync.blocks(section.container).concat(strays);
+                if (blocks.join('') !== section.snapshot) ops.push([index, section.blocks, blocks]);
+                index += blocks.length;
+            } else {
+                index += section.blocks;
+                if (strays.length) ops.push([index, 0, strays]);
+                index += strays.length;
+            }
+        }
+        return ops;
+    }
+
+    // After a save the containers are made to match what the server stored
+    settle() {
+        const leading = this.strays(null);
+        const settled = [];
+        if (leading.length) {
+            const container = this.container(true);
+            this.editor.insertBefore(container, this.editor.firstChild);
+            container.append(...leading);
+            settled.push({ id: null, container: container, loaded: true });
+        }
+        for (const section of this.sections) {
+            if (section.container.parentNode !== this.editor) continue;
+            const strays = this.strays(section.container);
+            settled.push(section);
+            if (section.loaded) {
+                section.container.append(...strays);
+            } else if (strays.length) {
+                const container = this.container(true);
+                section.container.after(container);
+                container.append(...strays);
+                settled.push({ id: null, container: container, loaded: true });
+            }
+        }
+        for (const section of settled) {
+            if (!section.loaded) continue;
+            const blocks = NoteSync.blocks(section.container);
+            section.blocks = blocks.length;
+            section.snapshot = blocks.join('');
+        }
+        this.sections = settled;
+    }
+
+    async save() {
+        const ops = this.ops();
+        if (!ops.length) return true;
+        let response = await this.sync.post({ base_version: this.sync.version, ops: ops });
+        if (response.status === 409) {
+            // Saved elsewhere in the meantime: this copy wins, so send all of it
+            await this.loadAll();
+            const present = this.sections.filter((section) => section.container.parentNode === this.editor);
+            if (present.some((section) => !section.loaded)) return false;
+            const blocks = NoteSync.blocks({ childNodes: this.strays(null) }).concat(...present.map(
+                (section) => NoteSync.blocks(section.container).concat(NoteSync.blocks({ childNodes: this.strays(section.container) }))
+            ));
+            response = await this.sync.post({ blocks: blocks });
+        }
+        if (!response.ok) return false;
+        this.sync.version = (await response.json()).version;
+        this.settle();
+        return true;
+    }
+}